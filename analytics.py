@@ -0,0 +1,2000 @@
+import hashlib
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from bill_io import available_cpus, file_digest, load_bills
+from profiling import stage
+from service_items import item_minutes, item_overrides_version
+
+# 分析流程（不依賴 Streamlit）：app.py 與 cli.py 共用
+
+# 流程依賴 Copy-on-Write：篩選後直接加欄、以 copy(deep=False) 取得可加欄的新物件，都不會動到原表也不必整份複製。
+# pandas 3 起固定開啟；pandas 2 需手動開啟
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
+CHURN_DAYS = 60
+T2_DAYS = 30
+T3_DAYS = 60
+REGULAR_DAYS = 180
+REGULAR_VISITS = 5
+RETENTION_DAYS = 180
+RETENTION_VISITS = 3
+RELATIONSHIP_COHORT_MONTHS = 12
+
+class DataInputError(Exception):
+    pass
+
+# 增量狀態：基礎模型存成單一 pickle，之後只上傳新月份帳單即可附加
+STATE_DIR = Path(os.environ.get("ANALYTICS_STATE_DIR", Path.home() / ".cache" / "therapist-churn-insights" / "state"))
+STATE_PATH = STATE_DIR / "base_state.pkl"
+
+# Normalize phone numbers
+
+def norm_digits(x):
+    if pd.isna(x):
+        return None
+    if isinstance(x, (int, np.integer)):
+        s = str(int(x))
+    elif isinstance(x, (float, np.floating)):
+        if np.isnan(x):
+            return None
+        s = str(int(x)) if float(x).is_integer() else str(x)
+    else:
+        s = str(x)
+    digits = re.sub(r"\D+", "", s)
+    return digits or None
+
+def _strip_non_digits(values):
+    # 已是純數字（isdecimal 與 \d 同為 Unicode Nd）的字串不必再跑 regex
+    text = pd.Series(values.to_numpy(dtype=object), index=values.index, dtype=object)
+    clean = text.str.isdecimal().to_numpy(dtype=bool)
+    result = text.to_numpy(dtype=object, copy=True)
+    if not clean.all():
+        result[~clean] = text[~clean].str.replace(r"\D+", "", regex=True).to_numpy(dtype=object)
+    result[pd.Series(result, dtype=object).str.len().to_numpy() == 0] = None
+    return pd.Series(result, index=values.index, dtype=object)
+
+def _norm_numeric_digits(values):
+    # 數值快速路徑：整數值直接轉 int 字串（去負號即為數字）；非整數比照 str(float) 再去非數字
+    arr = values.to_numpy(dtype=float)
+    is_int = np.isfinite(arr) & (np.floor(arr) == arr) & (np.abs(arr) < 2**53)
+    out = pd.Series([None] * len(values), index=values.index, dtype=object)
+    if is_int.any():
+        out[is_int] = np.abs(arr[is_int]).astype(np.int64).astype(str).astype(object)
+    if (~is_int).any():
+        out[~is_int] = _strip_non_digits(values[~is_int].astype(str)).to_numpy()
+    # 超過 2**53 的整數值交回 norm_digits 逐筆處理，確保與 str(int(x)) 一致
+    exact = ~(np.isfinite(arr) & (np.floor(arr) == arr) & ~is_int)
+    return out, pd.Series(~exact, index=values.index)
+
+def norm_digits_series(series):
+    # norm_digits 的向量化版本：字串走 str.replace，整數/浮點欄走 dtype 快速路徑，其餘逐筆
+    out = pd.Series([None] * len(series), index=series.index, dtype=object)
+    values = series[series.notna()]
+    if values.empty:
+        return out
+    fallback = pd.Series(False, index=values.index)
+    if pd.api.types.is_bool_dtype(values):
+        fallback[:] = True
+    elif pd.api.types.is_integer_dtype(values):
+        out[values.index] = _strip_non_digits(values.astype(str)).to_numpy()
+    elif pd.api.types.is_float_dtype(values):
+        digits, fallback = _norm_numeric_digits(values)
+        out[values.index] = digits.to_numpy()
+    else:
+        inferred = pd.api.types.infer_dtype(values)
+        if inferred == "string":
+            is_str = pd.Series(True, index=values.index)
+        elif inferred in ("mixed", "mixed-integer"):
+            is_str = values.str.len().notna()
+        else:
+            is_str = pd.Series(False, index=values.index)
+        if is_str.any():
+            strs = values[is_str]
+            out[strs.index] = _strip_non_digits(strs).to_numpy()
+        rest = values[~is_str]
+        if not rest.empty:
+            fallback[rest.index] = True
+            numeric = None
+            if pd.api.types.infer_dtype(rest) in ("integer", "floating", "mixed-integer-float"):
+                numeric = pd.to_numeric(rest, errors="coerce")
+            if numeric is not None and numeric.notna().all() and pd.api.types.is_integer_dtype(numeric):
+                out[rest.index] = _strip_non_digits(numeric.astype(str)).to_numpy()
+                fallback[rest.index] = False
+            elif numeric is not None and numeric.notna().all() and pd.api.types.is_float_dtype(numeric):
+                digits, rest_fallback = _norm_numeric_digits(numeric)
+                out[rest.index] = digits.to_numpy()
+                fallback[rest.index] = rest_fallback.to_numpy()
+    if fallback.any():
+        idx = fallback[fallback].index
+        out[idx] = [norm_digits(x) for x in values[idx]]
+    return out
+
+KEY_COLUMNS = ["phone_key", "分店", "設計師"]
+# 不重複值少的文字欄也轉 category：分組取首列等運算只搬 codes，不必把整欄轉成 Python 字串
+CATEGORY_COLUMNS = KEY_COLUMNS + ["項目", "指定"]
+
+def encode_keys(df, cols=CATEGORY_COLUMNS):
+    for c in cols:
+        if c in df.columns and not isinstance(df[c].dtype, pd.CategoricalDtype):
+            df[c] = df[c].astype("category")
+    return df
+
+def build_phone_key(df, cc_col, phone_col):
+    df[cc_col] = norm_digits_series(df[cc_col])
+    df[phone_col] = norm_digits_series(df[phone_col])
+    return df[cc_col].fillna("") + "-" + df[phone_col].fillna("")
+
+def norm_yes_no(x):
+    if pd.isna(x):
+        return None
+    s = str(x).strip().upper()
+    if s in ("Y", "YES", "TRUE", "1", "指定", "是"):
+        return True
+    if s in ("N", "NO", "FALSE", "0", "非指定", "否"):
+        return False
+    return None
+
+def minutes_to_hours(mins):
+    # 1~30=0.5, 31~60=1, 61~90=1.5, ...
+    mins = np.asarray(mins, dtype=float)
+    return np.where(mins > 0, np.ceil(mins / 30) * 0.5, 0.0)
+
+def visit_index(checkouts, key_cols):
+    # CSR 形式的來店索引：times 為依 (key, 時間) 排序的 int64 時間，offsets[slot]:offsets[slot + 1] 是該 key 的區段，
+    # keys 為 key → slot 的雜湊表（MultiIndex.get_indexer）；同一份資料建一次，流失/回指/熟客都從這裡查
+    visits = checkouts[key_cols + ["結帳操作時間"]].dropna()
+    dtypes = {c: visits[c].dtype for c in key_cols}
+    grouped = visits.groupby(key_cols, sort=True, observed=True)
+    codes = grouped.ngroup().to_numpy()
+    counts = grouped.size().to_numpy()
+    times = visits["結帳操作時間"].to_numpy()
+    order = np.lexsort((times.view("i8"), codes))
+    offsets = np.r_[0, np.cumsum(counts)].astype(np.int64)
+    starts = order[offsets[:-1]]
+    unit = np.datetime_data(times.dtype)[0]
+    return {
+        "key_cols": list(key_cols),
+        "dtypes": dtypes,
+        "keys": pd.MultiIndex.from_arrays([a[starts] for a in visit_key_arrays(visits, key_cols, dtypes)]),
+        "offsets": offsets,
+        "times": times[order].view("i8"),
+        "dtype": times.dtype,
+        "day": int(np.timedelta64(1, "D") / np.timedelta64(1, unit)),
+    }
+
+def visit_key_arrays(df, key_cols, dtypes):
+    # 鍵欄為 category 時以 codes 比對（類別不同時先對齊到索引的類別），否則用原值
+    arrays = []
+    for c in key_cols:
+        col = df[c]
+        if isinstance(dtypes[c], pd.CategoricalDtype):
+            if col.dtype != dtypes[c]:
+                col = col.astype(object).astype(dtypes[c])
+            arrays.append(col.cat.codes.to_numpy())
+        else:
+            arrays.append(col.to_numpy())
+    return arrays
+
+def visit_slots(index, df):
+    # 每列 key 對應的 slot，索引中沒有的為 -1
+    return index["keys"].get_indexer(pd.MultiIndex.from_arrays(visit_key_arrays(df, index["key_cols"], index["dtypes"])))
+
+def visit_ints(index, values):
+    # 時間轉成與索引同單位的 int64，並回傳非 NaT 的遮罩
+    values = np.asarray(values).astype(index["dtype"])
+    return values.view("i8"), ~np.isnat(values)
+
+def visit_search(index, slots, query, side="left"):
+    # 各 slot 區段內同步二分搜尋，回傳全域位置：區段內時間 < query（left）或 <= query（right）的最後一筆之後
+    times = index["times"]
+    lo = index["offsets"][slots]
+    hi = index["offsets"][slots + 1]
+    while True:
+        active = lo < hi
+        if not active.any():
+            return lo
+        mid = (lo + hi) // 2
+        t = times[np.where(active, mid, 0)]
+        right = active & ((t < query) if side == "left" else (t <= query))
+        lo = np.where(right, mid + 1, lo)
+        hi = np.where(active & ~right, mid, hi)
+
+def next_visit_day(index, slots, day):
+    # day（已取整到日）之後第一個有來店的日期（取整到日）與是否找到
+    pos = visit_search(index, slots, day + index["day"], "left")
+    found = pos < index["offsets"][slots + 1]
+    t = index["times"][np.where(found, pos, 0)]
+    return found, t - t % index["day"]
+
+def add_store_return_flags(df, index, first_col, churn_days, end_date=None):
+    # 同分店回店：首單日之後第一個來店日（以日計，同日不算）；index 為 (phone_key, 分店) 的 visit_index
+    slots = visit_slots(index, df)
+    first, valid = visit_ints(index, pd.to_datetime(df[first_col]).dt.normalize())
+    valid &= slots >= 0
+    found, next_day = next_visit_day(index, slots[valid], first[valid])
+    return_days = np.full(len(df), np.nan)
+    rows = np.flatnonzero(valid)[found]
+    return_days[rows] = (next_day[found] - first[valid][found]) // index["day"]
+    df["return_days_store"] = return_days
+    # 未回店（NaN）視為流失
+    df["churn"] = ~(return_days <= churn_days)
+    if end_date is not None:
+        df["matured"] = df[first_col] + pd.Timedelta(days=churn_days) <= end_date
+    return df
+
+def add_repeat_flags(df, index, first_col, t2, t3):
+    # 以日計：首單日之後第一個來店日為第 2 次、再之後的下一個來店日為第 3 次；index 為同 key 的 visit_index
+    slots = visit_slots(index, df)
+    first, valid = visit_ints(index, pd.to_datetime(df[first_col]).dt.normalize())
+    valid &= slots >= 0
+    rows = np.flatnonzero(valid)
+    slots = slots[valid]
+    first = first[valid]
+    days2 = np.full(len(df), np.nan)
+    days3 = np.full(len(df), np.nan)
+    found2, day2 = next_visit_day(index, slots, first)
+    days2[rows[found2]] = (day2[found2] - first[found2]) // index["day"]
+    found3, day3 = next_visit_day(index, slots[found2], day2[found2])
+    days3[rows[found2][found3]] = (day3[found3] - first[found2][found3]) // index["day"]
+    df["days_to_2nd"] = days2
+    df["days_to_3rd"] = days3
+    df["repeat2"] = days2 <= t2
+    df["repeat3"] = days3 <= t3
+    return df
+
+def add_regular_metrics(df, index, baseline_col):
+    n = len(df)
+    times = index["times"]
+    slots = visit_slots(index, df)
+    baseline, valid = visit_ints(index, df[baseline_col].to_numpy())
+    valid &= slots >= 0
+    slots = slots[valid]
+    base = baseline[valid]
+    regular_span = REGULAR_DAYS * index["day"]
+    retention_span = RETENTION_DAYS * index["day"]
+
+    lo = visit_search(index, slots, base, "left")
+    hi = visit_search(index, slots, base + regular_span, "right")
+    counts = np.zeros(n, dtype=np.int64)
+    counts[valid] = hi - lo
+    achieved = counts >= REGULAR_VISITS
+
+    regular_dates = np.full(n, np.datetime64("NaT"), dtype=index["dtype"])
+    post_regular_visits = np.full(n, np.nan)
+    retention_achieved = np.full(n, np.nan, dtype=object)
+    hit = achieved[valid]
+    if hit.any():
+        reg = times[lo[hit] + REGULAR_VISITS - 1]
+        post_lo = visit_search(index, slots[hit], reg, "right")
+        post_hi = visit_search(index, slots[hit], reg + retention_span, "right")
+        post = post_hi - post_lo
+        rows = np.flatnonzero(valid)[hit]
+        regular_dates[rows] = reg.view(index["dtype"])
+        post_regular_visits[rows] = post
+        retention_achieved[rows] = (post >= RETENTION_VISITS).tolist()
+    df["regular_count_180"] = counts
+    df["regular_achieved"] = achieved
+    df["regular_date"] = regular_dates
+    df["post_regular_visits_180"] = post_regular_visits
+    df["retention_achieved"] = retention_achieved
+    return df
+
+def zscore_series(series):
+    s = pd.to_numeric(series, errors="coerce")
+    mean = s.mean()
+    std = s.std()
+    if std == 0 or pd.isna(std):
+        return pd.Series(np.nan, index=s.index)
+    return (s - mean) / std
+
+def reliability_factor(n, n0=30):
+    n = pd.to_numeric(n, errors="coerce")
+    return np.where((n > 0) & pd.notna(n), np.minimum(1, np.sqrt(n / n0)), np.nan)
+
+def col_series(df, col):
+    if col in df.columns:
+        return df[col]
+    return pd.Series(np.nan, index=df.index)
+
+def goal_score_high(series, target, floor=0.0):
+    v = pd.to_numeric(series, errors="coerce").astype(float)
+    if pd.isna(target):
+        return pd.Series(np.nan, index=v.index)
+    denom = float(target) - float(floor)
+    if denom <= 0:
+        return pd.Series(np.nan, index=v.index)
+    score = (v - float(floor)) / denom * 100.0
+    return score.clip(lower=0, upper=100)
+
+def goal_score_low(series, target, ceiling=1.0):
+    v = pd.to_numeric(series, errors="coerce").astype(float)
+    if pd.isna(target):
+        return pd.Series(np.nan, index=v.index)
+    denom = float(ceiling) - float(target)
+    if denom <= 0:
+        return pd.Series(np.nan, index=v.index)
+    score = (float(ceiling) - v) / denom * 100.0
+    return score.clip(lower=0, upper=100)
+
+def shrink_to_neutral(score, rel, neutral=50.0):
+    s = pd.to_numeric(score, errors="coerce").astype(float)
+    r = pd.to_numeric(rel, errors="coerce").astype(float)
+    return neutral + (s - neutral) * r
+
+
+def normalize_bills(bills):
+    # 帳單 → 有效結帳列（phone_key、時間、指定）；逐列運算，串流讀檔時由 load_bills 逐塊套用
+    if "國碼" not in bills.columns or "電話號碼" not in bills.columns:
+        raise DataInputError("帳單檔缺少 '國碼' 或 '電話號碼' 欄位。")
+    bills["phone_key"] = build_phone_key(bills, "國碼", "電話號碼")
+    # 篩選本身就產生新表，之後直接加欄，不再另外複製整份帳單
+    valid_bills = bills[bills["phone_key"].str.contains("-") & (bills["phone_key"] != "-")]
+    valid_bills["結帳操作時間"] = pd.to_datetime(valid_bills["結帳操作時間"], errors="coerce")
+    if "指定" in valid_bills.columns:
+        valid_bills["is_requested"] = valid_bills["指定"].apply(norm_yes_no)
+    else:
+        valid_bills["is_requested"] = pd.NA
+    return valid_bills
+
+def prepare_checkouts(bills):
+    # 帳單 → 有效結帳列（phone_key、時間、指定），鍵欄轉 category；讀檔時已正規化就不再重做。
+    # 會員欄位不併進結帳列，要顯示/匯出時才以 attach_members 補上
+    valid_bills = bills if "phone_key" in bills.columns else normalize_bills(bills)
+    if "設計師" not in valid_bills.columns:
+        raise DataInputError("帳單檔缺少 '設計師' 欄位，無法分師傅。")
+
+    # phone_key/分店/設計師（與項目、指定）轉為 category：後續 groupby/merge 以整數 codes 運算，顯示時自動還原成原字串
+    return encode_keys(valid_bills)
+
+def read_members(member_file):
+    return pd.read_excel(member_file, sheet_name="會員名單", usecols=lambda c: c in ["國碼", "手機號碼", "來店次數", "會員姓名"])
+
+def prepare_members(members):
+    if "國碼" not in members.columns or "手機號碼" not in members.columns:
+        raise DataInputError("會員名單缺少 '國碼' 或 '手機號碼' 欄位。")
+    members["phone_key"] = build_phone_key(members, "國碼", "手機號碼")
+    valid_members = members[members["phone_key"].str.contains("-") & (members["phone_key"] != "-")]
+    member_cols = ["phone_key", "來店次數", "會員姓名"]
+    member_cols = [c for c in member_cols if c in valid_members.columns]
+    # 以 phone_key 為索引的會員表；同一電話重複時取第一筆
+    return valid_members[member_cols].drop_duplicates("phone_key").set_index("phone_key")
+
+def attach_members(df, members):
+    # 只在要顯示/匯出的小表上依 phone_key 查會員索引補欄（會員姓名、來店次數）
+    if members is None or df is None or "phone_key" not in df.columns:
+        return df
+    return df.join(members, on="phone_key")
+
+def read_item_overrides(file):
+    # 上傳的覆寫 CSV：至少要有「項目」「分鐘」兩欄
+    try:
+        df = pd.read_csv(file, dtype={"項目": object}, keep_default_na=False, na_values={"分鐘": [""]}, encoding="utf-8-sig")
+    except (ValueError, UnicodeDecodeError) as e:
+        raise DataInputError(f"無法讀取服務時長覆寫檔：{e}")
+    if "項目" not in df.columns or "分鐘" not in df.columns:
+        raise DataInputError("服務時長覆寫檔需包含「項目」與「分鐘」欄位。")
+    return df[["項目", "分鐘"]]
+
+def month_labels(times):
+    # 逐列 "YYYY-MM" 月份，以 category 表示：每個月只轉一次文字；缺結帳時間的列歸在 "NaT"，與逐列 astype(str) 相同。
+    # codes 直接由月序號相減得到（類別含首尾之間所有月份，分組都用 observed=True），不雜湊也不排序整欄
+    months = times.to_numpy(dtype="datetime64[M]")
+    nat = np.isnat(months)
+    ints = months.view("i8")
+    valid = ints[~nat]
+    lo, hi = (valid.min(), valid.max()) if len(valid) else (0, -1)
+    labels = list(np.datetime_as_string(np.arange(lo, hi + 1).astype("datetime64[M]")))
+    codes = ints - lo
+    if nat.any():
+        codes[nat] = len(labels)
+        labels.append("NaT")
+    return pd.Categorical.from_codes(codes, categories=labels)
+
+def month_starts(months):
+    # "YYYY-MM" 月份文字 → 當月第一天；"NaT" 為 NaT。不同的月份只解析一次再依 codes 展開
+    codes, uniques = pd.factorize(np.asarray(months, dtype=object))
+    starts = pd.PeriodIndex(uniques, freq="M").to_timestamp()
+    return starts.take(codes, allow_fill=True, fill_value=pd.NaT)
+
+def day_bits(times):
+    # 結帳日在當月的位元（1 << (日-1)）；缺結帳時間為 0
+    day = times.dt.day
+    return np.where(day.notna(), np.left_shift(1, day.fillna(1).to_numpy(dtype=np.int64) - 1), 0)
+
+def count_days(day_mask):
+    mask = np.asarray(day_mask, dtype=np.int64)
+    return sum((mask >> d) & 1 for d in range(31))
+
+ACTIVITY_SUMS = ["orders", "service_hours", "new_customers"]
+
+def activity_cube(checkouts, group_cols):
+    # 每 (分店, 設計師, 月) 一列：單數、有單日（當月日遮罩與天數）、服務時數、最後結帳時間；
+    # 出勤、穩定度與空窗率都由這張小表彙總，不再各自對全部結帳列分組。
+    # 服務分鐘由服務項目對照表查得（手動覆寫優先），不逐列解析文字
+    times = checkouts["結帳操作時間"]
+    cells = checkouts[group_cols[:-1]].assign(month=month_labels(times), day_mask=day_bits(times), last_tx=times)
+    if "項目" in checkouts.columns:
+        cells["service_hours"] = minutes_to_hours(item_minutes(checkouts["項目"]))
+    grouped = cells.groupby(group_cols, observed=True)
+    cube = grouped.size().rename("orders").to_frame()
+    if "service_hours" in cells.columns:
+        cube["service_hours"] = grouped["service_hours"].sum()
+    cube["last_tx"] = grouped["last_tx"].max()
+    # 同一天的位元相同：先對 (格, 日) 去重再相加即為 OR
+    cube["day_mask"] = (
+        cells[group_cols + ["day_mask"]].drop_duplicates()
+        .groupby(group_cols, observed=True)["day_mask"]
+        .sum()
+    )
+    cube["active_days"] = count_days(cube["day_mask"])
+    cube = cube.reset_index()
+    cube["month"] = cube["month"].astype(str)
+    return cube
+
+def rollup_activity(activity, keys):
+    # 把 cube 彙總到較粗的 keys（例如 設計師 × 月）或合併多份 cube：次數/時數相加、最後結帳取 max，
+    # 有單日以遮罩 OR 後重新計數（同一師傅跨分店同一天只算一次）
+    grouped = activity.groupby(keys, observed=True)
+    out = grouped[[c for c in ACTIVITY_SUMS if c in activity.columns]].sum()
+    out["last_tx"] = grouped["last_tx"].max()
+    masks = activity["day_mask"].to_numpy(dtype=np.int64)
+    bits = (
+        pd.DataFrame({d: (masks >> d) & 1 for d in range(31)}, index=activity.index)
+        .groupby([activity[k] for k in keys], observed=True)
+        .max()
+    )
+    out["day_mask"] = sum(bits[d].to_numpy(dtype=np.int64) << d for d in range(31))
+    out["active_days"] = count_days(out["day_mask"])
+    return out.reset_index()
+
+def add_new_customers(activity, new_first, group_cols):
+    # 新客數依全品牌首購所在的 (分店, 設計師, 月) 計；new_first 變動時整欄重算
+    firsts = new_first[group_cols[:-1]].assign(month=month_labels(new_first["結帳操作時間"]))
+    counts = firsts.groupby(group_cols, observed=True).size().rename("new_customers").reset_index()
+    counts["month"] = counts["month"].astype(str)
+    activity = activity.drop(columns="new_customers", errors="ignore").merge(counts, on=group_cols, how="left")
+    activity["new_customers"] = activity["new_customers"].fillna(0).astype(np.int64)
+    return activity
+
+def add_vacancy_rate(vacancy_monthly):
+    vacancy_monthly["vacancy_rate"] = (1 - vacancy_monthly["duration_hours"] / 168.0).clip(lower=0, upper=1)
+    return vacancy_monthly
+
+def vacancy_from_activity(activity, group_cols):
+    # 空窗率（月，168 小時上限）；帳單沒有「項目」欄時為 None
+    if "service_hours" not in activity.columns:
+        return None
+    # 沒有結帳時間的列歸在 "NaT" 月，不列入空窗率
+    activity = activity[activity["month"] != "NaT"]
+    return add_vacancy_rate(activity[group_cols + ["service_hours"]].rename(columns={"service_hours": "duration_hours"}))
+
+# 部分彙總：每 (資料截止日, 分店, 設計師, 月) 一列，全是可相加的計數（平均值拆成總和與筆數）；
+# 分店篩選只要把所選分店的列相加再重算比率
+PARTIAL_COUNTS = [
+    "matured_new_customers",
+    "churned",
+    "new_customers_3m",
+    "new_churned_3m",
+    "new_repeat_base_3m",
+    "new_repeat2_count",
+    "new_deep_n",
+    "new_deep_count",
+    "familiar_customers_3m",
+    "familiar_repeat2_count",
+    "familiar_deep_n",
+    "familiar_deep_count",
+    "total_orders_3m",
+    "request_yes_3m",
+    "request_total_3m",
+    "request_known",
+    "regular_base_180",
+    "regular_achieved_180",
+    "regular_days_sum",
+    "regular_days_n",
+    "retention_base_180",
+    "retention_achieved_180",
+    "post_regular_visits_sum",
+    "post_regular_visits_n",
+]
+
+def view_windows(end_date):
+    # 近 3 / 6 / 12 個月的起點
+    end_ts = pd.to_datetime(end_date)
+    return (
+        end_ts - pd.DateOffset(months=3),
+        end_ts - pd.DateOffset(months=6),
+        end_ts - pd.DateOffset(months=RELATIONSHIP_COHORT_MONTHS),
+    )
+
+def partial_counts(df, time_col, group_cols, counts, last_tx=False):
+    # counts：欄名 → 逐列布林/數值；月份取 time_col 所在月。分店或師傅缺值的列也保留（分店彙總要算）
+    cells = df[group_cols[:-1]].assign(month=month_labels(df[time_col]))
+    for name, values in counts.items():
+        cells[name] = np.asarray(values)
+    if last_tx:
+        cells["last_tx"] = df[time_col]
+    grouped = cells.groupby(group_cols, observed=True, dropna=False)
+    out = grouped[list(counts)].sum()
+    if last_tx:
+        out["last_tx"] = grouped["last_tx"].max()
+    out = out.reset_index()
+    out["month"] = out["month"].astype(str)
+    return out
+
+def end_date_partials(recent, new_first, relationship_first, end_date, group_cols, indexes, monthly):
+    # 單一資料截止日的部分彙總；滿期旗標與近 N 月區間的判斷與檢視階段相同。
+    # recent 只需含近 3 個月的結帳列；monthly 為與截止日無關的格（最後結帳時間、指定欄有值筆數），直接併入
+    start_ts_3m, _, start_ts_12m = view_windows(end_date)
+    parts = [monthly]
+
+    first_time = new_first["結帳操作時間"]
+    matured = (first_time + pd.Timedelta(days=CHURN_DAYS) <= end_date).to_numpy()
+    matured_2 = (first_time + pd.Timedelta(days=T2_DAYS) <= end_date).to_numpy()
+    matured_3 = (first_time + pd.Timedelta(days=T3_DAYS) <= end_date).to_numpy()
+    new_3m = (first_time >= start_ts_3m).to_numpy()
+    churn = new_first["churn"].to_numpy(dtype=bool)
+    parts.append(partial_counts(new_first, "結帳操作時間", group_cols, {
+        "matured_new_customers": matured,
+        "churned": matured & churn,
+        "new_customers_3m": new_3m & matured,
+        "new_churned_3m": new_3m & matured & churn,
+        "new_repeat_base_3m": new_3m & matured_2,
+        "new_repeat2_count": new_3m & matured_2 & new_first["repeat2"].to_numpy(dtype=bool),
+        "new_deep_n": new_3m & matured_3,
+        "new_deep_count": new_3m & matured_3 & new_first["repeat3"].to_numpy(dtype=bool),
+    }))
+
+    familiar_first = familiar_first_visits(recent, start_ts_3m, end_date, *indexes)
+    if not familiar_first.empty:
+        fam_2 = familiar_first["matured_2"].to_numpy(dtype=bool)
+        fam_3 = familiar_first["matured_3"].to_numpy(dtype=bool)
+        parts.append(partial_counts(familiar_first, "baseline_time", group_cols, {
+            "familiar_customers_3m": fam_2,
+            "familiar_repeat2_count": fam_2 & familiar_first["repeat2"].to_numpy(dtype=bool),
+            "familiar_deep_n": fam_3,
+            "familiar_deep_count": fam_3 & familiar_first["repeat3"].to_numpy(dtype=bool),
+        }))
+
+    times = recent["結帳操作時間"]
+    recent = recent[((times >= start_ts_3m) & (times <= end_date)).to_numpy()]
+    orders = {"total_orders_3m": np.ones(len(recent), dtype=np.int64)}
+    if "is_requested" in recent.columns:
+        orders.update(
+            request_yes_3m=(recent["is_requested"] == True).to_numpy(),
+            request_total_3m=recent["is_requested"].notna().to_numpy(),
+        )
+    parts.append(partial_counts(recent, "結帳操作時間", group_cols, orders))
+
+    if not relationship_first.empty:
+        baseline = relationship_first["baseline_time"]
+        regular_date = relationship_first["regular_date"]
+        in_12m = (baseline >= start_ts_12m).to_numpy()
+        regular_base = in_12m & (baseline + pd.Timedelta(days=REGULAR_DAYS) <= end_date).to_numpy()
+        achieved = (relationship_first["regular_achieved"] == True).to_numpy()
+        regular_days = (regular_date - baseline).dt.days.to_numpy(dtype=float)
+        retention_base = in_12m & achieved & (regular_date + pd.Timedelta(days=RETENTION_DAYS) <= end_date).to_numpy()
+        post_visits = relationship_first["post_regular_visits_180"].to_numpy(dtype=float)
+        parts.append(partial_counts(relationship_first, "baseline_time", group_cols, {
+            "regular_base_180": regular_base,
+            "regular_achieved_180": regular_base & achieved,
+            "regular_days_sum": np.where(regular_base & ~np.isnan(regular_days), regular_days, 0.0),
+            "regular_days_n": regular_base & ~np.isnan(regular_days),
+            "retention_base_180": retention_base,
+            "retention_achieved_180": retention_base & (relationship_first["retention_achieved"] == True).to_numpy(),
+            "post_regular_visits_sum": np.where(retention_base & ~np.isnan(post_visits), post_visits, 0.0),
+            "post_regular_visits_n": retention_base & ~np.isnan(post_visits),
+        }))
+
+    cells = pd.concat(parts, ignore_index=True).reindex(columns=group_cols + PARTIAL_COUNTS + ["last_tx"])
+    cells[PARTIAL_COUNTS] = cells[PARTIAL_COUNTS].fillna(0)
+    grouped = cells.groupby(group_cols, observed=True, dropna=False)
+    out = grouped[PARTIAL_COUNTS].sum()
+    out["last_tx"] = grouped["last_tx"].max()
+    counts = [c for c in PARTIAL_COUNTS if not c.endswith("_sum")]
+    out[counts] = out[counts].astype(np.int64)
+    out = out.reset_index()
+    out.insert(0, "end_date", end_date)
+    return out
+
+RELATIONSHIP_PARTIAL_COLUMNS = [
+    "baseline_time", "regular_date", "regular_achieved", "retention_achieved", "post_regular_visits_180",
+]
+
+def monthly_partials(merged, group_cols):
+    # 與截止日無關的每月格：最後結帳時間、指定欄有值筆數
+    known = {"request_known": merged["is_requested"].notna().to_numpy()} if "is_requested" in merged.columns else {}
+    return partial_counts(merged, "結帳操作時間", group_cols, known, last_tx=True)
+
+def store_partials(merged, new_first, relationship_first, end_dates=None, indexes=None, monthly=None):
+    # 篩選後的資料截止日是所選分店最後結帳時間的最大值，只可能是某家分店的最後結帳時間：
+    # 各截止日各算一份，且只含最後結帳不晚於該日的分店（截止日較晚的分店一選進來截止日就會變）
+    has_store = "分店" in merged.columns
+    group_cols = ["分店", "設計師", "month"] if has_store else ["設計師", "month"]
+    times = merged["結帳操作時間"]
+    if has_store:
+        store_last = times.groupby(merged["分店"], observed=True, dropna=False).max()
+    if end_dates is None:
+        ends = store_last if has_store else pd.Series([times.max()])
+        end_dates = sorted(set(ends.dropna()))
+    if not end_dates:
+        return None
+    # 熟客次數、回指與各截止日共用的索引與每月格只建一次（monthly 可由呼叫端先算好）；近 3 個月的結帳列從最早的截止日起算
+    indexes = store_visit_indexes(merged) if indexes is None else indexes
+    if monthly is None:
+        monthly = monthly_partials(merged, group_cols)
+    # 只留部分彙總用到的欄：各截止日依分店篩選時只複製這幾欄，不複製整列。
+    # 師傅關係起點早於最早截止日近 12 個月的列各項計數都是 0（所在的格已在 monthly 裡），先略過
+    start_ts_3m, _, start_ts_12m = view_windows(min(end_dates))
+    recent = merged.loc[
+        (times >= start_ts_3m).to_numpy(),
+        [c for c in KEY_COLUMNS + ["結帳操作時間", "is_requested"] if c in merged.columns],
+    ]
+    new_first = new_first[group_cols[:-1] + ["結帳操作時間", "churn", "repeat2", "repeat3"]]
+    if not relationship_first.empty:
+        relationship_first = relationship_first.loc[
+            (relationship_first["baseline_time"] >= start_ts_12m).to_numpy(), group_cols[:-1] + RELATIONSHIP_PARTIAL_COLUMNS
+        ]
+    blocks = []
+    for end_date in end_dates:
+        frames = (recent, new_first, relationship_first, monthly)
+        if has_store:
+            later = store_last.index[(store_last > end_date).to_numpy()]
+            if len(later):
+                frames = [df[~df["分店"].isin(later).to_numpy()] for df in frames]
+        block_recent, block_new_first, block_relationship, block_monthly = frames
+        blocks.append(end_date_partials(
+            block_recent, block_new_first, block_relationship, end_date, group_cols, indexes, block_monthly
+        ))
+    return pd.concat(blocks, ignore_index=True)
+
+def derive_customer_frames(merged_sorted, indexes=None):
+    # 依 phone_key 完整的結帳列推導新客與師傅關係；各列結果只看同一顧客的資料，可只對部分顧客重算
+    # New customer definition (全品牌首次結帳)
+    with stage("first_checkout", len(merged_sorted)):
+        new_first = merged_sorted.groupby("phone_key", as_index=False, observed=True).first()
+    new_first, relationship_first = same_store_frames(merged_sorted, new_first, indexes)
+    # 會員姓名由 attach_members 在名單上補，欄名固定
+    return new_first, relationship_first, "會員姓名"
+
+def store_visit_indexes(merged_sorted):
+    # (phone_key, 分店) 與 (phone_key, 分店, 設計師) 的 visit_index；同店指標與部分彙總共用
+    with stage("visit_index", len(merged_sorted)):
+        return visit_index(merged_sorted, ["phone_key", "分店"]), visit_index(merged_sorted, KEY_COLUMNS)
+
+def same_store_frames(merged_sorted, new_first, indexes=None):
+    # 以下皆為同分店口徑的逐列結果，與分店篩選無關；滿期旗標依篩選後的資料截止日在檢視階段計算
+    key_cols = ["phone_key", "分店", "設計師"]
+    store_index, relationship_index = store_visit_indexes(merged_sorted) if indexes is None else indexes
+    with stage("add_store_return_flags", len(new_first)):
+        new_first = add_store_return_flags(new_first, store_index, "結帳操作時間", CHURN_DAYS)
+    with stage("add_repeat_flags", len(new_first)):
+        new_first = add_repeat_flags(new_first, relationship_index, "結帳操作時間", T2_DAYS, T3_DAYS)
+
+    # 建立師傅關係起點（同分店同師傅第一次）；只取鍵欄與時間，其餘欄位用不到，不隨每段關係複製一份
+    with stage("add_regular_metrics") as s:
+        relationship_first = (
+            merged_sorted[key_cols + ["結帳操作時間"]]
+            .groupby(key_cols, as_index=False, observed=True)
+            .first()
+            .rename(columns={"結帳操作時間": "baseline_time"})
+        )
+        if not relationship_first.empty:
+            relationship_first = add_regular_metrics(relationship_first, relationship_index, "baseline_time")
+        s["rows"] = len(relationship_first)
+    return new_first, relationship_first
+
+def store_partition_frames(merged_store, new_first_store, group_cols):
+    # 單一分店的同店管線：回店/回指旗標、師傅關係與每月活動 cube；可在子行程執行
+    new_first_store, relationship_first = same_store_frames(merged_store, new_first_store)
+    return new_first_store, relationship_first, activity_cube(merged_store, group_cols)
+
+def partitioned_store_frames(merged_sorted, new_first, group_cols, executor):
+    # 依分店切開，各店在 executor（需有 map，例如 ProcessPoolExecutor）上跑 store_partition_frames 後合併；
+    # 各段保留原列順序，合併後的列順序與整份一起算相同。沒有分店的新客另成一段
+    merged_parts = merged_sorted.groupby("分店", observed=True, sort=True).indices
+    first_parts = new_first.groupby("分店", observed=True, sort=True).indices
+    stores = [store for store in merged_parts if store in first_parts]
+    if not stores:
+        # 沒有結帳列或分店全空白：不分段，整份照單一行程的做法算，欄位與空表形狀才會一致
+        return store_partition_frames(merged_sorted, new_first, group_cols)
+    tasks = [(merged_sorted.take(merged_parts[store]), new_first.take(first_parts[store])) for store in stores]
+    no_store = new_first["分店"].isna().to_numpy()
+    if no_store.any():
+        tasks.append((merged_sorted[merged_sorted["分店"].isna().to_numpy()], new_first[no_store]))
+    # 先在主行程補齊服務項目對照表，子行程只讀不寫
+    if "項目" in merged_sorted.columns:
+        item_minutes(merged_sorted["項目"].drop_duplicates())
+    results = list(executor.map(store_partition_frames, *zip(*tasks), [group_cols] * len(tasks)))
+    new_first = pd.concat([r[0] for r in results]).sort_index()
+    # 沒有分店那一段不會有師傅關係（空表沒有指標欄），合併時略過
+    relationship_parts = [r[1] for r in results if not r[1].empty] or [results[0][1]]
+    relationship_first = (
+        pd.concat(relationship_parts, ignore_index=True)
+        .sort_values(["phone_key", "分店", "設計師"], kind="stable")
+        .reset_index(drop=True)
+    )
+    # 只有首購在其他店、本店沒有首購的分店，空窗率仍要算
+    rest = [store for store in merged_parts if store not in first_parts]
+    activity = pd.concat(
+        [r[2] for r in results[:len(stores)]] + [activity_cube(merged_sorted.take(merged_parts[store]), group_cols) for store in rest],
+        ignore_index=True,
+    )
+    activity = activity.sort_values(group_cols[:-1], kind="stable").reset_index(drop=True)
+    return new_first, relationship_first, activity
+
+def derive_base_model(merged, members, include_types, load_timings, executor=None):
+    # executor：給定時同店指標依分店分段平行計算（全品牌首購仍先在主行程算一次）
+    # First checkout per phone（穩定排序：同時間的列維持上傳順序，取第一筆不受分店篩選影響）
+    with stage("sort_checkouts", len(merged)):
+        merged_sorted = merged.sort_values("結帳操作時間", kind="stable").reset_index(drop=True)
+    has_store = "分店" in merged_sorted.columns
+    group_cols = ["分店", "設計師", "month"] if has_store else ["設計師", "month"]
+    # 全部結帳列的每月格在索引與逐客表建好前先算，尖峰記憶體較低
+    with stage("monthly_partials", len(merged_sorted)):
+        monthly = monthly_partials(merged_sorted, group_cols)
+    if executor is not None and has_store:
+        with stage("first_checkout", len(merged_sorted)):
+            new_first = merged_sorted.groupby("phone_key", as_index=False, observed=True).first()
+        with stage("store_partitions", len(merged_sorted)):
+            new_first, relationship_first, activity_monthly = partitioned_store_frames(merged_sorted, new_first, group_cols, executor)
+        name_col = "會員姓名"
+        indexes = None
+    else:
+        # 每月活動 cube 與空窗率（月，168h cap）；同樣只需結帳列，先算
+        with stage("activity_cube", len(merged_sorted)) as s:
+            activity_monthly = activity_cube(merged_sorted, group_cols)
+            s["rows"] = len(activity_monthly)
+        indexes = store_visit_indexes(merged_sorted)
+        new_first, relationship_first, name_col = derive_customer_frames(merged_sorted, indexes)
+    activity_monthly = add_new_customers(activity_monthly, new_first, group_cols)
+    vacancy_monthly = vacancy_from_activity(activity_monthly, group_cols)
+    with stage("store_partials", len(merged_sorted)) as s:
+        partials = store_partials(merged_sorted, new_first, relationship_first, indexes=indexes, monthly=monthly)
+        s["rows"] = None if partials is None else len(partials)
+
+    base = {
+        "merged": merged_sorted,
+        "new_first": new_first,
+        "relationship_first": relationship_first,
+        "activity_monthly": activity_monthly,
+        "vacancy_monthly": vacancy_monthly,
+        "store_partials": partials,
+        "members": members,
+        "include_types": list(include_types),
+        "name_col": name_col,
+        "has_store": has_store,
+        # 算服務時數時的覆寫版本：增量附加時版本不同就重建已存月份的時數
+        "item_version": item_overrides_version(),
+        "load_timings": load_timings,
+    }
+    base["fingerprint"] = base_fingerprint(base)
+    return base
+
+def base_fingerprint(base):
+    # 基礎模型的內容指紋：結帳列（鍵欄、時間、指定、項目）雜湊加上覆寫版本；app 以它當由基礎模型導出結果的快取 key
+    # 逐欄累加 codes 與不重複值（類別欄直接用 codes），不為整份結帳列另建雜湊表
+    merged = base["merged"]
+    digest = hashlib.sha1()
+    for c in [c for c in KEY_COLUMNS + ["結帳操作時間", "is_requested", "項目"] if c in merged.columns]:
+        col = merged[c]
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            digest.update(col.cat.codes.to_numpy().tobytes())
+            digest.update(pd.util.hash_array(col.cat.categories.to_numpy(dtype=object)).tobytes())
+        elif col.dtype.kind == "M":
+            digest.update(col.to_numpy().view("i8").tobytes())
+        else:
+            codes, uniques = pd.factorize(col, use_na_sentinel=True)
+            digest.update(codes.tobytes())
+            digest.update(pd.util.hash_array(np.asarray(uniques, dtype=object).astype(str)).tobytes())
+    return f"{digest.hexdigest()[:16]}-{base.get('item_version')}"
+
+def default_compute_workers():
+    return max(1, min(available_cpus(), int(os.environ.get("COMPUTE_MAX_WORKERS", "8"))))
+
+def build_base_model(bill_files, member_file, include_types, load_workers=1, compute_workers=1):
+    # 基礎模型：只依上傳資料與結帳類型，篩選/目標/圖表設定改變時直接重用；
+    # compute_workers > 1 時同店指標以行程池依分店平行計算
+    with stage("load_bills") as s:
+        bills, used_sheets, load_timings = load_bills(bill_files, include_types, max_workers=load_workers, normalize=normalize_bills)
+        s["rows"] = len(bills)
+    if bills.empty:
+        raise DataInputError("帳單檔中找不到選擇的工作表。")
+    members = None
+    if member_file:
+        with stage("read_members") as s:
+            members = prepare_members(read_members(member_file))
+            s["rows"] = len(members)
+    with stage("prepare_checkouts", len(bills)) as s:
+        merged = prepare_checkouts(bills)
+        s["rows"] = len(merged)
+    if compute_workers > 1:
+        with ProcessPoolExecutor(max_workers=compute_workers) as pool:
+            return derive_base_model(merged, members, include_types, load_timings, executor=pool)
+    return derive_base_model(merged, members, include_types, load_timings)
+
+def unify_categories(frames, cols=CATEGORY_COLUMNS):
+    # 讓多個 frame 的類別欄共用同一組（排序後的）categories，concat 後仍為 category 且與完整重算一致；
+    # 舊版狀態裡還是文字的欄一併轉換
+    for c in cols:
+        present = [f for f in frames if f is not None and c in f.columns]
+        if not present:
+            continue
+        cats = pd.Index([])
+        for f in present:
+            values = f[c].cat.categories if isinstance(f[c].dtype, pd.CategoricalDtype) else f[c].dropna().unique()
+            cats = cats.union(pd.Index(values))
+        dtype = pd.CategoricalDtype(cats.sort_values())
+        for f in present:
+            f[c] = f[c].astype(dtype)
+    return frames
+
+def refresh_service_hours(state):
+    # 服務時長覆寫改過：以已存的結帳列依目前對照表重建 cube 的服務時數，空窗率跟著重算
+    group_cols = ["分店", "設計師", "month"] if state["has_store"] else ["設計師", "month"]
+    activity_monthly = add_new_customers(activity_cube(state["merged"], group_cols), state["new_first"], group_cols)
+    state = dict(
+        state,
+        activity_monthly=activity_monthly,
+        vacancy_monthly=vacancy_from_activity(activity_monthly, group_cols),
+        item_version=item_overrides_version(),
+    )
+    state["fingerprint"] = base_fingerprint(state)
+    return state
+
+def append_base_model(state, bills, load_timings):
+    # 只附加各分店既有資料截止時間之後的結帳列（重複上傳同一月份不會重算兩次），
+    # 並只重算新資料涉及的顧客與 (分店, 設計師, 月) 空窗率
+    if state.get("item_version") != item_overrides_version():
+        state = refresh_service_hours(state)
+    new_rows = prepare_checkouts(bills)
+    old = state["merged"]
+    if state["has_store"] and "分店" in new_rows.columns:
+        cutoff = old.groupby("分店", observed=True)["結帳操作時間"].max()
+        limit = new_rows["分店"].astype(object).map(cutoff)
+        keep = limit.isna() | (new_rows["結帳操作時間"] > limit)
+    else:
+        keep = pd.Series(True, index=new_rows.index) if old.empty else new_rows["結帳操作時間"] > old["結帳操作時間"].max()
+    new_rows = new_rows[keep.to_numpy()]
+    if new_rows.empty:
+        return dict(state, load_timings=load_timings), 0
+
+    # 淺複製即可：unify_categories 換掉的鍵欄只在新物件上，不會動到已存的狀態
+    old_new_first = state["new_first"].copy(deep=False)
+    old_relationship = state["relationship_first"].copy(deep=False)
+    group_cols = ["分店", "設計師", "month"] if state["has_store"] else ["設計師", "month"]
+    if state.get("activity_monthly") is None:
+        # 舊版狀態沒有 cube：由既有結帳列補建一次
+        old_activity = activity_cube(old, group_cols)
+    else:
+        old_activity = state["activity_monthly"].copy(deep=False)
+    old = old.copy(deep=False)
+    new_rows = new_rows.sort_values("結帳操作時間", kind="stable")
+    unify_categories([old, new_rows, old_new_first, old_relationship, old_activity])
+    merged_sorted = (
+        pd.concat([old, new_rows], ignore_index=True)
+        .sort_values("結帳操作時間", kind="stable")
+        .reset_index(drop=True)
+    )
+
+    phones = new_rows["phone_key"].unique()
+    new_first_sub, relationship_sub, _ = derive_customer_frames(merged_sorted[merged_sorted["phone_key"].isin(phones)])
+    key_cols = ["phone_key", "分店", "設計師"]
+    new_first = (
+        pd.concat([old_new_first[~old_new_first["phone_key"].isin(phones)], new_first_sub], ignore_index=True)
+        .sort_values("phone_key", kind="stable")
+        .reset_index(drop=True)
+    )
+    relationship_first = (
+        pd.concat([old_relationship[~old_relationship["phone_key"].isin(phones)], relationship_sub], ignore_index=True)
+        .sort_values(key_cols, kind="stable")
+        .reset_index(drop=True)
+    )
+
+    # cube 各格可相加：新資料的 cube 與既有 cube 合併，新客數依更新後的 new_first 重算
+    activity_monthly = rollup_activity(
+        pd.concat([old_activity, activity_cube(new_rows, group_cols)], ignore_index=True), group_cols
+    )
+    activity_monthly = add_new_customers(activity_monthly, new_first, group_cols)
+    # 各分店的截止時間會變，部分彙總整份重算
+    with stage("store_partials", len(merged_sorted)):
+        partials = store_partials(merged_sorted, new_first, relationship_first)
+
+    base = dict(
+        state,
+        merged=merged_sorted,
+        new_first=new_first,
+        relationship_first=relationship_first,
+        activity_monthly=activity_monthly,
+        vacancy_monthly=vacancy_from_activity(activity_monthly, group_cols),
+        store_partials=partials,
+        load_timings=load_timings,
+    )
+    base["fingerprint"] = base_fingerprint(base)
+    return base, len(new_rows)
+
+def save_base_state(base):
+    tmp = STATE_PATH.with_name(STATE_PATH.name + ".tmp")
+    STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    pd.to_pickle({k: v for k, v in base.items() if k != "load_timings"}, tmp)
+    os.replace(tmp, STATE_PATH)
+
+def load_base_state():
+    if not STATE_PATH.exists():
+        return None
+    return pd.read_pickle(STATE_PATH)
+
+
+def append_bills(bill_files, include_types, load_workers=1):
+    state = load_base_state()
+    if state is None:
+        raise DataInputError("尚未儲存增量狀態，請先以「完整重算」上傳全部帳單並儲存。")
+    if sorted(state["include_types"]) != sorted(include_types):
+        raise DataInputError("增量狀態的結帳類型與目前設定不同，請以「完整重算」重建狀態。")
+    # 同一批帳單剛附加過（狀態檔因此改寫，app 以狀態檔時間為快取 key 會再呼叫一次）：不再讀檔，回報當時附加的筆數
+    digests = sorted(file_digest(f) for f in bill_files)
+    last_append = state.get("last_append")
+    items_changed = state.get("item_version") != item_overrides_version()
+    if last_append is not None and last_append["files"] == digests:
+        if items_changed:
+            state = refresh_service_hours(state)
+            save_base_state(state)
+        return dict(state, load_timings=[]), last_append["rows"]
+    with stage("load_bills") as s:
+        bills, used_sheets, load_timings = load_bills(bill_files, include_types, max_workers=load_workers, normalize=normalize_bills)
+        s["rows"] = len(bills)
+    if bills.empty:
+        raise DataInputError("帳單檔中找不到選擇的工作表。")
+    with stage("append_base_model", len(bills)) as s:
+        base, appended = append_base_model(state, bills, load_timings)
+        s["rows"] = appended
+    if appended:
+        base["last_append"] = {"files": digests, "rows": appended}
+    if appended or items_changed:
+        save_base_state(base)
+    return base, appended
+
+def filter_stores(df, store_filter):
+    if store_filter is None or df is None or "分店" not in df.columns:
+        return df
+    # 全部分店都選時直接回傳原表，不複製；呼叫端要加欄請先 copy(deep=False)
+    keep = df["分店"].isin(store_filter)
+    if keep.all():
+        return df
+    return df[keep]
+
+def store_options(base):
+    if not base["has_store"]:
+        return None
+    return sorted([s for s in base["merged"]["分店"].dropna().unique()])
+
+def designer_options(base, store_filter=None):
+    # 每月活動 cube 含每個有結帳的 (分店, 設計師)，不必篩全部結帳列
+    return sorted([s for s in filter_stores(base["activity_monthly"], store_filter)["設計師"].dropna().unique()])
+
+def designer_totals(partials):
+    # 所選分店的部分彙總依師傅相加；師傅缺值的列不計
+    return partials.groupby("設計師", observed=True)[PARTIAL_COUNTS].sum()
+
+def new_customer_metrics(totals, min_repeat_base):
+    # 新客經營力（近 3 個月）：比率由相加後的計數重算；各組只列出有樣本的師傅
+    new_churn_by_designer = totals.loc[totals["new_customers_3m"] > 0, ["new_customers_3m", "new_churned_3m"]].reset_index()
+    new_churn_by_designer["new_retained_3m"] = (
+        new_churn_by_designer["new_customers_3m"] - new_churn_by_designer["new_churned_3m"]
+    )
+    new_churn_by_designer["new_churn_rate_3m"] = np.where(
+        new_churn_by_designer["new_customers_3m"] > 0,
+        new_churn_by_designer["new_churned_3m"] / new_churn_by_designer["new_customers_3m"],
+        np.nan,
+    )
+
+    new_by_designer = totals.loc[totals["new_repeat_base_3m"] > 0, ["new_repeat_base_3m", "new_repeat2_count"]].reset_index()
+    new_by_designer["new_repeat_rate_3m"] = np.where(
+        new_by_designer["new_repeat_base_3m"] > 0,
+        new_by_designer["new_repeat2_count"] / new_by_designer["new_repeat_base_3m"],
+        np.nan,
+    )
+    new_by_designer.loc[
+        new_by_designer["new_repeat_base_3m"] < min_repeat_base, "new_repeat_rate_3m"
+    ] = np.nan
+
+    deep = totals[totals["new_deep_n"] > 0]
+    new_deep = pd.DataFrame({
+        "new_deep_rate_3m": deep["new_deep_count"] / deep["new_deep_n"],
+        "new_deep_n": deep["new_deep_n"],
+    }).reset_index()
+    new_deep.loc[new_deep["new_deep_n"] < min_repeat_base, "new_deep_rate_3m"] = np.nan
+    return new_churn_by_designer, new_by_designer, new_deep
+
+def familiar_first_visits(checkouts, start_ts_3m, end_date, store_index, index):
+    # 熟客經營力（近 3 個月，同分店熟客）：近 3 月前已在同分店來過 ≥2 次者，近 3 月內各師傅的第一次。
+    # 近 3 月前的次數在 (phone_key, 分店) 的 visit_index 上二分搜尋，checkouts 只需含近 3 個月的結帳列；
+    # index 為 (phone_key, 分店, 設計師) 的 visit_index
+    times = checkouts["結帳操作時間"]
+    recent = checkouts[((times >= start_ts_3m) & (times <= end_date)).to_numpy()]
+    slots = visit_slots(store_index, recent)
+    known = slots >= 0
+    start_int = visit_ints(store_index, [start_ts_3m])[0][0]
+    visits_before = np.zeros(len(recent), dtype=np.int64)
+    visits_before[known] = (
+        visit_search(store_index, slots[known], np.full(known.sum(), start_int), "left")
+        - store_index["offsets"][slots[known]]
+    )
+    familiar_first = (
+        recent.loc[visits_before >= 2, ["phone_key", "分店", "設計師", "結帳操作時間"]]
+        .groupby(["phone_key", "分店", "設計師"], as_index=False, observed=True)["結帳操作時間"]
+        .min()
+        .rename(columns={"結帳操作時間": "baseline_time"})
+    )
+
+    if not familiar_first.empty:
+        familiar_first["matured_2"] = familiar_first["baseline_time"] + pd.Timedelta(days=T2_DAYS) <= end_date
+        familiar_first["matured_3"] = familiar_first["baseline_time"] + pd.Timedelta(days=T3_DAYS) <= end_date
+        familiar_first = add_repeat_flags(
+            familiar_first,
+            index,
+            "baseline_time",
+            T2_DAYS,
+            T3_DAYS,
+        )
+    return familiar_first
+
+def familiar_metrics(totals, min_repeat_base):
+    fam_by_designer = totals.loc[
+        totals["familiar_customers_3m"] > 0, ["familiar_customers_3m", "familiar_repeat2_count"]
+    ].reset_index()
+    fam_by_designer["familiar_repeat_rate_3m"] = np.where(
+        fam_by_designer["familiar_customers_3m"] > 0,
+        fam_by_designer["familiar_repeat2_count"] / fam_by_designer["familiar_customers_3m"],
+        np.nan,
+    )
+    fam_by_designer.loc[
+        fam_by_designer["familiar_customers_3m"] < min_repeat_base, "familiar_repeat_rate_3m"
+    ] = np.nan
+
+    deep = totals[totals["familiar_deep_n"] > 0]
+    fam_deep = pd.DataFrame({
+        "familiar_deep_rate_3m": deep["familiar_deep_count"] / deep["familiar_deep_n"],
+        "familiar_deep_n": deep["familiar_deep_n"],
+    }).reset_index()
+    fam_deep.loc[fam_deep["familiar_deep_n"] < min_repeat_base, "familiar_deep_rate_3m"] = np.nan
+    return fam_by_designer, fam_deep
+
+def attendance_metrics(designer_months, end_ts):
+    # 出勤狀態（以月份計），由 設計師 × 月 彙總表計算
+    months = designer_months.assign(month_period=month_starts(designer_months["month"]).to_period("M"))
+    months = months[months["month_period"].notna()]
+    end_month = end_ts.to_period("M")
+    start_month_3m = end_month - 2
+    recent = months[months["month_period"] >= start_month_3m].groupby("設計師", observed=True)
+    active_months_3m = recent["month_period"].nunique().reset_index(name="active_months_3m")
+    active_days_3m = recent["active_days"].sum().reset_index(name="active_days_3m")
+    avg_active_days_3m = recent["active_days"].sum().div(3).reset_index(name="avg_active_days_3m")
+    prev_month = end_month - 1
+    orders_prev = months[months["month_period"] == prev_month]
+    has_order_prev = (
+        orders_prev.groupby("設計師", observed=True)["orders"]
+        .sum()
+        .reset_index(name="orders_prev_month")
+    )
+    has_order_prev["has_order_prev_month"] = has_order_prev["orders_prev_month"] > 0
+    last_month = (
+        months.groupby("設計師", observed=True)["month_period"]
+        .max()
+        .reset_index(name="last_order_month")
+    )
+    last_month["months_since_last"] = last_month["last_order_month"].apply(lambda p: end_month.ordinal - p.ordinal)
+
+    return (
+        active_months_3m
+        .merge(active_days_3m, on="設計師", how="left")
+        .merge(avg_active_days_3m, on="設計師", how="left")
+        .merge(has_order_prev[["設計師", "has_order_prev_month"]], on="設計師", how="left")
+        .merge(last_month[["設計師", "months_since_last"]], on="設計師", how="left")
+    )
+
+def add_relationship_metrics(designer_metrics, totals):
+    # 熟客化/熟客維持（近 12 個月關係起點）；平均天數/次數由總和與筆數重算
+    regular = totals[totals["regular_base_180"] > 0]
+    if not regular.empty:
+        regular_summary = pd.DataFrame({
+            "regular_base_180": regular["regular_base_180"],
+            "regular_achieved_180": regular["regular_achieved_180"],
+            "regular_days_avg_180": regular["regular_days_sum"] / regular["regular_days_n"].where(regular["regular_days_n"] > 0),
+        }).reset_index()
+        regular_summary["regular_rate_180"] = np.where(
+            regular_summary["regular_base_180"] > 0,
+            regular_summary["regular_achieved_180"] / regular_summary["regular_base_180"],
+            np.nan,
+        )
+        designer_metrics = designer_metrics.merge(regular_summary, on="設計師", how="left")
+
+    retention = totals[totals["retention_base_180"] > 0]
+    if not retention.empty:
+        retention_summary = pd.DataFrame({
+            "retention_base_180": retention["retention_base_180"],
+            "retention_achieved_180": retention["retention_achieved_180"],
+            "post_regular_visits_avg_180": (
+                retention["post_regular_visits_sum"]
+                / retention["post_regular_visits_n"].where(retention["post_regular_visits_n"] > 0)
+            ),
+        }).reset_index()
+        retention_summary["post_regular_visits_monthly_avg_180"] = (
+            retention_summary["post_regular_visits_avg_180"] / 6
+        )
+        retention_summary["retention_rate_180"] = np.where(
+            retention_summary["retention_base_180"] > 0,
+            retention_summary["retention_achieved_180"] / retention_summary["retention_base_180"],
+            np.nan,
+        )
+        designer_metrics = designer_metrics.merge(retention_summary, on="設計師", how="left")
+
+    for col in [
+        "regular_rate_180",
+        "regular_base_180",
+        "regular_achieved_180",
+        "regular_days_avg_180",
+        "retention_rate_180",
+        "retention_base_180",
+        "retention_achieved_180",
+        "post_regular_visits_avg_180",
+        "post_regular_visits_monthly_avg_180",
+    ]:
+        if col not in designer_metrics.columns:
+            designer_metrics[col] = np.nan
+    return designer_metrics
+
+def request_metrics(totals):
+    # 指定率（近 3 個月）；缺「指定」欄位或無有效值時回傳 None
+    if not totals["request_known"].sum():
+        return None
+    request_summary = totals.loc[
+        totals["total_orders_3m"] > 0, ["request_yes_3m", "request_total_3m"]
+    ].reset_index()
+    request_summary["request_rate_3m"] = np.where(
+        request_summary["request_total_3m"] > 0,
+        request_summary["request_yes_3m"] / request_summary["request_total_3m"],
+        np.nan,
+    )
+    return request_summary
+
+def store_summaries(partials, designer_filter):
+    # Store monthly summary (average per month)；月份為首購所在月
+    month_summary = partials.groupby(["分店", "month"], observed=True)[["matured_new_customers", "churned"]].sum()
+    month_summary = month_summary[month_summary["matured_new_customers"] > 0].reset_index()
+    month_summary["retained"] = month_summary["matured_new_customers"] - month_summary["churned"]
+    month_summary["repeat_rate"] = np.where(
+        month_summary["matured_new_customers"] > 0,
+        month_summary["retained"] / month_summary["matured_new_customers"],
+        np.nan,
+    )
+    store_monthly_avg = (
+        month_summary.groupby("分店", observed=True)
+        .agg(
+            月平均新客數=("matured_new_customers", "mean"),
+            月平均流失數=("churned", "mean"),
+            月平均留住數=("retained", "mean"),
+            平均回店率=("repeat_rate", "mean"),
+            月份數=("month", "nunique"),
+        )
+        .reset_index()
+    )
+
+    summary_by_store = partials.groupby("分店", observed=True)[["matured_new_customers", "churned"]].sum()
+    summary_by_store = summary_by_store[summary_by_store["matured_new_customers"] > 0].reset_index()
+    summary_by_store["churn_rate"] = summary_by_store["churned"] / summary_by_store["matured_new_customers"]
+    summary_by_store["repeat_rate"] = 1 - summary_by_store["churn_rate"]
+
+    summary_by_store_designer = store_designer_summary(partials, designer_filter)
+    return store_monthly_avg, summary_by_store, summary_by_store_designer
+
+def store_designer_summary(partials, designer_filter):
+    summary_by_store_designer = (
+        partials[partials["設計師"].isin(designer_filter)]
+        .groupby(["分店", "設計師"], observed=True)[["matured_new_customers", "churned"]]
+        .sum()
+    )
+    summary_by_store_designer = summary_by_store_designer[summary_by_store_designer["matured_new_customers"] > 0].reset_index()
+    summary_by_store_designer["churn_rate"] = (
+        summary_by_store_designer["churned"] / summary_by_store_designer["matured_new_customers"]
+    )
+    summary_by_store_designer["repeat_rate"] = 1 - summary_by_store_designer["churn_rate"]
+    return summary_by_store_designer
+
+def interval_counts(group_ids, lo, hi, n_groups, n_slots, weights=None):
+    # 每列計入第 lo ~ hi-1 格（門檻或截止日）：各組的差分直方圖沿格累加，回傳 (n_groups, n_slots)；
+    # group_ids 為 -1 的列不計
+    keep = (lo < hi) & (group_ids >= 0)
+    width = n_slots + 1
+    w = None if weights is None else np.asarray(weights, dtype=float)[keep]
+    diff = (
+        np.bincount(group_ids[keep] * width + lo[keep], weights=w, minlength=n_groups * width)
+        - np.bincount(group_ids[keep] * width + hi[keep], weights=w, minlength=n_groups * width)
+    )
+    return np.cumsum(diff.reshape(n_groups, width), axis=1)[:, :n_slots]
+
+# 門檻試算：流失/回指門檻天數的範圍；計數可依 分店 × 師傅 相加
+SWEEP_WINDOWS = np.arange(14, 181)
+SWEEP_COUNTS = ["matured_new_customers", "returned", "repeat2_count", "repeat3_count"]
+
+def window_sweep(new_first_store, end_date, windows=None):
+    # 每 (分店, 設計師) × 門檻天數：滿期新客數，與同分店回店、同師傅第 2 / 3 次落在門檻內的人數。
+    # 每位新客計入的門檻是一段連續區間（回訪天數 ≤ 門檻 ≤ 首購到截止日的天數），以 searchsorted 找區間兩端，
+    # 各組的差分直方圖累加一次就得到全部門檻，不必逐門檻重算
+    windows = SWEEP_WINDOWS if windows is None else np.asarray(windows)
+    n_windows = len(windows)
+    key_cols = [c for c in ["分店", "設計師"] if c in new_first_store.columns]
+    grouped = new_first_store.groupby(key_cols, observed=True, dropna=False)
+    group_ids = grouped.ngroup().to_numpy()
+    keys = grouped.size().index.to_frame(index=False)
+    n_groups = len(keys)
+
+    age = ((pd.Timestamp(end_date) - new_first_store["結帳操作時間"]) // pd.Timedelta(days=1)).to_numpy(dtype=float)
+    hi = np.searchsorted(windows, np.where(np.isnan(age), -np.inf, age), "right")
+
+    def window_counts(days):
+        lo = np.searchsorted(windows, np.where(np.isnan(days), np.inf, days), "left")
+        return interval_counts(group_ids, lo, hi, n_groups, n_windows).ravel()
+
+    sweep = keys.loc[keys.index.repeat(n_windows)].reset_index(drop=True)
+    sweep["window_days"] = np.tile(windows, n_groups)
+    sweep["matured_new_customers"] = window_counts(np.zeros(len(new_first_store)))
+    sweep["returned"] = window_counts(new_first_store["return_days_store"].to_numpy(dtype=float))
+    sweep["repeat2_count"] = window_counts(new_first_store["days_to_2nd"].to_numpy(dtype=float))
+    sweep["repeat3_count"] = window_counts(new_first_store["days_to_3rd"].to_numpy(dtype=float))
+    return sweep
+
+def sweep_rates(sweep, keys):
+    # 依 keys（[] 為全部）相加後重算各門檻的比率；沒有滿期新客的門檻不列
+    rates = sweep.groupby(keys + ["window_days"], observed=True)[SWEEP_COUNTS].sum().reset_index()
+    rates = rates[rates["matured_new_customers"] > 0].reset_index(drop=True)
+    rates["churn_rate"] = 1 - rates["returned"] / rates["matured_new_customers"]
+    rates["repeat2_rate"] = rates["repeat2_count"] / rates["matured_new_customers"]
+    rates["repeat3_rate"] = rates["repeat3_count"] / rates["matured_new_customers"]
+    return rates
+
+def recent_vacancy(vacancy_monthly, start_ts_3m):
+    vm = vacancy_monthly[month_starts(vacancy_monthly["month"]) >= start_ts_3m]
+    return (
+        vm.groupby("設計師", observed=True)["vacancy_rate"]
+        .mean()
+        .reset_index()
+        .rename(columns={"vacancy_rate": "vacancy_rate_3m"})
+    )
+
+def stability_metrics(designer_months, activity_monthly, start_ts_6m, end_ts):
+    # 業績穩定度（近 6 個月）：有單天數看 設計師 × 月，服務時數看 cube 各格（分店 × 設計師 × 月）
+    active_days_6m = designer_months[month_starts(designer_months["month"]) >= start_ts_6m]
+
+    stability_by_designer = (
+        active_days_6m.groupby("設計師", observed=True)
+        .agg(
+            active_days_avg_6m=("active_days", "mean"),
+            active_days_std_6m=("active_days", "std"),
+            active_months_6m=("month", "nunique"),
+        )
+        .reset_index()
+    )
+    # CV = 標準差 / 平均；平均為 0 時不計
+    stability_by_designer.insert(
+        2,
+        "active_days_cv_6m",
+        stability_by_designer.pop("active_days_std_6m") / stability_by_designer["active_days_avg_6m"].where(lambda m: m != 0),
+    )
+
+    if "service_hours" in activity_monthly.columns:
+        hours_6m = activity_monthly[month_starts(activity_monthly["month"]) >= start_ts_6m]
+        hours_summary = (
+            hours_6m.groupby("設計師", observed=True)["service_hours"]
+            .agg(service_hours_avg_6m="mean", service_hours_std_6m="std")
+            .reset_index()
+        )
+        hours_summary["service_hours_cv_6m"] = (
+            hours_summary.pop("service_hours_std_6m") / hours_summary["service_hours_avg_6m"].where(lambda m: m != 0)
+        )
+        stability_by_designer = stability_by_designer.merge(hours_summary, on="設計師", how="left")
+
+    last_tx = designer_months.groupby("設計師", observed=True)["last_tx"].max().reset_index()
+    last_tx["days_since_last_tx"] = (end_ts - last_tx["last_tx"]).dt.days
+    return stability_by_designer.merge(last_tx, on="設計師", how="left")
+
+def add_block_scores(designer_metrics):
+    # 四大區塊戰力指標（Z-score + 樣本數修正）
+    basic_z = pd.DataFrame({
+        "z_active_days": zscore_series(designer_metrics.get("avg_active_days_3m")),
+        "z_active_days_3m": zscore_series(designer_metrics.get("active_days_3m")),
+        "z_total_orders": zscore_series(designer_metrics.get("total_orders_3m")),
+        "z_vacancy": -zscore_series(designer_metrics.get("vacancy_rate_3m")),
+    })
+    designer_metrics["basic_z"] = basic_z.mean(axis=1, skipna=True)
+    designer_metrics["basic_rel"] = reliability_factor(designer_metrics.get("total_orders_3m"))
+    designer_metrics["basic_score"] = designer_metrics["basic_z"] * designer_metrics["basic_rel"]
+    designer_metrics["basic_score_0100"] = np.clip(50 + 10 * designer_metrics["basic_score"], 0, 100)
+
+    new_acq_z = pd.DataFrame({
+        "z_new_share": zscore_series(designer_metrics.get("new_share_3m")),
+        "z_new_per_day": zscore_series(designer_metrics.get("new_per_active_day_3m")),
+    })
+    designer_metrics["new_acq_z"] = new_acq_z.mean(axis=1, skipna=True)
+    designer_metrics["new_acq_rel"] = reliability_factor(designer_metrics.get("new_customers_3m"))
+    designer_metrics["new_acq_score"] = designer_metrics["new_acq_z"] * designer_metrics["new_acq_rel"]
+    designer_metrics["new_acq_score_0100"] = np.clip(50 + 10 * designer_metrics["new_acq_score"], 0, 100)
+
+    new_ret_z = pd.DataFrame({
+        "z_new_retention": zscore_series(designer_metrics.get("new_retention_rate_3m")),
+    })
+    designer_metrics["new_ret_z"] = new_ret_z.mean(axis=1, skipna=True)
+    designer_metrics["new_ret_rel"] = reliability_factor(designer_metrics.get("new_customers_3m"))
+    designer_metrics["new_ret_score"] = designer_metrics["new_ret_z"] * designer_metrics["new_ret_rel"]
+    designer_metrics["new_ret_score_0100"] = np.clip(50 + 10 * designer_metrics["new_ret_score"], 0, 100)
+
+    convert_z = pd.DataFrame({
+        "z_regular_rate": zscore_series(designer_metrics.get("regular_rate_180")),
+        "z_regular_days": -zscore_series(designer_metrics.get("regular_days_avg_180")),
+    })
+    designer_metrics["convert_z"] = convert_z.mean(axis=1, skipna=True)
+    designer_metrics["convert_rel"] = reliability_factor(designer_metrics.get("regular_base_180"))
+    designer_metrics["convert_score"] = designer_metrics["convert_z"] * designer_metrics["convert_rel"]
+    designer_metrics["convert_score_0100"] = np.clip(50 + 10 * designer_metrics["convert_score"], 0, 100)
+
+    retain_z = pd.DataFrame({
+        "z_retention_rate": zscore_series(designer_metrics.get("retention_rate_180")),
+        "z_post_visits": zscore_series(designer_metrics.get("post_regular_visits_avg_180")),
+    })
+    designer_metrics["retain_z"] = retain_z.mean(axis=1, skipna=True)
+    designer_metrics["retain_rel"] = reliability_factor(designer_metrics.get("retention_base_180"))
+    designer_metrics["retain_score"] = designer_metrics["retain_z"] * designer_metrics["retain_rel"]
+    designer_metrics["retain_score_0100"] = np.clip(50 + 10 * designer_metrics["retain_score"], 0, 100)
+
+    stability_cv = designer_metrics["service_hours_cv_6m"] if "service_hours_cv_6m" in designer_metrics.columns else pd.Series(np.nan, index=designer_metrics.index)
+    stability_cv = np.where(pd.notna(stability_cv), stability_cv, designer_metrics.get("active_days_cv_6m"))
+    designer_metrics["stability_cv"] = stability_cv
+    designer_metrics["stability_z"] = -zscore_series(designer_metrics.get("stability_cv"))
+    designer_metrics["stability_rel"] = reliability_factor(designer_metrics.get("active_months_6m"), n0=6)
+    designer_metrics["stability_score"] = designer_metrics["stability_z"] * designer_metrics["stability_rel"]
+    designer_metrics["stability_score_0100"] = np.clip(50 + 10 * designer_metrics["stability_score"], 0, 100)
+
+    block_scores = designer_metrics[
+        ["basic_score", "new_acq_score", "new_ret_score", "convert_score", "retain_score", "stability_score"]
+    ]
+    weights = np.array([1/6, 1/6, 1/6, 1/6, 1/6, 1/6])
+    valid_mask = block_scores.notna().values
+    weighted = block_scores.fillna(0).values * weights
+    weight_sum = (valid_mask * weights).sum(axis=1)
+    overall_z = np.where(weight_sum > 0, weighted.sum(axis=1) / weight_sum, np.nan)
+    designer_metrics["overall_score_z"] = overall_z
+    designer_metrics["overall_score"] = np.clip(50 + 10 * overall_z, 0, 100)
+    return designer_metrics
+
+def designer_metric_table(totals, designer_months, activity_monthly, vacancy_monthly, end_date, min_repeat_base):
+    # 師傅指標表：totals 為所選分店部分彙總依師傅相加的計數，出勤、穩定度與空窗率由每月活動 cube
+    # （designer_months 為其 設計師 × 月 彙總）計算；檢視與歷史各截止日共用
+    start_ts_3m, start_ts_6m, _ = view_windows(end_date)
+    end_ts = pd.to_datetime(end_date)
+    new_churn_by_designer, new_by_designer, new_deep = new_customer_metrics(totals, min_repeat_base)
+    fam_by_designer, fam_deep = familiar_metrics(totals, min_repeat_base)
+
+    # 合併師傅指標
+    designer_metrics = (
+        new_churn_by_designer
+        .merge(new_by_designer, on="設計師", how="outer")
+        .merge(new_deep, on="設計師", how="outer")
+        .merge(fam_by_designer, on="設計師", how="outer")
+        .merge(fam_deep, on="設計師", how="outer")
+    )
+
+    # 近 3 個月總單量
+    orders_summary = totals.loc[totals["total_orders_3m"] > 0, ["total_orders_3m"]].reset_index()
+    designer_metrics = designer_metrics.merge(orders_summary, on="設計師", how="left")
+    designer_metrics["new_share_3m"] = np.where(
+        pd.to_numeric(designer_metrics["total_orders_3m"], errors="coerce") > 0,
+        pd.to_numeric(designer_metrics["new_customers_3m"], errors="coerce")
+        / pd.to_numeric(designer_metrics["total_orders_3m"], errors="coerce"),
+        np.nan,
+    )
+
+    designer_metrics = designer_metrics.merge(attendance_metrics(designer_months, end_ts), on="設計師", how="left")
+    designer_metrics["new_per_active_day_3m"] = np.where(
+        pd.to_numeric(designer_metrics.get("active_days_3m"), errors="coerce") > 0,
+        pd.to_numeric(designer_metrics.get("new_customers_3m"), errors="coerce")
+        / pd.to_numeric(designer_metrics.get("active_days_3m"), errors="coerce"),
+        np.nan,
+    )
+    designer_metrics["new_retention_rate_3m"] = np.where(
+        pd.notna(designer_metrics.get("new_churn_rate_3m")),
+        1 - pd.to_numeric(designer_metrics.get("new_churn_rate_3m"), errors="coerce"),
+        np.nan,
+    )
+
+    designer_metrics = add_relationship_metrics(designer_metrics, totals)
+
+    # 經營中熟客：已達熟客(180天達5次)但後180天維持觀察期尚未滿
+    designer_metrics["in_service_regular_180"] = (
+        pd.to_numeric(designer_metrics["regular_achieved_180"], errors="coerce")
+        - pd.to_numeric(designer_metrics["retention_base_180"], errors="coerce")
+    ).clip(lower=0)
+
+    request_summary = request_metrics(totals)
+    if request_summary is not None:
+        designer_metrics = designer_metrics.merge(request_summary, on="設計師", how="left")
+    else:
+        designer_metrics["request_rate_3m"] = np.nan
+        designer_metrics["request_yes_3m"] = np.nan
+        designer_metrics["request_total_3m"] = np.nan
+
+    # Vacancy metrics (monthly, 168h cap)
+    vacancy_recent = None
+    if vacancy_monthly is not None:
+        vacancy_recent = recent_vacancy(vacancy_monthly, start_ts_3m)
+        designer_metrics = designer_metrics.merge(vacancy_recent, on="設計師", how="left")
+
+    with stage("stability_metrics", len(designer_months)):
+        stability = stability_metrics(designer_months, activity_monthly, start_ts_6m, end_ts)
+    designer_metrics = designer_metrics.merge(stability, on="設計師", how="left")
+    designer_metrics = add_block_scores(designer_metrics)
+    return designer_metrics, vacancy_recent, request_summary is not None
+
+def compute_view(base, store_filter=None, designer_filter=None, min_repeat_base=5):
+    with stage("compute_view", len(base["merged"])):
+        return _compute_view(base, store_filter, designer_filter, min_repeat_base)
+
+def view_end_date(base, store_filter):
+    # 所選分店最後結帳時間的最大值：由最晚截止日那份部分彙總（含全部分店）的 last_tx 取得，不掃全部結帳列
+    partials = base.get("store_partials")
+    if partials is None:
+        return filter_stores(base["merged"], store_filter)["結帳操作時間"].max()
+    latest = partials[partials["end_date"] == partials["end_date"].max()]
+    return filter_stores(latest, store_filter)["last_tx"].max()
+
+def view_partials(base, store_filter, end_date):
+    # 舊版狀態沒有部分彙總時，只對這個截止日現算一份
+    partials = base.get("store_partials")
+    if partials is None:
+        partials = store_partials(base["merged"], base["new_first"], base["relationship_first"], [end_date])
+    return filter_stores(partials[partials["end_date"] == end_date], store_filter)
+
+def _compute_view(base, store_filter, designer_filter, min_repeat_base):
+    # 檢視階段：師傅與分店指標由所選分店的部分彙總相加後重算比率；
+    # 逐列的新客與師傅關係表只依資料截止日加上滿期旗標，供名單與圖表使用
+    has_store = base["has_store"]
+    if not has_store:
+        store_filter = None
+    if designer_filter is None:
+        designer_filter = designer_options(base, store_filter)
+
+    end_date = view_end_date(base, store_filter)
+    if pd.isna(end_date):
+        raise DataInputError("篩選後沒有可用資料。")
+    partials = view_partials(base, store_filter, end_date)
+
+    # 新客（全品牌首購）→ 同分店回店
+    new_first_store = filter_stores(base["new_first"], store_filter).copy(deep=False)
+    new_first_store["matured"] = new_first_store["結帳操作時間"] + pd.Timedelta(days=CHURN_DAYS) <= end_date
+
+    relationship_first = filter_stores(base["relationship_first"], store_filter).copy(deep=False)
+    if not relationship_first.empty:
+        relationship_first["regular_matured_180"] = (
+            relationship_first["baseline_time"] + pd.Timedelta(days=REGULAR_DAYS) <= end_date
+        )
+        relationship_first["retention_matured_180"] = (
+            relationship_first["regular_date"] + pd.Timedelta(days=RETENTION_DAYS) <= end_date
+        )
+
+    new_first_store["matured_2"] = new_first_store["結帳操作時間"] + pd.Timedelta(days=T2_DAYS) <= end_date
+    new_first_store["matured_3"] = new_first_store["結帳操作時間"] + pd.Timedelta(days=T3_DAYS) <= end_date
+
+    start_ts_3m, start_ts_6m, start_ts_12m = view_windows(end_date)
+    new_recent_churn = new_first_store[
+        (new_first_store["結帳操作時間"] >= start_ts_3m) & new_first_store["matured"]
+    ]
+
+    activity_monthly = filter_stores(base["activity_monthly"], store_filter)
+    vacancy_monthly = None if base["vacancy_monthly"] is None else filter_stores(base["vacancy_monthly"], store_filter)
+    # 出勤與穩定度共用同一份 設計師 × 月 彙總（由基礎模型的 cube 依分店篩選後彙總）
+    designer_months = rollup_activity(activity_monthly, ["設計師", "month"])
+    designer_metrics, vacancy_recent, has_request = designer_metric_table(
+        designer_totals(partials), designer_months, activity_monthly, vacancy_monthly, end_date, min_repeat_base
+    )
+
+    store_monthly_avg = None
+    summary_by_store = None
+    summary_by_store_designer = None
+    if has_store:
+        store_monthly_avg, summary_by_store, summary_by_store_designer = store_summaries(partials, designer_filter)
+
+    return {
+        "store_filter": store_filter,
+        "designer_filter": designer_filter,
+        "min_repeat_base": min_repeat_base,
+        "end_date": end_date,
+        "start_ts_3m": start_ts_3m,
+        "start_ts_6m": start_ts_6m,
+        "start_ts_12m": start_ts_12m,
+        "new_first_store": new_first_store,
+        "filtered_new_first": new_first_store[new_first_store["設計師"].isin(designer_filter)],
+        "new_recent_churn": new_recent_churn,
+        "relationship_first": relationship_first,
+        "store_partials": partials,
+        "designer_metrics": designer_metrics,
+        "has_request": has_request,
+        "store_monthly_avg": store_monthly_avg,
+        "summary_by_store": summary_by_store,
+        "summary_by_store_designer": summary_by_store_designer,
+        "activity_monthly": activity_monthly,
+        "vacancy_monthly": vacancy_monthly,
+        "vacancy_recent": vacancy_recent,
+    }
+
+def with_designer_filter(view, designer_filter):
+    # 只有流失名單與分店 x 師傅彙總受師傅篩選影響，其餘檢視結果沿用（例如開啟快照時）
+    new_first_store = view["new_first_store"]
+    view = dict(
+        view,
+        designer_filter=designer_filter,
+        filtered_new_first=new_first_store[new_first_store["設計師"].isin(designer_filter)],
+    )
+    if view["summary_by_store"] is not None:
+        view["summary_by_store_designer"] = store_designer_summary(view["store_partials"], designer_filter)
+    return view
+
+# 師傅指標歷史：近 N 個月各月（截止於該月最後一筆結帳，最後一期為資料截止日）的師傅指標表
+HISTORY_MONTHS = 24
+
+def history_end_dates(times, end_date, months=HISTORY_MONTHS):
+    # 各期資料截止時間：各月底以前最後一筆結帳時間（與只用該月底以前的帳單重算時的資料截止日相同），
+    # 最後一期為資料截止日；不早於第一筆結帳的月份。某月沒有結帳時與前一期相同，只留一期
+    times = np.sort(times.dropna().to_numpy(dtype="datetime64[us]"))
+    end_ts = pd.Timestamp(end_date)
+    end_month = end_ts.to_period("M")
+    start_month = max(end_month - (months - 1), pd.Timestamp(times[0]).to_period("M"))
+    next_starts = np.array(
+        [(p + 1).start_time for p in pd.period_range(start_month, end_month - 1, freq="M")], dtype="datetime64[us]"
+    )
+    month_last = times[np.searchsorted(times, next_starts, "left") - 1]
+    return pd.DatetimeIndex(np.unique(np.append(month_last, end_ts.to_datetime64()))).as_unit("us")
+
+def as_of_slot(end_dates, times):
+    # 各時間從第幾期開始 ≤ 資料截止時間；缺值（NaT 排在最後）永遠不計
+    return np.searchsorted(end_dates.to_numpy(), np.asarray(times, dtype="datetime64[us]"), "left")
+
+def window_slot(starts, times):
+    # 各時間到第幾期為止仍 ≥ 近 N 月起點（起點隨期數遞增）
+    return np.searchsorted(starts.to_numpy(), np.asarray(times, dtype="datetime64[us]"), "right")
+
+def history_counts(merged, new_first, relationship_first, end_dates, designers):
+    # 部分彙總各計數在每一期的師傅合計。每列的條件都是「滿期（時間 ≤ 截止日）且在近 N 月內（時間 ≥ 起點）」，
+    # 兩者對期數單調，所以每列計入的是一段連續期數：以 searchsorted 找兩端，差分直方圖累加一次得到全部期數。
+    # 熟客回指的近 3 月前次數隨起點變動，另由 familiar_history_counts 逐期計算
+    n_designers, n_dates = len(designers), len(end_dates)
+    windows = [view_windows(d) for d in end_dates]
+    starts_3m = pd.DatetimeIndex([w[0] for w in windows]).as_unit("us")
+    starts_12m = pd.DatetimeIndex([w[2] for w in windows]).as_unit("us")
+    counts = {}
+
+    def add(name, ids, lo, hi, weights=None):
+        counts[name] = interval_counts(ids, lo, hi, n_designers, n_dates, weights)
+
+    first_time = new_first["結帳操作時間"]
+    matured = as_of_slot(end_dates, first_time + pd.Timedelta(days=CHURN_DAYS))
+    matured_2 = as_of_slot(end_dates, first_time + pd.Timedelta(days=T2_DAYS))
+    matured_3 = as_of_slot(end_dates, first_time + pd.Timedelta(days=T3_DAYS))
+    in_3m = window_slot(starts_3m, first_time)
+    churn = new_first["churn"].to_numpy(dtype=bool)
+    always = np.full(len(new_first), n_dates)
+    ids = designers.get_indexer(new_first["設計師"])
+    add("matured_new_customers", ids, matured, always)
+    add("churned", ids, matured, always, churn)
+    add("new_customers_3m", ids, matured, in_3m)
+    add("new_churned_3m", ids, matured, in_3m, churn)
+    add("new_repeat_base_3m", ids, matured_2, in_3m)
+    add("new_repeat2_count", ids, matured_2, in_3m, new_first["repeat2"].to_numpy(dtype=bool))
+    add("new_deep_n", ids, matured_3, in_3m)
+    add("new_deep_count", ids, matured_3, in_3m, new_first["repeat3"].to_numpy(dtype=bool))
+
+    times = merged["結帳操作時間"]
+    seen = as_of_slot(end_dates, times)
+    in_3m = window_slot(starts_3m, times)
+    ids = designers.get_indexer(merged["設計師"])
+    add("total_orders_3m", ids, seen, in_3m)
+    if "is_requested" in merged.columns:
+        add("request_yes_3m", ids, seen, in_3m, (merged["is_requested"] == True).to_numpy())
+        add("request_total_3m", ids, seen, in_3m, merged["is_requested"].notna().to_numpy())
+        add("request_known", ids, seen, np.full(len(merged), n_dates), merged["is_requested"].notna().to_numpy())
+
+    if not relationship_first.empty:
+        baseline = relationship_first["baseline_time"]
+        regular_date = relationship_first["regular_date"]
+        in_12m = window_slot(starts_12m, baseline)
+        regular_base = as_of_slot(end_dates, baseline + pd.Timedelta(days=REGULAR_DAYS))
+        retention_base = as_of_slot(end_dates, regular_date + pd.Timedelta(days=RETENTION_DAYS))
+        achieved = (relationship_first["regular_achieved"] == True).to_numpy()
+        regular_days = (regular_date - baseline).dt.days.to_numpy(dtype=float)
+        post_visits = relationship_first["post_regular_visits_180"].to_numpy(dtype=float)
+        ids = designers.get_indexer(relationship_first["設計師"])
+        add("regular_base_180", ids, regular_base, in_12m)
+        add("regular_achieved_180", ids, regular_base, in_12m, achieved)
+        add("regular_days_sum", ids, regular_base, in_12m, np.nan_to_num(regular_days))
+        add("regular_days_n", ids, regular_base, in_12m, ~np.isnan(regular_days))
+        add("retention_base_180", ids, retention_base, in_12m, achieved)
+        add(
+            "retention_achieved_180", ids, retention_base, in_12m,
+            achieved & (relationship_first["retention_achieved"] == True).to_numpy(),
+        )
+        add("post_regular_visits_sum", ids, retention_base, in_12m, np.where(achieved, np.nan_to_num(post_visits), 0.0))
+        add("post_regular_visits_n", ids, retention_base, in_12m, achieved & ~np.isnan(post_visits))
+    return counts
+
+def familiar_history_counts(merged, end_dates, designers, indexes):
+    # 熟客回指逐期計算：每期只取近 3 個月的結帳列，近 3 月前次數在共用的 visit_index 上二分搜尋
+    names = ["familiar_customers_3m", "familiar_repeat2_count", "familiar_deep_n", "familiar_deep_count"]
+    counts = {name: np.zeros((len(designers), len(end_dates))) for name in names}
+    times = merged["結帳操作時間"]
+    for k, end_date in enumerate(end_dates):
+        start_ts_3m = view_windows(end_date)[0]
+        recent = merged[((times >= start_ts_3m) & (times <= end_date)).to_numpy()]
+        familiar_first = familiar_first_visits(recent, start_ts_3m, end_date, *indexes)
+        if familiar_first.empty:
+            continue
+        ids = designers.get_indexer(familiar_first["設計師"])
+        keep = ids >= 0
+        fam_2 = familiar_first["matured_2"].to_numpy(dtype=bool)
+        fam_3 = familiar_first["matured_3"].to_numpy(dtype=bool)
+        flags = {
+            "familiar_customers_3m": fam_2,
+            "familiar_repeat2_count": fam_2 & familiar_first["repeat2"].to_numpy(dtype=bool),
+            "familiar_deep_n": fam_3,
+            "familiar_deep_count": fam_3 & familiar_first["repeat3"].to_numpy(dtype=bool),
+        }
+        for name, values in flags.items():
+            counts[name][:, k] = np.bincount(ids[keep], weights=values[keep], minlength=len(designers))
+    return counts
+
+def designer_history(base, store_filter=None, months=HISTORY_MONTHS, min_repeat_base=5):
+    # 長表：每 (end_date, 設計師) 一列，欄位與檢視的 designer_metrics 相同（含戰力分數，Z-score 為同期師傅間比較）。
+    # 各期計數由區間累加一次算完，visit_index 只建一次；出勤、穩定度、空窗率取每月活動 cube 截止月以前的格
+    has_store = base["has_store"]
+    if not has_store:
+        store_filter = None
+    merged = filter_stores(base["merged"], store_filter)
+    end_date = view_end_date(base, store_filter)
+    if pd.isna(end_date):
+        raise DataInputError("篩選後沒有可用資料。")
+    with stage("designer_history", len(merged)) as s:
+        end_dates = history_end_dates(merged["結帳操作時間"], end_date, months)
+        designers = pd.Index(merged["設計師"].dropna().unique(), name="設計師").sort_values()
+        counts = history_counts(
+            merged,
+            filter_stores(base["new_first"], store_filter),
+            filter_stores(base["relationship_first"], store_filter),
+            end_dates,
+            designers,
+        )
+        counts.update(familiar_history_counts(merged, end_dates, designers, store_visit_indexes(base["merged"])))
+
+        activity_monthly = filter_stores(base["activity_monthly"], store_filter)
+        activity_starts = month_starts(activity_monthly["month"])
+        designer_months = rollup_activity(activity_monthly, ["設計師", "month"])
+        designer_month_starts = month_starts(designer_months["month"])
+        vacancy_monthly = base["vacancy_monthly"]
+        if vacancy_monthly is not None:
+            vacancy_monthly = filter_stores(vacancy_monthly, store_filter)
+            vacancy_starts = month_starts(vacancy_monthly["month"])
+        count_cols = [c for c in PARTIAL_COUNTS if not c.endswith("_sum")]
+        frames = []
+        for k, as_of in enumerate(end_dates):
+            totals = pd.DataFrame(
+                {name: counts[name][:, k] if name in counts else 0.0 for name in PARTIAL_COUNTS},
+                index=designers,
+            ).round()
+            totals[count_cols] = totals[count_cols].astype(np.int64)
+            designer_metrics, _, _ = designer_metric_table(
+                totals,
+                designer_months[designer_month_starts <= as_of],
+                activity_monthly[activity_starts <= as_of],
+                None if vacancy_monthly is None else vacancy_monthly[vacancy_starts <= as_of],
+                as_of,
+                min_repeat_base,
+            )
+            designer_metrics.insert(0, "end_date", as_of)
+            frames.append(designer_metrics)
+        # 早期沒有熟客化樣本時欄位補在最後，統一成最後一期（與檢視相同）的欄序
+        history = pd.concat(frames, ignore_index=True).reindex(columns=frames[-1].columns)
+        s["rows"] = len(history)
+    return history
+
+# 目標達成分預設目標（比率以 0-1 表示）
+DEFAULT_TARGETS = {
+    "avg_active_days": 16.5,
+    "active_days_3m": 50.0,
+    "total_orders_3m": 188.0,
+    "vacancy_rate_3m": 0.25,
+    "new_share_3m": 0.15,
+    "new_per_active_day_3m": 0.35,
+    "new_retention_rate_3m": 0.60,
+    "regular_rate_180": 0.18,
+    "regular_days_avg_180": 60.0,
+    "retention_rate_180": 0.80,
+    "post_regular_visits_monthly_avg_180": 1.50,
+    "stability_cv": 0.45,
+}
+STABILITY_CEILING = 1.0
+
+def add_goal_scores(designer_metrics, targets=None):
+    # 目標達成分（0-100，達標=100；並依樣本數修正）
+    designer_metrics = designer_metrics.copy()
+    targets = dict(DEFAULT_TARGETS, **(targets or {}))
+    basic_goal_components = pd.DataFrame({
+        "g_avg_active_days": goal_score_high(col_series(designer_metrics, "avg_active_days_3m"), targets["avg_active_days"], floor=0.0),
+        "g_active_days_3m": goal_score_high(col_series(designer_metrics, "active_days_3m"), targets["active_days_3m"], floor=0.0),
+        "g_total_orders": goal_score_high(col_series(designer_metrics, "total_orders_3m"), targets["total_orders_3m"], floor=0.0),
+        "g_vacancy": goal_score_low(col_series(designer_metrics, "vacancy_rate_3m"), targets["vacancy_rate_3m"], ceiling=1.0),
+    })
+    designer_metrics["basic_goal_raw"] = basic_goal_components.mean(axis=1, skipna=True)
+    designer_metrics["basic_goal_0100"] = shrink_to_neutral(designer_metrics["basic_goal_raw"], designer_metrics.get("basic_rel"))
+
+    new_acq_goal_components = pd.DataFrame({
+        "g_new_share": goal_score_high(col_series(designer_metrics, "new_share_3m"), targets["new_share_3m"], floor=0.0),
+        "g_new_per_day": goal_score_high(col_series(designer_metrics, "new_per_active_day_3m"), targets["new_per_active_day_3m"], floor=0.0),
+    })
+    designer_metrics["new_acq_goal_raw"] = new_acq_goal_components.mean(axis=1, skipna=True)
+    designer_metrics["new_acq_goal_0100"] = shrink_to_neutral(designer_metrics["new_acq_goal_raw"], designer_metrics.get("new_acq_rel"))
+
+    designer_metrics["new_ret_goal_raw"] = goal_score_high(col_series(designer_metrics, "new_retention_rate_3m"), targets["new_retention_rate_3m"], floor=0.0)
+    designer_metrics["new_ret_goal_0100"] = shrink_to_neutral(designer_metrics["new_ret_goal_raw"], designer_metrics.get("new_ret_rel"))
+
+    convert_goal_components = pd.DataFrame({
+        "g_regular_rate": goal_score_high(col_series(designer_metrics, "regular_rate_180"), targets["regular_rate_180"], floor=0.0),
+        "g_regular_days": goal_score_low(col_series(designer_metrics, "regular_days_avg_180"), targets["regular_days_avg_180"], ceiling=float(REGULAR_DAYS)),
+    })
+    designer_metrics["convert_goal_raw"] = convert_goal_components.mean(axis=1, skipna=True)
+    designer_metrics["convert_goal_0100"] = shrink_to_neutral(designer_metrics["convert_goal_raw"], designer_metrics.get("convert_rel"))
+
+    retain_goal_components = pd.DataFrame({
+        "g_retention_rate": goal_score_high(col_series(designer_metrics, "retention_rate_180"), targets["retention_rate_180"], floor=0.0),
+        "g_post_visits": goal_score_high(col_series(designer_metrics, "post_regular_visits_monthly_avg_180"), targets["post_regular_visits_monthly_avg_180"], floor=0.0),
+    })
+    designer_metrics["retain_goal_raw"] = retain_goal_components.mean(axis=1, skipna=True)
+    designer_metrics["retain_goal_0100"] = shrink_to_neutral(designer_metrics["retain_goal_raw"], designer_metrics.get("retain_rel"))
+
+    designer_metrics["stability_goal_raw"] = goal_score_low(col_series(designer_metrics, "stability_cv"), targets["stability_cv"], ceiling=float(STABILITY_CEILING))
+    designer_metrics["stability_goal_0100"] = shrink_to_neutral(designer_metrics["stability_goal_raw"], designer_metrics.get("stability_rel"))
+
+    goal_blocks = designer_metrics[
+        ["basic_goal_0100", "new_acq_goal_0100", "new_ret_goal_0100", "convert_goal_0100", "retain_goal_0100", "stability_goal_0100"]
+    ]
+    # 將戰力指標權重調整：暫時不計入「新客獲取量」以避免偏差
+    goal_weights = np.array([1/5, 1/5, 0, 1/5, 1/5, 1/5])
+    goal_valid = goal_blocks.notna().values
+    goal_weighted = goal_blocks.fillna(0).values * goal_weights
+    goal_weight_sum = (goal_valid * goal_weights).sum(axis=1)
+    designer_metrics["overall_goal_0100"] = np.where(goal_weight_sum > 0, goal_weighted.sum(axis=1) / goal_weight_sum, np.nan)
+    return designer_metrics
+
+def overall_summary(new_first_store):
+    overall = {
+        "matured_new_customers": int(len(new_first_store[new_first_store["matured"]])),
+        "churned_matured": int(new_first_store.loc[new_first_store["matured"], "churn"].sum()),
+    }
+    overall["retained_matured"] = overall["matured_new_customers"] - overall["churned_matured"]
+    overall["churn_rate_matured"] = (
+        overall["churned_matured"] / overall["matured_new_customers"]
+        if overall["matured_new_customers"]
+        else None
+    )
+    overall["repeat_rate_matured"] = (
+        1 - overall["churn_rate_matured"]
+        if overall["churn_rate_matured"] is not None
+        else None
+    )
+    return overall
+
+# 師傅彙總表：欄位中文名稱與顯示順序（介面與 Excel 報表共用）
+DESIGNER_TABLE_RENAME = {
+    "end_date": "截止日",
+    "設計師": "師傅",
+    "overall_goal_0100": "戰力指標(0-100)",
+    "basic_goal_0100": "基本狀態(0-100)",
+    "new_acq_goal_0100": "新客獲取量(0-100)",
+    "new_ret_goal_0100": "新客留存力(0-100)",
+    "convert_goal_0100": "熟客轉化力(0-100)",
+    "retain_goal_0100": "熟客經營力(0-100)",
+    "stability_goal_0100": "業績穩定度(0-100)",
+    "new_share_3m": "新客占比(新客/總單量)",
+    "new_per_active_day_3m": "新客/有單天數(3M)",
+    "new_customers_3m": "新客數(3M,滿60天)",
+    "new_churn_rate_3m": "新客流失率(60天)",
+    "new_retention_rate_3m": "新客留存率(60天)",
+    "total_orders_3m": "總單量(3M)",
+    "new_churned_3m": "流失人數(3M)",
+    "new_retained_3m": "留住人數(3M)",
+    "new_repeat_rate_3m": "新客回指率(30天)",
+    "new_repeat_base_3m": "新客回指樣本數(30天)",
+    "new_deep_rate_3m": "新客深度回指率(60天)",
+    "new_deep_n": "新客深度回指樣本數(60天)",
+    "familiar_repeat_rate_3m": "熟客回指率(30天)",
+    "familiar_customers_3m": "熟客回指樣本數(30天)",
+    "familiar_deep_rate_3m": "熟客深度回指率(60天)",
+    "familiar_deep_n": "熟客深度回指樣本數(60天)",
+    "avg_active_days_3m": "每月平均有單天數(近3月)",
+    "active_days_3m": "近3月有單天數",
+    "regular_rate_180": "熟客化率(180天達5次)",
+    "regular_base_180": "熟客化樣本數(滿180天)",
+    "regular_achieved_180": "熟客化達標人數",
+    "regular_days_avg_180": "平均達標天數",
+    "retention_rate_180": "熟客維持率(後180天≥3次)",
+    "retention_base_180": "熟客維持樣本數(滿後180天)",
+    "retention_achieved_180": "熟客維持達標人數",
+    "post_regular_visits_avg_180": "後180天平均回訪次數",
+    "post_regular_visits_monthly_avg_180": "熟客月均回訪次數(後180天)",
+    "request_rate_3m": "指定率(3M)",
+    "request_yes_3m": "指定單數(3M)",
+    "request_total_3m": "總單數(3M)",
+    "vacancy_rate_3m": "空窗率(3M)",
+    "days_since_last_tx": "最近有單距今(天)",
+}
+DESIGNER_TABLE_COLUMNS = [
+    "師傅",
+    "戰力指標(0-100)",
+    "基本狀態(0-100)",
+    "新客獲取量(0-100)",
+    "新客留存力(0-100)",
+    "熟客轉化力(0-100)",
+    "熟客經營力(0-100)",
+    "業績穩定度(0-100)",
+    "新客占比(新客/總單量)",
+    "新客/有單天數(3M)",
+    "新客數(3M,滿60天)",
+    "新客流失率(60天)",
+    "新客留存率(60天)",
+    "流失人數(3M)",
+    "留住人數(3M)",
+    "新客回指率(30天)",
+    "新客回指樣本數(30天)",
+    "新客深度回指率(60天)",
+    "新客深度回指樣本數(60天)",
+    "熟客回指率(30天)",
+    "熟客回指樣本數(30天)",
+    "熟客深度回指率(60天)",
+    "熟客深度回指樣本數(60天)",
+    "總單量(3M)",
+    "每月平均有單天數(近3月)",
+    "近3月有單天數",
+    "熟客化率(180天達5次)",
+    "熟客化樣本數(滿180天)",
+    "熟客化達標人數",
+    "平均達標天數",
+    "熟客維持率(後180天≥3次)",
+    "熟客維持樣本數(滿後180天)",
+    "熟客維持達標人數",
+    "後180天平均回訪次數",
+    "熟客月均回訪次數(後180天)",
+    "指定率(3M)",
+    "指定單數(3M)",
+    "總單數(3M)",
+    "空窗率(3M)",
+    "業績穩定度(CV)",
+]
+
+def designer_report_table(designer_metrics_filtered):
+    designer_table = designer_metrics_filtered.copy()
+    service_cv = designer_table["service_hours_cv_6m"] if "service_hours_cv_6m" in designer_table.columns else pd.Series(np.nan, index=designer_table.index)
+    active_cv = designer_table["active_days_cv_6m"] if "active_days_cv_6m" in designer_table.columns else pd.Series(np.nan, index=designer_table.index)
+    designer_table["業績穩定度(CV)"] = np.where(service_cv.notna(), service_cv, active_cv)
+    return designer_table.rename(columns=DESIGNER_TABLE_RENAME)
+
+def designer_history_table(history, designer_filter):
+    # 師傅指標歷史長表 → 報表欄位；history 需已含目標達成分。截止日只列日期
+    table = designer_report_table(history[history["設計師"].isin(designer_filter)])
+    table["截止日"] = table["截止日"].dt.normalize()
+    cols = [c for c in ["截止日"] + DESIGNER_TABLE_COLUMNS if c in table.columns]
+    return table[cols].sort_values(["截止日", "師傅"], kind="stable").reset_index(drop=True)
+
+def store_report_tables(summary_by_store, summary_by_store_designer):
+    store_table = summary_by_store.rename(
+        columns={
+            "分店": "分店",
+            "matured_new_customers": "滿60天新客數",
+            "churned": "流失數",
+            "churn_rate": "流失率",
+            "repeat_rate": "回店率",
+        }
+    )
+    store_designer_table = summary_by_store_designer.rename(
+        columns={
+            "分店": "分店",
+            "設計師": "師傅",
+            "matured_new_customers": "滿60天新客數",
+            "churned": "流失數",
+            "churn_rate": "流失率",
+            "repeat_rate": "回店率",
+        }
+    )
+    return store_table, store_designer_table
+
+def vacancy_report_table(vacancy_monthly, store_filter, designer_filter):
+    display_vacancy = filter_stores(vacancy_monthly, store_filter)
+    display_vacancy = display_vacancy[display_vacancy["設計師"].isin(designer_filter)]
+    return display_vacancy.rename(
+        columns={
+            "分店": "分店",
+            "設計師": "師傅",
+            "month": "月份",
+            "duration_hours": "服務時數",
+            "vacancy_rate": "空窗率",
+        }
+    )
+
+def churn_detail_table(filtered_new_first, name_col, store_filter, designer_filter, churned_only=True, members=None):
+    detail = filtered_new_first[filtered_new_first["churn"]] if churned_only else filtered_new_first
+    detail = filter_stores(detail, store_filter)
+    detail_display = attach_members(detail[detail["設計師"].isin(designer_filter)], members)
+    detail_display["是否滿期"] = detail_display["matured"].map({True: "是", False: "否"})
+    detail_display["是否流失"] = detail_display["churn"].map({True: "是", False: "否"})
+    detail_display["電話"] = detail_display["phone_key"]
+    detail_display = detail_display.rename(columns={"設計師": "師傅", "結帳操作時間": "首單時間"})
+
+    display_cols = ["電話", name_col, "分店", "師傅", "首單時間", "是否滿期", "是否流失"]
+    display_cols = [c for c in display_cols if c in detail_display.columns]
+    return detail_display, display_cols
+
+def write_excel_report(target, overall, designer_table, store_table, store_designer_table, churn_list, display_vacancy, history_table=None):
+    overall_df = pd.DataFrame([{
+        "滿60天新客數": overall["matured_new_customers"],
+        "流失人數": overall["churned_matured"],
+        "留住人數": overall["retained_matured"],
+        "流失率": overall["churn_rate_matured"],
+        "回店率": overall["repeat_rate_matured"],
+    }])
+    with stage("excel_export", len(churn_list)), pd.ExcelWriter(target, engine="openpyxl") as writer:
+        overall_df.to_excel(writer, index=False, sheet_name="總覽")
+        if designer_table is not None:
+            designer_table.to_excel(writer, index=False, sheet_name="師傅彙總(3M)")
+        if store_table is not None:
+            store_table.to_excel(writer, index=False, sheet_name="分店彙總")
+        if store_designer_table is not None:
+            store_designer_table.to_excel(writer, index=False, sheet_name="分店師傅彙總")
+        churn_list.to_excel(writer, index=False, sheet_name="流失名單")
+        if display_vacancy is not None:
+            display_vacancy.to_excel(writer, index=False, sheet_name="空窗率(月)")
+        if history_table is not None:
+            history_table.to_excel(writer, index=False, sheet_name="師傅歷史(月)")
+
+def build_report(base, view, targets=None, churned_only=True, history_months=0):
+    # 與介面「下載 Excel」相同內容的報表資料；designer_metrics 已含目標達成分。
+    # history_months > 0 時另算近 N 個月各月的師傅指標歷史
+    designer_filter = view["designer_filter"]
+    designer_metrics = add_goal_scores(view["designer_metrics"], targets)
+    designer_metrics_filtered = designer_metrics[designer_metrics["設計師"].isin(designer_filter)].copy()
+    designer_table = None if designer_metrics_filtered.empty else designer_report_table(designer_metrics_filtered)
+    store_table = None
+    store_designer_table = None
+    if base["has_store"]:
+        store_table, store_designer_table = store_report_tables(view["summary_by_store"], view["summary_by_store_designer"])
+    display_vacancy = None
+    if view["vacancy_monthly"] is not None:
+        display_vacancy = vacancy_report_table(view["vacancy_monthly"], view["store_filter"], designer_filter)
+    detail_display, display_cols = churn_detail_table(
+        view["filtered_new_first"], base["name_col"], view["store_filter"], designer_filter, churned_only, base["members"]
+    )
+    history = None
+    history_table = None
+    if history_months:
+        history = add_goal_scores(designer_history(base, view["store_filter"], history_months, view["min_repeat_base"]), targets)
+        history_table = designer_history_table(history, designer_filter)
+    return {
+        "designer_metrics": designer_metrics,
+        "overall": overall_summary(view["new_first_store"]),
+        "designer_table": designer_table,
+        "store_table": store_table,
+        "store_designer_table": store_designer_table,
+        "churn_list": detail_display[display_cols],
+        "display_vacancy": display_vacancy,
+        "designer_history": history,
+        "history_table": history_table,
+    }
@@ -2,11 +2,49 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import altair as alt
-from pathlib import Path
 import re
 import html
-from datetime import timedelta
 from io import BytesIO
+from bill_io import default_load_workers
+from analytics import (
+    CHURN_DAYS,
+    DEFAULT_TARGETS,
+    DESIGNER_TABLE_COLUMNS,
+    HISTORY_MONTHS,
+    REGULAR_DAYS,
+    RETENTION_DAYS,
+    STABILITY_CEILING,
+    STATE_PATH,
+    T2_DAYS,
+    T3_DAYS,
+    DataInputError,
+    add_goal_scores,
+    append_bills,
+    attach_members,
+    base_fingerprint,
+    build_base_model,
+    churn_detail_table,
+    compute_view,
+    default_compute_workers,
+    designer_history,
+    designer_history_table,
+    designer_options,
+    designer_report_table,
+    month_starts,
+    overall_summary,
+    read_item_overrides,
+    save_base_state,
+    store_options,
+    store_report_tables,
+    sweep_rates,
+    vacancy_report_table,
+    window_sweep,
+    with_designer_filter,
+    write_excel_report,
+)
+from snapshot import list_snapshots, load_snapshot
+from service_items import item_minutes_table, item_overrides_version, save_item_overrides
+from profiling import append_profile_log, profile_table, start_profiling, stop_profiling
 
 def _theme():
     return {
@@ -355,6 +393,30 @@ with st.sidebar:
     chart_top_n = st.number_input("圖表顯示前 N 名（0=全部）", min_value=0, max_value=100, value=0, step=1)
     min_repeat_base = st.number_input("回指率最低樣本數（低於則不顯示）", min_value=1, max_value=100, value=5, step=1)
     store_chart_type = st.selectbox("分店比較圖表", ["群組直條圖", "熱度圖", "堆疊條圖"])
+    load_workers = default_load_workers()
+    parallel_load = st.checkbox(f"多檔平行讀取（最多 {load_workers} 個行程）", value=load_workers > 1)
+    compute_workers = default_compute_workers()
+    parallel_compute = st.checkbox(f"分店平行計算（最多 {compute_workers} 個行程）", value=compute_workers > 1)
+    compute_mode = st.radio("計算模式", ["完整重算", "增量附加", "開啟快照"], horizontal=True)
+    incremental_mode = compute_mode == "增量附加"
+    snapshot_mode = compute_mode == "開啟快照"
+    snapshot_name = None
+    if incremental_mode:
+        st.caption("只上傳新月份帳單，沿用已儲存的狀態；會員名單沿用儲存時的版本。")
+    if snapshot_mode:
+        snapshots = list_snapshots()
+        if snapshots:
+            snapshot_labels = {
+                f"{m['name']}（資料截止 {m['end_date'][:10]}，{m['rows']:,} 筆）": m["name"] for m in snapshots
+            }
+            snapshot_name = snapshot_labels[st.selectbox("快照", list(snapshot_labels.keys()))]
+    profile_enabled = st.checkbox("效能紀錄（逐段耗時與記憶體）", value=False)
+
+# 每次重跑重新開始紀錄；沒勾選時清掉，避免同一執行緒留著上次的紀錄
+if profile_enabled:
+    start_profiling()
+else:
+    stop_profiling()
 
 st.write("""
 本工具會：
@@ -367,95 +429,14 @@ st.write("""
 空窗率計算：依項目分鐘估算時長（1～30=0.5；31～60=1；61～90=1.5，以此類推），月上限 168 小時
 """)
 
-if not bill_files:
-    st.info("請先上傳帳單檔。")
+if snapshot_mode and snapshot_name is None:
+    st.info("尚無快照，請先以 `python3 cli.py ... --snapshot` 建立。")
     st.stop()
 
-CHURN_DAYS = 60
-T2_DAYS = 30
-T3_DAYS = 60
-REGULAR_DAYS = 180
-REGULAR_VISITS = 5
-RETENTION_DAYS = 180
-RETENTION_VISITS = 3
-RELATIONSHIP_COHORT_MONTHS = 12
-
-@st.cache_data(show_spinner=False)
-def load_member(file):
-    return pd.read_excel(file, sheet_name="會員名單")
-
-@st.cache_data(show_spinner=False)
-def load_bill(file, sheets):
-    xls = pd.ExcelFile(file)
-    available = [s for s in sheets if s in xls.sheet_names]
-    frames = []
-    for s in available:
-        frames.append(pd.read_excel(file, sheet_name=s))
-    if not frames:
-        return pd.DataFrame(), available
-    return pd.concat(frames, ignore_index=True), available
-
-def infer_store_name(filename):
-    stem = Path(filename).stem
-    name = stem
-    name = re.sub(r"帳單紀錄", "", name)
-    name = re.sub(r"帳單|紀錄", "", name)
-    name = re.sub(r"\d{4}-\d{2}-\d{2}", "", name)
-    name = re.sub(r"\d{8,}", "", name)
-    name = re.sub(r"[_\-]+", " ", name)
-    name = re.sub(r"\s+", " ", name).strip()
-    return name if name else stem
-
-def load_bills(files, sheets):
-    frames = []
-    used = set()
-    for f in files:
-        df, used_sheets = load_bill(f, sheets)
-        if not df.empty:
-            store_name = infer_store_name(getattr(f, "name", "未命名分店"))
-            df["來源檔案"] = getattr(f, "name", "未命名檔案")
-            if "分店" not in df.columns:
-                df["分店"] = store_name
-            else:
-                df["分店"] = df["分店"].fillna(store_name)
-            frames.append(df)
-        used.update(used_sheets)
-    if not frames:
-        return pd.DataFrame(), list(used)
-    return pd.concat(frames, ignore_index=True), list(used)
-
-bills, used_sheets = load_bills(bill_files, include_types)
-
-if bills.empty:
-    st.error("帳單檔中找不到選擇的工作表。")
+if not bill_files and not snapshot_mode:
+    st.info("請先上傳帳單檔。")
     st.stop()
 
-# Normalize phone numbers
-
-def norm_digits(x):
-    if pd.isna(x):
-        return None
-    if isinstance(x, (int, np.integer)):
-        s = str(int(x))
-    elif isinstance(x, (float, np.floating)):
-        if np.isnan(x):
-            return None
-        s = str(int(x)) if float(x).is_integer() else str(x)
-    else:
-        s = str(x)
-    digits = re.sub(r"\D+", "", s)
-    return digits or None
-
-def norm_yes_no(x):
-    if pd.isna(x):
-        return None
-    s = str(x).strip().upper()
-    if s in ("Y", "YES", "TRUE", "1", "指定", "是"):
-        return True
-    if s in ("N", "NO", "FALSE", "0", "非指定", "否"):
-        return False
-    return None
-
 def mask_last3(x):
     if pd.isna(x):
         return ""
@@ -464,21 +445,6 @@ def mask_last3(x):
         return ""
     return digits[-3:] if len(digits) >= 3 else digits
 
-def extract_minutes(item_text):
-    if pd.isna(item_text):
-        return 0
-    mins = re.findall(r"(\d+)\s*分鐘", str(item_text))
-    if not mins:
-        return 0
-    return sum(int(m) for m in mins)
-
-def minutes_to_hours(mins):
-    if mins <= 0:
-        return 0.0
-    # 1~30=0.5, 31~60=1, 61~90=1.5, ...
-    units = int((mins - 1) // 30 + 1)
-    return units * 0.5
-
 def render_bar_chart(df, category_col, value_col, title, color="#2b7a78", top_n=0, value_format="percent", orient="vertical", ascending=False):
     if df.empty:
         st.info("沒有可顯示的資料。")
@@ -618,186 +584,160 @@ def section_gap():
     st.markdown('<div class="section-gap"></div>', unsafe_allow_html=True)
 
 
-for df, col in [(bills, "國碼"), (bills, "電話號碼")]:
-    if col in df.columns:
-        bills[col] = bills[col].apply(norm_digits)
-
-if "國碼" not in bills.columns or "電話號碼" not in bills.columns:
-    st.error("帳單檔缺少 '國碼' 或 '電話號碼' 欄位。")
+# 基礎模型很大，用 cache_resource 直接共用同一份物件，不必每次重跑都反序列化複製一份；
+# 之後的計算（compute_view 等）都不會改動它。item_version：服務時長覆寫存檔的時間，改了覆寫才會重算空窗率
+@st.cache_resource(show_spinner="計算中…")
+def build_base_model_cached(bill_files, member_file, include_types, load_workers, compute_workers, item_version):
+    return build_base_model(bill_files, member_file, include_types, load_workers, compute_workers)
+
+@st.cache_resource(show_spinner="開啟快照…")
+def load_snapshot_cached(name):
+    return load_snapshot(name)
+
+@st.cache_resource(show_spinner="附加新資料…")
+def append_bills_cached(bill_files, include_types, load_workers, state_mtime, item_version):
+    return append_bills(bill_files, include_types, load_workers)
+
+# 歷史逐月重算各期計數，較慢：以基礎模型指紋、分店與樣本數為 key，切換其他設定時直接重用（_base 不參與 hash）
+@st.cache_data(show_spinner="計算師傅指標歷史…")
+def designer_history_cached(_base, fingerprint, store_filter, min_repeat_base):
+    return designer_history(_base, None if store_filter is None else list(store_filter), HISTORY_MONTHS, min_repeat_base)
+
+snapshot_view = None
+try:
+    if snapshot_mode:
+        base_model, snapshot_view = load_snapshot_cached(snapshot_name)
+    elif incremental_mode:
+        base_model, appended_rows = append_bills_cached(
+            bill_files,
+            include_types,
+            load_workers if parallel_load else 1,
+            STATE_PATH.stat().st_mtime_ns if STATE_PATH.exists() else None,
+            item_overrides_version(),
+        )
+    else:
+        base_model = build_base_model_cached(
+            bill_files,
+            member_file,
+            include_types,
+            load_workers if parallel_load else 1,
+            compute_workers if parallel_compute else 1,
+            item_overrides_version(),
+        )
+except DataInputError as e:
+    st.error(str(e))
     st.stop()
 
-bills["phone_key"] = bills["國碼"].fillna("") + "-" + bills["電話號碼"].fillna("")
-
-valid_bills = bills[bills["phone_key"].str.contains("-") & (bills["phone_key"] != "-")].copy()
+with st.sidebar:
+    if snapshot_mode:
+        st.caption(f"快照 {snapshot_name}：{len(base_model['merged']):,} 筆結帳。")
+    elif incremental_mode:
+        st.caption(f"已附加 {appended_rows:,} 筆新結帳，狀態共 {len(base_model['merged']):,} 筆。")
+    elif st.button("儲存為增量狀態"):
+        save_base_state(base_model)
+        st.caption(f"已儲存 {len(base_model['merged']):,} 筆結帳。")
+
+merged = base_model["merged"]
+new_first = base_model["new_first"]
+name_col = base_model["name_col"]
+has_store = base_model["has_store"]
+load_timings = base_model["load_timings"]
 
-valid_bills["結帳操作時間"] = pd.to_datetime(valid_bills["結帳操作時間"], errors="coerce")
-if "指定" in valid_bills.columns:
-    valid_bills["is_requested"] = valid_bills["指定"].apply(norm_yes_no)
-else:
-    valid_bills["is_requested"] = pd.NA
-
-# Merge member data (optional)
-merged = valid_bills.copy()
-if member_file:
-    members = load_member(member_file)
-    for df, col in [(members, "國碼"), (members, "手機號碼")]:
-        if col in df.columns:
-            df[col] = df[col].apply(norm_digits)
-    if "國碼" not in members.columns or "手機號碼" not in members.columns:
-        st.error("會員名單缺少 '國碼' 或 '手機號碼' 欄位。")
-        st.stop()
-    members["phone_key"] = members["國碼"].fillna("") + "-" + members["手機號碼"].fillna("")
-    valid_members = members[members["phone_key"].str.contains("-") & (members["phone_key"] != "-")].copy()
-    member_cols = ["phone_key", "來店次數", "會員姓名"]
-    member_cols = [c for c in member_cols if c in valid_members.columns]
-    merged = valid_bills.merge(valid_members[member_cols], on="phone_key", how="left")
-
-# First checkout per phone
-merged_sorted = merged.sort_values("結帳操作時間")
-first_checkout = merged_sorted.groupby("phone_key", as_index=False).first()
-
-# New customer definition (全品牌首次結帳)
-new_first = first_checkout.copy()
-
-end_date_all = merged["結帳操作時間"].max()
-
-# Choose member name column
-name_col = "會員姓名"
-if "會員姓名" not in new_first.columns:
-    # fallback if merge suffixes exist
-    if "會員姓名_y" in new_first.columns:
-        new_first[name_col] = new_first["會員姓名_y"]
-    elif "會員姓名_x" in new_first.columns:
-        new_first[name_col] = new_first["會員姓名_x"]
-
-# Designer column
-if "設計師" not in new_first.columns:
-    st.error("帳單檔缺少 '設計師' 欄位，無法分師傅。")
-    st.stop()
+with st.sidebar:
+    with st.expander("讀檔耗時", expanded=False):
+        if load_timings:
+            st.dataframe(pd.DataFrame(load_timings).style.format({"秒數": "{:.2f}"}), use_container_width=True, hide_index=True)
+        else:
+            st.caption("沒有解析任何工作表。")
+
+if "項目" in merged.columns and not snapshot_mode:
+    with st.sidebar:
+        with st.expander("服務時長對照", expanded=False):
+            item_table = item_minutes_table(merged["項目"])
+            n_unknown = int(item_table["未知時長"].sum())
+            if n_unknown:
+                st.caption(f"{n_unknown} 種項目無法由文字判斷分鐘數，目前以 0 小時計（會高估空窗率），可在「覆寫分鐘」填入。")
+            if incremental_mode:
+                st.caption("增量附加：儲存覆寫後，已儲存月份的服務時數與空窗率會依新的對照表重算。")
+            edited_items = st.data_editor(
+                item_table,
+                disabled=["項目", "筆數", "解析分鐘", "未知時長"],
+                hide_index=True,
+                use_container_width=True,
+                key="item_minutes_editor",
+            )
+            item_override_file = st.file_uploader("上傳覆寫 CSV（欄位：項目、分鐘）", type=["csv"], key="item_override")
+            if st.button("儲存服務時長覆寫"):
+                # 編輯表內清空的覆寫視為刪除；上傳檔的列再蓋過去
+                override_rows = edited_items[["項目", "覆寫分鐘"]].rename(columns={"覆寫分鐘": "分鐘"})
+                if item_override_file is not None:
+                    try:
+                        override_rows = pd.concat([override_rows, read_item_overrides(item_override_file)], ignore_index=True)
+                    except DataInputError as e:
+                        st.error(str(e))
+                        st.stop()
+                save_item_overrides(override_rows)
+                st.rerun()
+            st.download_button(
+                "下載對照表 CSV",
+                data=(
+                    item_table.assign(分鐘=item_table["覆寫分鐘"].fillna(item_table["解析分鐘"]))[["項目", "分鐘", "筆數"]]
+                    .to_csv(index=False)
+                    .encode("utf-8-sig")
+                ),
+                file_name="item_minutes.csv",
+                mime="text/csv",
+            )
 
-# Store column (optional)
-has_store = "分店" in new_first.columns
 if not has_store:
     st.warning("帳單檔缺少 '分店' 欄位，將無法依分店分組。")
 
 # Sidebar filters
 with st.sidebar:
     st.header("篩選")
+    store_choices = store_options(base_model)
     if has_store:
-        store_options = sorted([s for s in merged["分店"].dropna().unique()])
-        store_filter = st.multiselect("分店", store_options, default=store_options)
+        store_filter = st.multiselect("分店", store_choices, default=store_choices)
     else:
         store_filter = None
-    if has_store and store_filter is not None:
-        base_for_designers = merged[merged["分店"].isin(store_filter)]
-    else:
-        base_for_designers = merged
-    designer_options = sorted([s for s in base_for_designers["設計師"].dropna().unique()])
-    exclude_designers = st.multiselect("排除師傅", designer_options, default=[])
-    include_options = [d for d in designer_options if d not in set(exclude_designers)]
+    designer_choices = designer_options(base_model, store_filter)
+    exclude_designers = st.multiselect("排除師傅", designer_choices, default=[])
+    include_options = [d for d in designer_choices if d not in set(exclude_designers)]
     designer_filter = st.multiselect("師傅", include_options, default=include_options)
 
-merged_store = merged.copy()
-if has_store and store_filter is not None:
-    merged_store = merged_store[merged_store["分店"].isin(store_filter)]
-merged_store = merged_store.sort_values("結帳操作時間")
-merged_designer = merged_store[merged_store["設計師"].isin(designer_filter)].copy()
-
 # 新客以全品牌判定，請確保已上傳全品牌資料
 st.caption("新客口徑為全品牌歷史首次結帳；若未上傳全品牌帳單，可能高估新客與流失率。")
 
-end_date = merged_store["結帳操作時間"].max()
-if pd.isna(end_date):
-    st.error("篩選後沒有可用資料。")
+try:
+    # 快照已含全品牌檢視結果；分店與樣本數設定相同時只需套用師傅篩選
+    if (
+        snapshot_view is not None
+        and (store_filter is None or set(store_filter) == set(store_choices))
+        and snapshot_view["min_repeat_base"] == min_repeat_base
+    ):
+        view = with_designer_filter(snapshot_view, designer_filter)
+    else:
+        view = compute_view(base_model, store_filter, designer_filter, min_repeat_base)
+except DataInputError as e:
+    st.error(str(e))
     st.stop()
 
-# 新客（全品牌首購）→ 同分店回店
-new_first_store = new_first.copy()
-if has_store and store_filter is not None:
-    new_first_store = new_first_store[new_first_store["分店"].isin(store_filter)]
-
-checkouts_by_phone_store = merged_store.groupby(["phone_key", "分店"])["結帳操作時間"].apply(list)
-
-def distinct_visit_dates(times):
-    dates = set()
-    for t in times:
-        if pd.isna(t):
-            continue
-        ts = pd.to_datetime(t, errors="coerce")
-        if pd.isna(ts):
-            continue
-        dates.add(ts.date())
-    return sorted(dates)
-
-churn_flags = []
-return_days_store = []
-for _, row in new_first_store.iterrows():
-    pk = row["phone_key"]
-    store = row.get("分店")
-    first_time = row["結帳操作時間"]
-    if pd.isna(first_time):
-        return_days_store.append(np.nan)
-        churn_flags.append(True)
-        continue
-    first_date = pd.to_datetime(first_time).date()
-    times = checkouts_by_phone_store.get((pk, store), [])
-    visit_dates = distinct_visit_dates(times)
-    next_dates = [d for d in visit_dates if d > first_date]
-    next_date = next_dates[0] if next_dates else None
-    if next_date is not None:
-        return_days = (next_date - first_date).days
-        return_days_store.append(return_days)
-        churn_flags.append(return_days > CHURN_DAYS)
-    else:
-        return_days_store.append(np.nan)
-        churn_flags.append(True)
-new_first_store["return_days_store"] = return_days_store
-new_first_store["churn"] = churn_flags
-new_first_store["matured"] = new_first_store["結帳操作時間"] + pd.Timedelta(days=CHURN_DAYS) <= end_date
-
-filtered_new_first = new_first_store[new_first_store["設計師"].isin(designer_filter)].copy()
-
-def add_repeat_flags(df, list_map, key_cols, first_col, t2, t3):
-    days2 = []
-    days3 = []
-    repeat2 = []
-    repeat3 = []
-    for _, row in df.iterrows():
-        key = tuple(row[c] for c in key_cols)
-        first_time = row[first_col]
-        if pd.isna(first_time):
-            days2.append(np.nan)
-            days3.append(np.nan)
-            repeat2.append(False)
-            repeat3.append(False)
-            continue
-        first_date = pd.to_datetime(first_time).date()
-        times = list_map.get(key, [])
-        visit_dates = distinct_visit_dates(times)
-        after = [d for d in visit_dates if d > first_date]
-        d2 = (after[0] - first_date).days if len(after) >= 1 else np.nan
-        d3 = (after[1] - first_date).days if len(after) >= 2 else np.nan
-        days2.append(d2)
-        days3.append(d3)
-        repeat2.append(pd.notna(d2) and d2 <= t2)
-        repeat3.append(pd.notna(d3) and d3 <= t3)
-    df["days_to_2nd"] = days2
-    df["days_to_3rd"] = days3
-    df["repeat2"] = repeat2
-    df["repeat3"] = repeat3
-    return df
-
-def zscore_series(series):
-    s = pd.to_numeric(series, errors="coerce")
-    mean = s.mean()
-    std = s.std()
-    if std == 0 or pd.isna(std):
-        return pd.Series(np.nan, index=s.index)
-    return (s - mean) / std
-
-def reliability_factor(n, n0=30):
-    n = pd.to_numeric(n, errors="coerce")
-    return np.where((n > 0) & pd.notna(n), np.minimum(1, np.sqrt(n / n0)), np.nan)
+end_date = view["end_date"]
+new_first_store = view["new_first_store"]
+filtered_new_first = view["filtered_new_first"]
+new_recent_churn = view["new_recent_churn"]
+relationship_first = view["relationship_first"]
+designer_metrics = view["designer_metrics"]
+store_monthly_avg = view["store_monthly_avg"]
+summary_by_store = view["summary_by_store"]
+summary_by_store_designer = view["summary_by_store_designer"]
+vacancy_monthly = view["vacancy_monthly"]
+vacancy_recent = view["vacancy_recent"]
+start_ts_3m = view["start_ts_3m"]
+start_ts_6m = view["start_ts_6m"]
+start_ts_12m = view["start_ts_12m"]
+if not view["has_request"]:
+    st.warning("帳單檔缺少「指定」欄位或無有效值，指定率將不計算。")
 
 def quantile_default(df, col, q, fallback):
     if col not in df.columns:
@@ -807,36 +747,6 @@ def quantile_default(df, col, q, fallback):
         return fallback
     return float(s.quantile(q))
 
-def col_series(df, col):
-    if col in df.columns:
-        return df[col]
-    return pd.Series(np.nan, index=df.index)
-
-def goal_score_high(series, target, floor=0.0):
-    v = pd.to_numeric(series, errors="coerce").astype(float)
-    if pd.isna(target):
-        return pd.Series(np.nan, index=v.index)
-    denom = float(target) - float(floor)
-    if denom <= 0:
-        return pd.Series(np.nan, index=v.index)
-    score = (v - float(floor)) / denom * 100.0
-    return score.clip(lower=0, upper=100)
-
-def goal_score_low(series, target, ceiling=1.0):
-    v = pd.to_numeric(series, errors="coerce").astype(float)
-    if pd.isna(target):
-        return pd.Series(np.nan, index=v.index)
-    denom = float(ceiling) - float(target)
-    if denom <= 0:
-        return pd.Series(np.nan, index=v.index)
-    score = (float(ceiling) - v) / denom * 100.0
-    return score.clip(lower=0, upper=100)
-
-def shrink_to_neutral(score, rel, neutral=50.0):
-    s = pd.to_numeric(score, errors="coerce").astype(float)
-    r = pd.to_numeric(rel, errors="coerce").astype(float)
-    return neutral + (s - neutral) * r
-
 def score_insight(df, score_col, value, tag_mode="generic"):
     if pd.isna(value):
         return None, None, None, None, None
@@ -952,592 +862,6 @@ def build_delta_map(df, selected_name, x_col, y_col, x_label, y_label, x_fmt, y_
     rule_y = alt.Chart(pd.DataFrame({"y": [0]})).mark_rule(color="#d6c9b8").encode(y="y:Q")
     return (rule_x + rule_y + base + highlight).properties(height=320)
 
-def add_regular_metrics(df, list_map, key_cols, baseline_col):
-    regular_counts = []
-    regular_achieved = []
-    regular_dates = []
-    post_regular_visits = []
-    retention_achieved = []
-    for _, row in df.iterrows():
-        key = tuple(row[c] for c in key_cols)
-        baseline_time = row[baseline_col]
-        times = list_map.get(key, [])
-        times = [t for t in times if pd.notna(t)]
-        times.sort()
-        after = [t for t in times if t >= baseline_time]
-        window_end = baseline_time + timedelta(days=REGULAR_DAYS)
-        within = [t for t in after if t <= window_end]
-        count_within = len(within)
-        regular_counts.append(count_within)
-        achieved = count_within >= REGULAR_VISITS
-        regular_achieved.append(achieved)
-        if achieved:
-            reg_date = within[REGULAR_VISITS - 1]
-        else:
-            reg_date = pd.NaT
-        regular_dates.append(reg_date)
-        if achieved:
-            retention_end = reg_date + timedelta(days=RETENTION_DAYS)
-            post = [t for t in after if t > reg_date and t <= retention_end]
-            post_count = len(post)
-            post_regular_visits.append(post_count)
-            retention_achieved.append(post_count >= RETENTION_VISITS)
-        else:
-            post_regular_visits.append(np.nan)
-            retention_achieved.append(np.nan)
-    df["regular_count_180"] = regular_counts
-    df["regular_achieved"] = regular_achieved
-    df["regular_date"] = regular_dates
-    df["post_regular_visits_180"] = post_regular_visits
-    df["retention_achieved"] = retention_achieved
-    return df
-
-checkouts_by_phone_store_designer = (
-    merged_store.groupby(["phone_key", "分店", "設計師"])["結帳操作時間"]
-    .apply(list)
-)
-
-# 建立師傅關係起點（同分店同師傅第一次）
-relationship_first = (
-    merged_store.sort_values("結帳操作時間")
-    .groupby(["phone_key", "分店", "設計師"], as_index=False)
-    .first()
-    .rename(columns={"結帳操作時間": "baseline_time"})
-)
-if not relationship_first.empty:
-    relationship_first = add_regular_metrics(
-        relationship_first,
-        checkouts_by_phone_store_designer,
-        ["phone_key", "分店", "設計師"],
-        "baseline_time",
-    )
-    relationship_first["regular_matured_180"] = (
-        relationship_first["baseline_time"] + pd.Timedelta(days=REGULAR_DAYS) <= end_date
-    )
-    relationship_first["retention_matured_180"] = (
-        relationship_first["regular_date"] + pd.Timedelta(days=RETENTION_DAYS) <= end_date
-    )
-
-new_first_store["matured_2"] = new_first_store["結帳操作時間"] + pd.Timedelta(days=T2_DAYS) <= end_date
-new_first_store["matured_3"] = new_first_store["結帳操作時間"] + pd.Timedelta(days=T3_DAYS) <= end_date
-new_first_store = add_repeat_flags(
-    new_first_store,
-    checkouts_by_phone_store_designer,
-    ["phone_key", "分店", "設計師"],
-    "結帳操作時間",
-    T2_DAYS,
-    T3_DAYS,
-)
-
-end_ts = pd.to_datetime(end_date)
-start_ts_3m = end_ts - pd.DateOffset(months=3)
-start_ts_6m = end_ts - pd.DateOffset(months=6)
-start_ts_12m = end_ts - pd.DateOffset(months=RELATIONSHIP_COHORT_MONTHS)
-
-# 新客經營力（近 3 個月）
-new_recent = new_first_store[new_first_store["結帳操作時間"] >= start_ts_3m].copy()
-new_recent_churn = new_recent[new_recent["matured"]].copy()
-new_churn_by_designer = (
-    new_recent_churn.groupby("設計師")
-    .agg(
-        new_customers_3m=("phone_key", "count"),
-        new_churned_3m=("churn", "sum"),
-    )
-    .reset_index()
-)
-new_churn_by_designer["new_retained_3m"] = (
-    new_churn_by_designer["new_customers_3m"] - new_churn_by_designer["new_churned_3m"]
-)
-new_churn_by_designer["new_churn_rate_3m"] = np.where(
-    new_churn_by_designer["new_customers_3m"] > 0,
-    new_churn_by_designer["new_churned_3m"] / new_churn_by_designer["new_customers_3m"],
-    np.nan,
-)
-
-new_recent2 = new_recent[new_recent["matured_2"]].copy()
-new_by_designer = (
-    new_recent2.groupby("設計師")
-    .agg(
-        new_repeat_base_3m=("phone_key", "count"),
-        new_repeat2_count=("repeat2", "sum"),
-    )
-    .reset_index()
-)
-new_by_designer["new_repeat_rate_3m"] = np.where(
-    new_by_designer["new_repeat_base_3m"] > 0,
-    new_by_designer["new_repeat2_count"] / new_by_designer["new_repeat_base_3m"],
-    np.nan,
-)
-new_by_designer.loc[
-    new_by_designer["new_repeat_base_3m"] < min_repeat_base, "new_repeat_rate_3m"
-] = np.nan
-
-new_recent3 = new_recent[new_recent["matured_3"]].copy()
-new_deep = (
-    new_recent3.groupby("設計師")
-    .agg(new_deep_rate_3m=("repeat3", "mean"), new_deep_n=("repeat3", "count"))
-    .reset_index()
-)
-new_deep.loc[new_deep["new_deep_n"] < min_repeat_base, "new_deep_rate_3m"] = np.nan
-
-# 熟客經營力（近 3 個月，同分店熟客）
-history = merged_store[merged_store["結帳操作時間"] < start_ts_3m]
-familiar_keys = (
-    history.groupby(["phone_key", "分店"])
-    .size()
-    .reset_index(name="visits_before")
-)
-familiar_keys = familiar_keys[familiar_keys["visits_before"] >= 2][["phone_key", "分店"]]
-
-if familiar_keys.empty:
-    familiar_first = pd.DataFrame(columns=["phone_key", "分店", "設計師", "baseline_time"])
-else:
-    familiar_visits = merged_store[merged_store["結帳操作時間"] >= start_ts_3m]
-    familiar_visits = familiar_visits.merge(familiar_keys, on=["phone_key", "分店"], how="inner")
-    familiar_first = (
-        familiar_visits.sort_values("結帳操作時間")
-        .groupby(["phone_key", "分店", "設計師"], as_index=False)
-        .first()
-        .rename(columns={"結帳操作時間": "baseline_time"})
-    )
-
-if not familiar_first.empty:
-    familiar_first["matured_2"] = familiar_first["baseline_time"] + pd.Timedelta(days=T2_DAYS) <= end_date
-    familiar_first["matured_3"] = familiar_first["baseline_time"] + pd.Timedelta(days=T3_DAYS) <= end_date
-    familiar_first = add_repeat_flags(
-        familiar_first,
-        checkouts_by_phone_store_designer,
-        ["phone_key", "分店", "設計師"],
-        "baseline_time",
-        T2_DAYS,
-        T3_DAYS,
-    )
-
-if familiar_first.empty:
-    fam_recent2 = familiar_first.copy()
-    fam_recent3 = familiar_first.copy()
-else:
-    fam_recent2 = familiar_first[familiar_first["matured_2"]].copy()
-    fam_recent3 = familiar_first[familiar_first["matured_3"]].copy()
-fam_by_designer = (
-    fam_recent2.groupby("設計師")
-    .agg(
-        familiar_customers_3m=("phone_key", "count"),
-        familiar_repeat2_count=("repeat2", "sum"),
-    )
-    .reset_index()
-)
-fam_by_designer["familiar_repeat_rate_3m"] = np.where(
-    fam_by_designer["familiar_customers_3m"] > 0,
-    fam_by_designer["familiar_repeat2_count"] / fam_by_designer["familiar_customers_3m"],
-    np.nan,
-)
-fam_by_designer.loc[
-    fam_by_designer["familiar_customers_3m"] < min_repeat_base, "familiar_repeat_rate_3m"
-] = np.nan
-
-fam_deep = (
-    fam_recent3.groupby("設計師")
-    .agg(familiar_deep_rate_3m=("repeat3", "mean"), familiar_deep_n=("repeat3", "count"))
-    .reset_index()
-)
-fam_deep.loc[fam_deep["familiar_deep_n"] < min_repeat_base, "familiar_deep_rate_3m"] = np.nan
-
-# 合併師傅指標
-designer_metrics = (
-    new_churn_by_designer
-    .merge(new_by_designer, on="設計師", how="outer")
-    .merge(new_deep, on="設計師", how="outer")
-    .merge(fam_by_designer, on="設計師", how="outer")
-    .merge(fam_deep, on="設計師", how="outer")
-)
-
-# 近 3 個月總單量
-orders_recent = merged_store[merged_store["結帳操作時間"] >= start_ts_3m].copy()
-orders_summary = (
-    orders_recent.groupby("設計師")
-    .size()
-    .reset_index(name="total_orders_3m")
-)
-designer_metrics = designer_metrics.merge(orders_summary, on="設計師", how="left")
-designer_metrics["new_share_3m"] = np.where(
-    pd.to_numeric(designer_metrics["total_orders_3m"], errors="coerce") > 0,
-    pd.to_numeric(designer_metrics["new_customers_3m"], errors="coerce")
-    / pd.to_numeric(designer_metrics["total_orders_3m"], errors="coerce"),
-    np.nan,
-)
-
-# 出勤狀態（以月份計）
-orders_monthly = merged_store.copy()
-orders_monthly["month_period"] = orders_monthly["結帳操作時間"].dt.to_period("M")
-orders_monthly["date"] = orders_monthly["結帳操作時間"].dt.date
-end_month = end_ts.to_period("M")
-start_month_3m = end_month - 2
-recent_months = orders_monthly[orders_monthly["month_period"] >= start_month_3m]
-active_months_3m = (
-    recent_months.groupby("設計師")["month_period"]
-    .nunique()
-    .reset_index(name="active_months_3m")
-)
-active_days_monthly = (
-    orders_monthly.groupby(["設計師", "month_period"])["date"]
-    .nunique()
-    .reset_index(name="active_days")
-)
-active_days_recent = active_days_monthly[active_days_monthly["month_period"] >= start_month_3m]
-active_days_3m = (
-    active_days_recent.groupby("設計師")["active_days"]
-    .sum()
-    .reset_index(name="active_days_3m")
-)
-avg_active_days_3m = (
-    active_days_recent.groupby("設計師")["active_days"]
-    .sum()
-    .div(3)
-    .reset_index(name="avg_active_days_3m")
-)
-prev_month = end_month - 1
-orders_prev = orders_monthly[orders_monthly["month_period"] == prev_month]
-has_order_prev = (
-    orders_prev.groupby("設計師")
-    .size()
-    .reset_index(name="orders_prev_month")
-)
-has_order_prev["has_order_prev_month"] = has_order_prev["orders_prev_month"] > 0
-last_month = (
-    orders_monthly.groupby("設計師")["month_period"]
-    .max()
-    .reset_index(name="last_order_month")
-)
-last_month["months_since_last"] = last_month["last_order_month"].apply(lambda p: end_month.ordinal - p.ordinal)
-
-attendance_summary = (
-    active_months_3m
-    .merge(active_days_3m, on="設計師", how="left")
-    .merge(avg_active_days_3m, on="設計師", how="left")
-    .merge(has_order_prev[["設計師", "has_order_prev_month"]], on="設計師", how="left")
-    .merge(last_month[["設計師", "months_since_last"]], on="設計師", how="left")
-)
-designer_metrics = designer_metrics.merge(attendance_summary, on="設計師", how="left")
-designer_metrics["new_per_active_day_3m"] = np.where(
-    pd.to_numeric(designer_metrics.get("active_days_3m"), errors="coerce") > 0,
-    pd.to_numeric(designer_metrics.get("new_customers_3m"), errors="coerce")
-    / pd.to_numeric(designer_metrics.get("active_days_3m"), errors="coerce"),
-    np.nan,
-)
-designer_metrics["new_retention_rate_3m"] = np.where(
-    pd.notna(designer_metrics.get("new_churn_rate_3m")),
-    1 - pd.to_numeric(designer_metrics.get("new_churn_rate_3m"), errors="coerce"),
-    np.nan,
-)
-
-# 熟客化/熟客維持（近 12 個月關係起點）
-regular_summary = None
-retention_summary = None
-if not relationship_first.empty:
-    rel_recent = relationship_first[relationship_first["baseline_time"] >= start_ts_12m].copy()
-    regular_base = rel_recent[rel_recent["regular_matured_180"]].copy()
-    if not regular_base.empty:
-        regular_base["regular_achieved_int"] = regular_base["regular_achieved"].fillna(False).astype(int)
-        regular_base["regular_days"] = (regular_base["regular_date"] - regular_base["baseline_time"]).dt.days
-        regular_summary = (
-            regular_base.groupby("設計師")
-            .agg(
-                regular_base_180=("phone_key", "count"),
-                regular_achieved_180=("regular_achieved_int", "sum"),
-                regular_days_avg_180=("regular_days", "mean"),
-            )
-            .reset_index()
-        )
-        regular_summary["regular_rate_180"] = np.where(
-            regular_summary["regular_base_180"] > 0,
-            regular_summary["regular_achieved_180"] / regular_summary["regular_base_180"],
-            np.nan,
-        )
-        designer_metrics = designer_metrics.merge(regular_summary, on="設計師", how="left")
-
-    retention_base = rel_recent[
-        (rel_recent["regular_achieved"] == True) & (rel_recent["retention_matured_180"])
-    ].copy()
-    if not retention_base.empty:
-        retention_base["retention_achieved_int"] = retention_base["retention_achieved"].fillna(False).astype(int)
-        retention_summary = (
-            retention_base.groupby("設計師")
-            .agg(
-                retention_base_180=("phone_key", "count"),
-                retention_achieved_180=("retention_achieved_int", "sum"),
-                post_regular_visits_avg_180=("post_regular_visits_180", "mean"),
-            )
-            .reset_index()
-        )
-        retention_summary["post_regular_visits_monthly_avg_180"] = (
-            retention_summary["post_regular_visits_avg_180"] / 6
-        )
-        retention_summary["retention_rate_180"] = np.where(
-            retention_summary["retention_base_180"] > 0,
-            retention_summary["retention_achieved_180"] / retention_summary["retention_base_180"],
-            np.nan,
-        )
-        designer_metrics = designer_metrics.merge(retention_summary, on="設計師", how="left")
-
-    for col in [
-        "regular_rate_180",
-        "regular_base_180",
-        "regular_achieved_180",
-        "regular_days_avg_180",
-        "retention_rate_180",
-        "retention_base_180",
-        "retention_achieved_180",
-        "post_regular_visits_avg_180",
-        "post_regular_visits_monthly_avg_180",
-    ]:
-        if col not in designer_metrics.columns:
-            designer_metrics[col] = np.nan
-
-# 經營中熟客：已達熟客(180天達5次)但後180天維持觀察期尚未滿
-designer_metrics["in_service_regular_180"] = (
-    pd.to_numeric(designer_metrics["regular_achieved_180"], errors="coerce")
-    - pd.to_numeric(designer_metrics["retention_base_180"], errors="coerce")
-).clip(lower=0)
-
-# 指定率（近 3 個月）
-if "is_requested" in merged_store.columns and merged_store["is_requested"].notna().any():
-    request_recent = merged_store[merged_store["結帳操作時間"] >= start_ts_3m].copy()
-    request_recent["is_requested_num"] = request_recent["is_requested"].map({True: 1, False: 0})
-    request_summary = (
-        request_recent.groupby("設計師")["is_requested_num"]
-        .agg(request_yes_3m="sum", request_total_3m="count")
-        .reset_index()
-    )
-    request_summary["request_rate_3m"] = np.where(
-        request_summary["request_total_3m"] > 0,
-        request_summary["request_yes_3m"] / request_summary["request_total_3m"],
-        np.nan,
-    )
-    designer_metrics = designer_metrics.merge(request_summary, on="設計師", how="left")
-else:
-    designer_metrics["request_rate_3m"] = np.nan
-    designer_metrics["request_yes_3m"] = np.nan
-    designer_metrics["request_total_3m"] = np.nan
-    st.warning("帳單檔缺少「指定」欄位或無有效值，指定率將不計算。")
-
-# Store monthly summary (average per month)
-store_monthly_avg = None
-if has_store:
-    store_month = new_first_store[new_first_store["matured"]].copy()
-    store_month["month"] = store_month["結帳操作時間"].dt.to_period("M").astype(str)
-    month_summary = (
-        store_month.groupby(["分店", "month"])
-        .agg(matured_new_customers=("phone_key", "count"), churned=("churn", "sum"))
-        .reset_index()
-    )
-    month_summary["retained"] = month_summary["matured_new_customers"] - month_summary["churned"]
-    month_summary["repeat_rate"] = np.where(
-        month_summary["matured_new_customers"] > 0,
-        month_summary["retained"] / month_summary["matured_new_customers"],
-        np.nan,
-    )
-    store_monthly_avg = (
-        month_summary.groupby("分店")
-        .agg(
-            月平均新客數=("matured_new_customers", "mean"),
-            月平均流失數=("churned", "mean"),
-            月平均留住數=("retained", "mean"),
-            平均回店率=("repeat_rate", "mean"),
-            月份數=("month", "nunique"),
-        )
-        .reset_index()
-    )
-
-summary_by_store = None
-summary_by_store_designer = None
-if has_store:
-    matured_store = new_first_store[new_first_store["matured"]].copy()
-    summary_by_store = (
-        matured_store.groupby("分店")
-        .agg(
-            matured_new_customers=("phone_key", "count"),
-            churned=("churn", "sum"),
-        )
-        .reset_index()
-    )
-    summary_by_store["churn_rate"] = summary_by_store["churned"] / summary_by_store["matured_new_customers"]
-    summary_by_store["repeat_rate"] = 1 - summary_by_store["churn_rate"]
-
-    summary_by_store_designer = (
-        matured_store[matured_store["設計師"].isin(designer_filter)]
-        .groupby(["分店", "設計師"])
-        .agg(
-            matured_new_customers=("phone_key", "count"),
-            churned=("churn", "sum"),
-        )
-        .reset_index()
-    )
-    summary_by_store_designer["churn_rate"] = (
-        summary_by_store_designer["churned"] / summary_by_store_designer["matured_new_customers"]
-    )
-    summary_by_store_designer["repeat_rate"] = 1 - summary_by_store_designer["churn_rate"]
-
-# Vacancy metrics (monthly, 168h cap)
-vacancy_monthly = None
-vacancy_recent = None
-if "項目" in merged_store.columns:
-    time_df = merged_store.copy()
-    time_df["duration_minutes"] = time_df["項目"].apply(extract_minutes)
-    time_df["duration_hours"] = time_df["duration_minutes"].apply(minutes_to_hours)
-    time_df["month"] = time_df["結帳操作時間"].dt.to_period("M").astype(str)
-    if has_store:
-        group_cols = ["分店", "設計師", "month"]
-    else:
-        group_cols = ["設計師", "month"]
-    vacancy_monthly = (
-        time_df.groupby(group_cols)["duration_hours"]
-        .sum()
-        .reset_index()
-    )
-    vacancy_monthly["vacancy_rate"] = (1 - vacancy_monthly["duration_hours"] / 168.0).clip(lower=0, upper=1)
-    vm = vacancy_monthly.copy()
-    vm["month_start"] = pd.to_datetime(vm["month"] + "-01")
-    vm = vm[vm["month_start"] >= start_ts_3m]
-    vacancy_recent = (
-        vm.groupby("設計師")["vacancy_rate"]
-        .mean()
-        .reset_index()
-        .rename(columns={"vacancy_rate": "vacancy_rate_3m"})
-    )
-    designer_metrics = designer_metrics.merge(vacancy_recent, on="設計師", how="left")
-
-# 業績穩定度（近 6 個月）
-stability_by_designer = None
-stability_df = merged_store.copy()
-stability_df["month"] = stability_df["結帳操作時間"].dt.to_period("M").astype(str)
-stability_df["date"] = stability_df["結帳操作時間"].dt.date
-active_days = (
-    stability_df.groupby(["設計師", "month"])["date"]
-    .nunique()
-    .reset_index(name="active_days")
-)
-active_days["month_start"] = pd.to_datetime(active_days["month"] + "-01")
-active_days_6m = active_days[active_days["month_start"] >= start_ts_6m]
-
-stability_by_designer = (
-    active_days_6m.groupby("設計師")
-    .agg(
-        active_days_avg_6m=("active_days", "mean"),
-        active_days_cv_6m=("active_days", lambda s: s.std() / s.mean() if s.mean() else np.nan),
-        active_months_6m=("month", "nunique"),
-    )
-    .reset_index()
-)
-
-if vacancy_monthly is not None:
-    hours_df = vacancy_monthly.copy()
-    hours_df = hours_df.rename(columns={"duration_hours": "service_hours"})
-    hours_df["month_start"] = pd.to_datetime(hours_df["month"] + "-01")
-    hours_6m = hours_df[hours_df["month_start"] >= start_ts_6m]
-    hours_summary = (
-        hours_6m.groupby("設計師")["service_hours"]
-        .agg(service_hours_avg_6m="mean", service_hours_cv_6m=lambda s: s.std() / s.mean() if s.mean() else np.nan)
-        .reset_index()
-    )
-    stability_by_designer = stability_by_designer.merge(hours_summary, on="設計師", how="left")
-
-last_tx = (
-    merged_store.groupby("設計師")["結帳操作時間"]
-    .max()
-    .reset_index()
-    .rename(columns={"結帳操作時間": "last_tx"})
-)
-last_tx["days_since_last_tx"] = (end_ts - last_tx["last_tx"]).dt.days
-stability_by_designer = stability_by_designer.merge(last_tx, on="設計師", how="left")
-designer_metrics = designer_metrics.merge(stability_by_designer, on="設計師", how="left")
-
-# 四大區塊戰力指標（Z-score + 樣本數修正）
-basic_z = pd.DataFrame({
-    "z_active_days": zscore_series(designer_metrics.get("avg_active_days_3m")),
-    "z_active_days_3m": zscore_series(designer_metrics.get("active_days_3m")),
-    "z_total_orders": zscore_series(designer_metrics.get("total_orders_3m")),
-    "z_vacancy": -zscore_series(designer_metrics.get("vacancy_rate_3m")),
-})
-designer_metrics["basic_z"] = basic_z.mean(axis=1, skipna=True)
-designer_metrics["basic_rel"] = reliability_factor(designer_metrics.get("total_orders_3m"))
-designer_metrics["basic_score"] = designer_metrics["basic_z"] * designer_metrics["basic_rel"]
-designer_metrics["basic_score_0100"] = np.clip(50 + 10 * designer_metrics["basic_score"], 0, 100)
-
-new_acq_z = pd.DataFrame({
-    "z_new_share": zscore_series(designer_metrics.get("new_share_3m")),
-    "z_new_per_day": zscore_series(designer_metrics.get("new_per_active_day_3m")),
-})
-designer_metrics["new_acq_z"] = new_acq_z.mean(axis=1, skipna=True)
-designer_metrics["new_acq_rel"] = reliability_factor(designer_metrics.get("new_customers_3m"))
-designer_metrics["new_acq_score"] = designer_metrics["new_acq_z"] * designer_metrics["new_acq_rel"]
-designer_metrics["new_acq_score_0100"] = np.clip(50 + 10 * designer_metrics["new_acq_score"], 0, 100)
-
-new_ret_z = pd.DataFrame({
-    "z_new_retention": zscore_series(designer_metrics.get("new_retention_rate_3m")),
-})
-designer_metrics["new_ret_z"] = new_ret_z.mean(axis=1, skipna=True)
-designer_metrics["new_ret_rel"] = reliability_factor(designer_metrics.get("new_customers_3m"))
-designer_metrics["new_ret_score"] = designer_metrics["new_ret_z"] * designer_metrics["new_ret_rel"]
-designer_metrics["new_ret_score_0100"] = np.clip(50 + 10 * designer_metrics["new_ret_score"], 0, 100)
-
-convert_z = pd.DataFrame({
-    "z_regular_rate": zscore_series(designer_metrics.get("regular_rate_180")),
-    "z_regular_days": -zscore_series(designer_metrics.get("regular_days_avg_180")),
-})
-designer_metrics["convert_z"] = convert_z.mean(axis=1, skipna=True)
-designer_metrics["convert_rel"] = reliability_factor(designer_metrics.get("regular_base_180"))
-designer_metrics["convert_score"] = designer_metrics["convert_z"] * designer_metrics["convert_rel"]
-designer_metrics["convert_score_0100"] = np.clip(50 + 10 * designer_metrics["convert_score"], 0, 100)
-
-retain_z = pd.DataFrame({
-    "z_retention_rate": zscore_series(designer_metrics.get("retention_rate_180")),
-    "z_post_visits": zscore_series(designer_metrics.get("post_regular_visits_avg_180")),
-})
-designer_metrics["retain_z"] = retain_z.mean(axis=1, skipna=True)
-designer_metrics["retain_rel"] = reliability_factor(designer_metrics.get("retention_base_180"))
-designer_metrics["retain_score"] = designer_metrics["retain_z"] * designer_metrics["retain_rel"]
-designer_metrics["retain_score_0100"] = np.clip(50 + 10 * designer_metrics["retain_score"], 0, 100)
-
-stability_cv = designer_metrics["service_hours_cv_6m"] if "service_hours_cv_6m" in designer_metrics.columns else pd.Series(np.nan, index=designer_metrics.index)
-stability_cv = np.where(pd.notna(stability_cv), stability_cv, designer_metrics.get("active_days_cv_6m"))
-designer_metrics["stability_cv"] = stability_cv
-designer_metrics["stability_z"] = -zscore_series(designer_metrics.get("stability_cv"))
-designer_metrics["stability_rel"] = reliability_factor(designer_metrics.get("active_months_6m"), n0=6)
-designer_metrics["stability_score"] = designer_metrics["stability_z"] * designer_metrics["stability_rel"]
-designer_metrics["stability_score_0100"] = np.clip(50 + 10 * designer_metrics["stability_score"], 0, 100)
-
-block_scores = designer_metrics[
-    ["basic_score", "new_acq_score", "new_ret_score", "convert_score", "retain_score", "stability_score"]
-]
-weights = np.array([1/6, 1/6, 1/6, 1/6, 1/6, 1/6])
-valid_mask = block_scores.notna().values
-weighted = block_scores.fillna(0).values * weights
-weight_sum = (valid_mask * weights).sum(axis=1)
-overall_z = np.where(weight_sum > 0, weighted.sum(axis=1) / weight_sum, np.nan)
-designer_metrics["overall_score_z"] = overall_z
-designer_metrics["overall_score"] = np.clip(50 + 10 * overall_z, 0, 100)
-
-# 目標達成分（0-100，達標=100；並依樣本數修正）
-goal_base = designer_metrics[designer_metrics["設計師"].isin(designer_filter)].copy()
-
-default_target_avg_active_days = 16.5
-default_target_active_days_3m = 50.0
-default_target_total_orders_3m = 188.0
-default_target_vacancy_rate_3m = 0.25
-
-default_target_new_share_3m = 0.15
-default_target_new_per_active_day_3m = 0.35
-default_target_new_retention_rate_3m = 0.60
-
-default_target_regular_rate_180 = 0.18
-default_target_regular_days_avg_180 = 60.0
-default_target_retention_rate_180 = 0.80
-default_target_post_regular_visits_monthly_avg_180 = 1.50
-
-stability_ceiling = 1.0
-default_target_stability_cv = 0.45
-
 with st.sidebar:
     with st.expander("目標達成分設定（可選）", expanded=False):
         st.caption("達標=100 分；未達標依比例扣分。低樣本會往 50 分收斂。")
@@ -1545,27 +869,27 @@ with st.sidebar:
             "每月平均有單天數目標(近3月)",
             min_value=0.0,
             max_value=31.0,
-            value=float(round(default_target_avg_active_days, 1)),
+            value=float(round(DEFAULT_TARGETS["avg_active_days"], 1)),
             step=0.5,
         )
         target_active_days_3m = st.number_input(
             "近3月有單天數目標",
             min_value=0.0,
             max_value=93.0,
-            value=float(round(default_target_active_days_3m, 0)),
+            value=float(round(DEFAULT_TARGETS["active_days_3m"], 0)),
             step=1.0,
         )
         target_total_orders_3m = st.number_input(
             "總單量目標(3M)",
             min_value=0.0,
-            value=float(round(default_target_total_orders_3m, 0)),
+            value=float(round(DEFAULT_TARGETS["total_orders_3m"], 0)),
             step=10.0,
         )
         target_vacancy_rate_3m_pct = st.slider(
             "空窗率目標(3M, 越低越好)",
             min_value=0.0,
             max_value=100.0,
-            value=float(round(default_target_vacancy_rate_3m * 100, 1)),
+            value=float(round(DEFAULT_TARGETS["vacancy_rate_3m"] * 100, 1)),
             step=0.5,
         )
         st.divider()
@@ -1573,20 +897,20 @@ with st.sidebar:
             "新客占比目標(3M)",
             min_value=0.0,
             max_value=100.0,
-            value=float(round(default_target_new_share_3m * 100, 1)),
+            value=float(round(DEFAULT_TARGETS["new_share_3m"] * 100, 1)),
             step=0.5,
         )
         target_new_per_active_day_3m = st.number_input(
             "新客/有單天數目標(3M)",
             min_value=0.0,
-            value=float(round(default_target_new_per_active_day_3m, 2)),
+            value=float(round(DEFAULT_TARGETS["new_per_active_day_3m"], 2)),
             step=0.05,
         )
         target_new_retention_rate_3m_pct = st.slider(
             "新客留存率目標(60天, 同分店)",
             min_value=0.0,
             max_value=100.0,
-            value=float(round(default_target_new_retention_rate_3m * 100, 1)),
+            value=float(round(DEFAULT_TARGETS["new_retention_rate_3m"] * 100, 1)),
             step=0.5,
         )
         st.divider()
@@ -1594,35 +918,35 @@ with st.sidebar:
             "熟客化率目標(180天達≥5次)",
             min_value=0.0,
             max_value=100.0,
-            value=float(round(default_target_regular_rate_180 * 100, 1)),
+            value=float(round(DEFAULT_TARGETS["regular_rate_180"] * 100, 1)),
             step=0.5,
         )
         target_regular_days_avg_180 = st.number_input(
             "平均達標天數目標(越低越好)",
             min_value=1.0,
             max_value=float(REGULAR_DAYS),
-            value=float(round(default_target_regular_days_avg_180, 0)),
+            value=float(round(DEFAULT_TARGETS["regular_days_avg_180"], 0)),
             step=5.0,
         )
         target_retention_rate_180_pct = st.slider(
             "熟客維持率目標(後180天≥3次)",
             min_value=0.0,
             max_value=100.0,
-            value=float(round(default_target_retention_rate_180 * 100, 1)),
+            value=float(round(DEFAULT_TARGETS["retention_rate_180"] * 100, 1)),
             step=0.5,
         )
         target_post_regular_visits_monthly_avg_180 = st.number_input(
             "熟客月均回訪次數目標(後180天)",
             min_value=0.0,
-            value=float(round(default_target_post_regular_visits_monthly_avg_180, 2)),
+            value=float(round(DEFAULT_TARGETS["post_regular_visits_monthly_avg_180"], 2)),
             step=0.1,
         )
         st.divider()
         target_stability_cv = st.number_input(
             "業績穩定度目標(CV, 越低越好)",
             min_value=0.0,
-            max_value=float(stability_ceiling),
-            value=float(round(default_target_stability_cv, 2)),
+            max_value=float(STABILITY_CEILING),
+            value=float(round(DEFAULT_TARGETS["stability_cv"], 2)),
             step=0.05,
         )
 
@@ -1632,69 +956,25 @@ target_new_retention_rate_3m = float(target_new_retention_rate_3m_pct) / 100.0
 target_regular_rate_180 = float(target_regular_rate_180_pct) / 100.0
 target_retention_rate_180 = float(target_retention_rate_180_pct) / 100.0
 
-basic_goal_components = pd.DataFrame({
-    "g_avg_active_days": goal_score_high(col_series(designer_metrics, "avg_active_days_3m"), target_avg_active_days, floor=0.0),
-    "g_active_days_3m": goal_score_high(col_series(designer_metrics, "active_days_3m"), target_active_days_3m, floor=0.0),
-    "g_total_orders": goal_score_high(col_series(designer_metrics, "total_orders_3m"), target_total_orders_3m, floor=0.0),
-    "g_vacancy": goal_score_low(col_series(designer_metrics, "vacancy_rate_3m"), target_vacancy_rate_3m, ceiling=1.0),
-})
-designer_metrics["basic_goal_raw"] = basic_goal_components.mean(axis=1, skipna=True)
-designer_metrics["basic_goal_0100"] = shrink_to_neutral(designer_metrics["basic_goal_raw"], designer_metrics.get("basic_rel"))
-
-new_acq_goal_components = pd.DataFrame({
-    "g_new_share": goal_score_high(col_series(designer_metrics, "new_share_3m"), target_new_share_3m, floor=0.0),
-    "g_new_per_day": goal_score_high(col_series(designer_metrics, "new_per_active_day_3m"), target_new_per_active_day_3m, floor=0.0),
-})
-designer_metrics["new_acq_goal_raw"] = new_acq_goal_components.mean(axis=1, skipna=True)
-designer_metrics["new_acq_goal_0100"] = shrink_to_neutral(designer_metrics["new_acq_goal_raw"], designer_metrics.get("new_acq_rel"))
-
-designer_metrics["new_ret_goal_raw"] = goal_score_high(col_series(designer_metrics, "new_retention_rate_3m"), target_new_retention_rate_3m, floor=0.0)
-designer_metrics["new_ret_goal_0100"] = shrink_to_neutral(designer_metrics["new_ret_goal_raw"], designer_metrics.get("new_ret_rel"))
-
-convert_goal_components = pd.DataFrame({
-    "g_regular_rate": goal_score_high(col_series(designer_metrics, "regular_rate_180"), target_regular_rate_180, floor=0.0),
-    "g_regular_days": goal_score_low(col_series(designer_metrics, "regular_days_avg_180"), target_regular_days_avg_180, ceiling=float(REGULAR_DAYS)),
-})
-designer_metrics["convert_goal_raw"] = convert_goal_components.mean(axis=1, skipna=True)
-designer_metrics["convert_goal_0100"] = shrink_to_neutral(designer_metrics["convert_goal_raw"], designer_metrics.get("convert_rel"))
-
-retain_goal_components = pd.DataFrame({
-    "g_retention_rate": goal_score_high(col_series(designer_metrics, "retention_rate_180"), target_retention_rate_180, floor=0.0),
-    "g_post_visits": goal_score_high(col_series(designer_metrics, "post_regular_visits_monthly_avg_180"), target_post_regular_visits_monthly_avg_180, floor=0.0),
-})
-designer_metrics["retain_goal_raw"] = retain_goal_components.mean(axis=1, skipna=True)
-designer_metrics["retain_goal_0100"] = shrink_to_neutral(designer_metrics["retain_goal_raw"], designer_metrics.get("retain_rel"))
-
-designer_metrics["stability_goal_raw"] = goal_score_low(col_series(designer_metrics, "stability_cv"), target_stability_cv, ceiling=float(stability_ceiling))
-designer_metrics["stability_goal_0100"] = shrink_to_neutral(designer_metrics["stability_goal_raw"], designer_metrics.get("stability_rel"))
-
-goal_blocks = designer_metrics[
-    ["basic_goal_0100", "new_acq_goal_0100", "new_ret_goal_0100", "convert_goal_0100", "retain_goal_0100", "stability_goal_0100"]
-]
-# 將戰力指標權重調整：暫時不計入「新客獲取量」以避免偏差
-goal_weights = np.array([1/5, 1/5, 0, 1/5, 1/5, 1/5])
-goal_valid = goal_blocks.notna().values
-goal_weighted = goal_blocks.fillna(0).values * goal_weights
-goal_weight_sum = (goal_valid * goal_weights).sum(axis=1)
-designer_metrics["overall_goal_0100"] = np.where(goal_weight_sum > 0, goal_weighted.sum(axis=1) / goal_weight_sum, np.nan)
+goal_targets = {
+    "avg_active_days": target_avg_active_days,
+    "active_days_3m": target_active_days_3m,
+    "total_orders_3m": target_total_orders_3m,
+    "vacancy_rate_3m": target_vacancy_rate_3m,
+    "new_share_3m": target_new_share_3m,
+    "new_per_active_day_3m": target_new_per_active_day_3m,
+    "new_retention_rate_3m": target_new_retention_rate_3m,
+    "regular_rate_180": target_regular_rate_180,
+    "regular_days_avg_180": target_regular_days_avg_180,
+    "retention_rate_180": target_retention_rate_180,
+    "post_regular_visits_monthly_avg_180": target_post_regular_visits_monthly_avg_180,
+    "stability_cv": target_stability_cv,
+}
+designer_metrics = add_goal_scores(designer_metrics, goal_targets)
 
 designer_metrics_filtered = designer_metrics[designer_metrics["設計師"].isin(designer_filter)].copy()
 
-overall = {
-    "matured_new_customers": int(len(new_first_store[new_first_store["matured"]])),
-    "churned_matured": int(new_first_store.loc[new_first_store["matured"], "churn"].sum()),
-}
-overall["retained_matured"] = overall["matured_new_customers"] - overall["churned_matured"]
-overall["churn_rate_matured"] = (
-    overall["churned_matured"] / overall["matured_new_customers"]
-    if overall["matured_new_customers"]
-    else None
-)
-overall["repeat_rate_matured"] = (
-    1 - overall["churn_rate_matured"]
-    if overall["churn_rate_matured"] is not None
-    else None
-)
+overall = overall_summary(new_first_store)
 
 st.subheader("總覽摘要")
 col1, col2, col3, col4, col5 = st.columns(5)
@@ -1839,6 +1119,48 @@ render_bar_chart(
     ascending=metric_asc,
 )
 
+st.subheader("師傅指標歷史（月底）")
+st.caption(f"近 {HISTORY_MONTHS} 個月每月的師傅指標，截止於該月最後一筆結帳（最後一點為資料截止日），口徑與上方相同；戰力分數的 Z-score 為同月師傅間比較。")
+history_table = None
+if st.checkbox(f"計算近 {HISTORY_MONTHS} 個月歷史（並加入 Excel 報表）", value=False):
+    history = designer_history_cached(
+        base_model,
+        base_model.get("fingerprint") or base_fingerprint(base_model),
+        None if store_filter is None else tuple(store_filter),
+        min_repeat_base,
+    )
+    history = add_goal_scores(history, goal_targets)
+    history = history[history["設計師"].isin(designer_filter)].copy()
+    history_table = designer_history_table(history, designer_filter)
+    history["業績穩定度(CV)"] = history["stability_cv"]
+    history_choice = st.selectbox("歷史指標", list(metric_options.keys()))
+    history_col, history_fmt, _ = metric_options[history_choice]
+    # 預設比較最新一期戰力指標最高的幾位
+    latest = history[history["end_date"] == history["end_date"].max()]
+    history_options = latest.sort_values("overall_goal_0100", ascending=False)["設計師"].astype(str).tolist()
+    history_pick = st.multiselect("歷史比較師傅", history_options, default=history_options[:5])
+    history_view = history.loc[history["設計師"].astype(str).isin(history_pick), ["end_date", "設計師", history_col]].dropna()
+    if history_view.empty:
+        st.info("所選師傅在此期間沒有這項指標。")
+    else:
+        history_view["設計師"] = history_view["設計師"].astype(str)
+        hover = alt.selection_point(fields=["end_date"], nearest=True, on="mouseover", empty=False)
+        base = alt.Chart(history_view).encode(
+            x=alt.X("end_date:T", title="月份", axis=alt.Axis(format="%Y-%m")),
+            y=alt.Y(f"{history_col}:Q", axis=alt.Axis(format=_fmt_alt(history_fmt)), title=history_choice),
+            color=alt.Color("設計師:N", title="師傅"),
+        )
+        points = base.mark_circle(size=50).encode(
+            opacity=alt.condition(hover, alt.value(1), alt.value(0.4)),
+            tooltip=[
+                alt.Tooltip("設計師:N", title="師傅"),
+                alt.Tooltip("end_date:T", title="截止日", format="%Y-%m-%d"),
+                alt.Tooltip(f"{history_col}:Q", title=history_choice, format=_fmt_alt(history_fmt)),
+            ],
+        ).add_params(hover)
+        hover_rule = alt.Chart(history_view).mark_rule(color="#bdbdbd").encode(x="end_date:T").transform_filter(hover)
+        st.altair_chart((base.mark_line() + points + hover_rule).properties(height=320), use_container_width=True)
+
 st.subheader("個別師傅狀態")
 st.caption("新客＝全品牌首次；回店口徑＝同分店；熟客＝180 天內同分店同師傅消費 ≥5 次。")
 
@@ -1852,8 +1174,8 @@ else:
         st.info("此師傅在最近 3 個月內沒有足夠資料。")
     else:
         r = selected_row.iloc[0]
-        detail_recent = new_recent_churn[new_recent_churn["設計師"] == designer_select].copy()
-        rel_all = relationship_first[relationship_first["設計師"] == designer_select].copy()
+        detail_recent = attach_members(new_recent_churn[new_recent_churn["設計師"] == designer_select], base_model["members"])
+        rel_all = attach_members(relationship_first[relationship_first["設計師"] == designer_select], base_model["members"])
         st.markdown("**戰力指標**")
         row1 = st.columns(1)
         with row1[0]:
@@ -2315,7 +1637,7 @@ else:
         if vacancy_monthly is not None:
             cv_monthly = vacancy_monthly.copy()
             cv_monthly = cv_monthly.rename(columns={"duration_hours": "service_hours"})
-            cv_monthly["month_start"] = pd.to_datetime(cv_monthly["month"] + "-01")
+            cv_monthly["month_start"] = month_starts(cv_monthly["month"])
             cv_monthly = cv_monthly[cv_monthly["month_start"] >= start_ts_6m]
             cv_monthly = cv_monthly[cv_monthly["設計師"] == designer_select]
             if not cv_monthly.empty:
@@ -2532,6 +1854,63 @@ else:
     )
     st.altair_chart(hist + rules + labels, use_container_width=True)
 
+st.subheader("門檻試算（流失 / 回指天數）")
+st.caption("以全部新客在各門檻天數下重算：滿期新客為首購到資料截止已滿門檻天數者；流失看同分店回店，回指看同分店同師傅第 2 / 3 次。虛線為目前採用的門檻。")
+sweep_metrics = {
+    "流失率": ("churn_rate", CHURN_DAYS),
+    "第2次回指率": ("repeat2_rate", T2_DAYS),
+    "第3次回指率": ("repeat3_rate", T3_DAYS),
+}
+sweep_groups = ["全部", "依分店", "依師傅"] if has_store else ["全部", "依師傅"]
+sc1, sc2 = st.columns(2)
+sweep_metric = sc1.radio("試算指標", list(sweep_metrics), horizontal=True)
+sweep_group = sc2.radio("試算分組", sweep_groups, horizontal=True)
+sweep = window_sweep(new_first_store, end_date)
+if sweep_group == "依師傅":
+    sweep_key = "設計師"
+    sweep = sweep[sweep["設計師"].isin(designer_filter)]
+elif sweep_group == "依分店":
+    sweep_key = "分店"
+else:
+    sweep_key = None
+sweep_df = sweep_rates(sweep, [] if sweep_key is None else [sweep_key])
+if sweep_key is None:
+    sweep_key = "組別"
+    sweep_df[sweep_key] = "全部"
+else:
+    sweep_df[sweep_key] = sweep_df[sweep_key].astype(str)
+    sweep_options = (
+        sweep_df.groupby(sweep_key)["matured_new_customers"].max().sort_values(ascending=False).index.tolist()
+    )
+    sweep_pick = st.multiselect(f"比較{'師傅' if sweep_key == '設計師' else '分店'}", sweep_options, default=sweep_options[:8])
+    sweep_df = sweep_df[sweep_df[sweep_key].isin(sweep_pick)]
+
+rate_col, current_days = sweep_metrics[sweep_metric]
+if sweep_df.empty:
+    st.info("目前沒有可試算的新客資料。")
+else:
+    sweep_df = sweep_df.rename(columns={"window_days": "門檻天數", rate_col: sweep_metric, "matured_new_customers": "滿期新客數"})
+    # 滑鼠移到任一門檻，顯示該門檻各組的比率與滿期新客數
+    hover = alt.selection_point(fields=["門檻天數"], nearest=True, on="mouseover", empty=False)
+    base = alt.Chart(sweep_df).encode(
+        x=alt.X("門檻天數:Q", title="門檻天數(天)"),
+        y=alt.Y(f"{sweep_metric}:Q", axis=alt.Axis(format=".0%"), title=sweep_metric),
+        color=alt.Color(f"{sweep_key}:N", title=sweep_key),
+    )
+    lines = base.mark_line()
+    points = base.mark_circle(size=50).encode(
+        opacity=alt.condition(hover, alt.value(1), alt.value(0)),
+        tooltip=[
+            sweep_key,
+            "門檻天數:Q",
+            alt.Tooltip(f"{sweep_metric}:Q", format=".2%"),
+            alt.Tooltip("滿期新客數:Q", format=",.0f"),
+        ],
+    ).add_params(hover)
+    hover_rule = alt.Chart(sweep_df).mark_rule(color="#bdbdbd").encode(x="門檻天數:Q").transform_filter(hover)
+    current_rule = alt.Chart(pd.DataFrame({"門檻天數": [current_days]})).mark_rule(color="#f28e2b", strokeDash=[4, 4]).encode(x="門檻天數:Q")
+    st.altair_chart((lines + points + hover_rule + current_rule).properties(height=320), use_container_width=True)
+
 st.subheader("詳細表格")
 st.caption("依照你的篩選條件，以下是完整明細表格。")
 store_table = None
@@ -2544,125 +1923,18 @@ if designer_metrics_filtered.empty:
     st.info("目前沒有足夠的近 3 月資料。")
     designer_table = None
 else:
-    designer_table = designer_metrics_filtered.copy()
-    service_cv = designer_table["service_hours_cv_6m"] if "service_hours_cv_6m" in designer_table.columns else pd.Series(np.nan, index=designer_table.index)
-    active_cv = designer_table["active_days_cv_6m"] if "active_days_cv_6m" in designer_table.columns else pd.Series(np.nan, index=designer_table.index)
-    designer_table["業績穩定度(CV)"] = np.where(service_cv.notna(), service_cv, active_cv)
-    designer_table = designer_table.rename(
-        columns={
-            "設計師": "師傅",
-            "overall_goal_0100": "戰力指標(0-100)",
-            "basic_goal_0100": "基本狀態(0-100)",
-            "new_acq_goal_0100": "新客獲取量(0-100)",
-            "new_ret_goal_0100": "新客留存力(0-100)",
-            "convert_goal_0100": "熟客轉化力(0-100)",
-            "retain_goal_0100": "熟客經營力(0-100)",
-            "stability_goal_0100": "業績穩定度(0-100)",
-            "new_share_3m": "新客占比(新客/總單量)",
-            "new_per_active_day_3m": "新客/有單天數(3M)",
-            "new_customers_3m": "新客數(3M,滿60天)",
-            "new_churn_rate_3m": "新客流失率(60天)",
-            "new_retention_rate_3m": "新客留存率(60天)",
-            "total_orders_3m": "總單量(3M)",
-            "new_churned_3m": "流失人數(3M)",
-            "new_retained_3m": "留住人數(3M)",
-            "new_repeat_rate_3m": "新客回指率(30天)",
-            "new_repeat_base_3m": "新客回指樣本數(30天)",
-            "new_deep_rate_3m": "新客深度回指率(60天)",
-            "new_deep_n": "新客深度回指樣本數(60天)",
-            "familiar_repeat_rate_3m": "熟客回指率(30天)",
-            "familiar_customers_3m": "熟客回指樣本數(30天)",
-            "familiar_deep_rate_3m": "熟客深度回指率(60天)",
-            "familiar_deep_n": "熟客深度回指樣本數(60天)",
-            "avg_active_days_3m": "每月平均有單天數(近3月)",
-            "active_days_3m": "近3月有單天數",
-            "regular_rate_180": "熟客化率(180天達5次)",
-            "regular_base_180": "熟客化樣本數(滿180天)",
-            "regular_achieved_180": "熟客化達標人數",
-            "regular_days_avg_180": "平均達標天數",
-            "retention_rate_180": "熟客維持率(後180天≥3次)",
-            "retention_base_180": "熟客維持樣本數(滿後180天)",
-            "retention_achieved_180": "熟客維持達標人數",
-            "post_regular_visits_avg_180": "後180天平均回訪次數",
-            "post_regular_visits_monthly_avg_180": "熟客月均回訪次數(後180天)",
-            "request_rate_3m": "指定率(3M)",
-            "request_yes_3m": "指定單數(3M)",
-            "request_total_3m": "總單數(3M)",
-            "vacancy_rate_3m": "空窗率(3M)",
-            "days_since_last_tx": "最近有單距今(天)",
-        }
-    )
-    cols = [
-        "師傅",
-        "戰力指標(0-100)",
-        "基本狀態(0-100)",
-        "新客獲取量(0-100)",
-        "新客留存力(0-100)",
-        "熟客轉化力(0-100)",
-        "熟客經營力(0-100)",
-        "業績穩定度(0-100)",
-        "新客占比(新客/總單量)",
-        "新客/有單天數(3M)",
-        "新客數(3M,滿60天)",
-        "新客流失率(60天)",
-        "新客留存率(60天)",
-        "流失人數(3M)",
-        "留住人數(3M)",
-        "新客回指率(30天)",
-        "新客回指樣本數(30天)",
-        "新客深度回指率(60天)",
-        "新客深度回指樣本數(60天)",
-        "熟客回指率(30天)",
-        "熟客回指樣本數(30天)",
-        "熟客深度回指率(60天)",
-        "熟客深度回指樣本數(60天)",
-        "總單量(3M)",
-        "每月平均有單天數(近3月)",
-        "近3月有單天數",
-        "熟客化率(180天達5次)",
-        "熟客化樣本數(滿180天)",
-        "熟客化達標人數",
-        "平均達標天數",
-        "熟客維持率(後180天≥3次)",
-        "熟客維持樣本數(滿後180天)",
-        "熟客維持達標人數",
-        "後180天平均回訪次數",
-        "熟客月均回訪次數(後180天)",
-        "指定率(3M)",
-        "指定單數(3M)",
-        "總單數(3M)",
-        "空窗率(3M)",
-        "業績穩定度(CV)",
-    ]
-    cols = [c for c in cols if c in designer_table.columns]
+    designer_table = designer_report_table(designer_metrics_filtered)
+    cols = [c for c in DESIGNER_TABLE_COLUMNS if c in designer_table.columns]
     st.dataframe(designer_table[cols].sort_values("新客流失率(60天)", ascending=True), use_container_width=True)
     st.caption("業績穩定度：若缺少項目分鐘，將以出勤 CV 代替工時 CV。")
 
 # 分店彙總
 if has_store:
     st.markdown("**分店彙總**")
-    store_table = summary_by_store.rename(
-        columns={
-            "分店": "分店",
-            "matured_new_customers": "滿60天新客數",
-            "churned": "流失數",
-            "churn_rate": "流失率",
-            "repeat_rate": "回店率",
-        }
-    )
+    store_table, store_designer_table = store_report_tables(summary_by_store, summary_by_store_designer)
     st.dataframe(store_table.sort_values("流失率", ascending=False), use_container_width=True)
 
     st.markdown("**分店 x 師傅彙總**")
-    store_designer_table = summary_by_store_designer.rename(
-        columns={
-            "分店": "分店",
-            "設計師": "師傅",
-            "matured_new_customers": "滿60天新客數",
-            "churned": "流失數",
-            "churn_rate": "流失率",
-            "repeat_rate": "回店率",
-        }
-    )
     st.dataframe(store_designer_table.sort_values("流失率", ascending=False), use_container_width=True)
 
 # 空窗率（月，168 小時上限）
@@ -2670,66 +1942,23 @@ st.markdown("**空窗率（月，168 小時上限）**")
 if vacancy_monthly is None:
     st.warning("帳單檔缺少 '項目' 欄位，無法估算服務時數與空窗率。")
 else:
-    display_vacancy = vacancy_monthly.copy()
-    if has_store and store_filter is not None:
-        display_vacancy = display_vacancy[display_vacancy["分店"].isin(store_filter)]
-    display_vacancy = display_vacancy[display_vacancy["設計師"].isin(designer_filter)]
-    display_vacancy = display_vacancy.rename(
-        columns={
-            "分店": "分店",
-            "設計師": "師傅",
-            "month": "月份",
-            "duration_hours": "服務時數",
-            "vacancy_rate": "空窗率",
-        }
-    )
+    display_vacancy = vacancy_report_table(vacancy_monthly, store_filter, designer_filter)
     st.dataframe(display_vacancy.sort_values(["月份", "師傅"]), use_container_width=True)
 
 # 流失名單
 st.markdown("**流失名單**")
 show_churned_only = st.checkbox("只看流失者", value=True)
 
-if show_churned_only:
-    detail = filtered_new_first[filtered_new_first["churn"]].copy()
-else:
-    detail = filtered_new_first.copy()
-
-if has_store and store_filter is not None:
-    detail = detail[detail["分店"].isin(store_filter)]
-detail = detail[detail["設計師"].isin(designer_filter)]
-
-detail_display = detail.copy()
-detail_display["是否滿期"] = detail_display["matured"].map({True: "是", False: "否"})
-detail_display["是否流失"] = detail_display["churn"].map({True: "是", False: "否"})
-detail_display["電話"] = detail_display["phone_key"]
-detail_display = detail_display.rename(columns={"設計師": "師傅", "結帳操作時間": "首單時間"})
-
-display_cols = ["電話", name_col, "分店", "師傅", "首單時間", "是否滿期", "是否流失"]
-display_cols = [c for c in display_cols if c in detail_display.columns]
+detail_display, display_cols = churn_detail_table(
+    filtered_new_first, name_col, store_filter, designer_filter, show_churned_only, base_model["members"]
+)
 st.dataframe(detail_display[display_cols].sort_values("首單時間"), use_container_width=True)
 
 # Download Excel
 st.subheader("下載報表")
 
 output = BytesIO()
-overall_df = pd.DataFrame([{
-    "滿60天新客數": overall["matured_new_customers"],
-    "流失人數": overall["churned_matured"],
-    "留住人數": overall["retained_matured"],
-    "流失率": overall["churn_rate_matured"],
-    "回店率": overall["repeat_rate_matured"],
-}])
-with pd.ExcelWriter(output, engine="openpyxl") as writer:
-    overall_df.to_excel(writer, index=False, sheet_name="總覽")
-    if designer_table is not None:
-        designer_table.to_excel(writer, index=False, sheet_name="師傅彙總(3M)")
-    if store_table is not None:
-        store_table.to_excel(writer, index=False, sheet_name="分店彙總")
-    if store_designer_table is not None:
-        store_designer_table.to_excel(writer, index=False, sheet_name="分店師傅彙總")
-    detail_display[display_cols].to_excel(writer, index=False, sheet_name="流失名單")
-    if display_vacancy is not None:
-        display_vacancy.to_excel(writer, index=False, sheet_name="空窗率(月)")
+write_excel_report(output, overall, designer_table, store_table, store_designer_table, detail_display[display_cols], display_vacancy, history_table)
 
 st.download_button(
     label="下載 Excel",
@@ -2737,3 +1966,26 @@ st.download_button(
     file_name="customer_relationship_analysis.xlsx",
     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
 )
+
+if profile_enabled:
+    # 快取命中的階段不會出現；只列出這次重跑實際執行的部分
+    profile_records = stop_profiling()
+    append_profile_log(profile_records, {
+        "source": "app",
+        "mode": compute_mode,
+        "bill_files": len(bill_files or []),
+        "rows": len(merged),
+        "stores": None if store_filter is None else len(store_filter),
+        "designers": len(designer_filter),
+    })
+    with st.sidebar:
+        with st.expander("效能紀錄", expanded=False):
+            if profile_records:
+                st.dataframe(
+                    pd.DataFrame(profile_table(profile_records)).style.format({"秒數": "{:.3f}", "峰值記憶體(MB)": "{:.0f}"}),
+                    use_container_width=True,
+                    hide_index=True,
+                )
+            else:
+                st.caption("這次重跑全部使用快取，沒有執行任何計算階段。")
+
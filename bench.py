@@ -0,0 +1,326 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+# 讀檔快取與服務時長對照表指向暫存資料夾，量到的是冷讀，也不會用到使用者的覆寫
+_CACHE_TMP = tempfile.TemporaryDirectory(prefix="bench-cache-")
+os.environ["BILL_CACHE_DIR"] = os.path.join(_CACHE_TMP.name, "bills")
+os.environ["ITEM_MINUTES_DIR"] = os.path.join(_CACHE_TMP.name, "items")
+
+import numpy as np
+import pandas as pd
+
+from bill_io import load_bills
+from analytics import (
+    CHURN_DAYS,
+    REGULAR_DAYS,
+    REGULAR_VISITS,
+    RETENTION_DAYS,
+    RETENTION_VISITS,
+    T2_DAYS,
+    T3_DAYS,
+    add_block_scores,
+    add_goal_scores,
+    add_regular_metrics,
+    add_repeat_flags,
+    add_store_return_flags,
+    activity_cube,
+    compute_view,
+    designer_history,
+    rollup_activity,
+    derive_base_model,
+    prepare_checkouts,
+    prepare_members,
+    stability_metrics,
+    store_partials,
+    vacancy_from_activity,
+    visit_index,
+    window_sweep,
+)
+from synthetic import synthetic_bills, synthetic_members, write_store_workbooks
+
+# 效能量測：以合成帳單逐段計時各管線階段，結果存成 JSON 供前後版本比較
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000, 5_000_000]
+KEY_COLS = ["phone_key", "分店", "設計師"]
+
+def peak_rss_mb():
+    # Linux 的 ru_maxrss 單位為 KB，macOS 為 bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def timed(stages, name, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    stages[name] = round(time.perf_counter() - start, 4)
+    return result
+
+def first_checkouts(merged):
+    merged_sorted = merged.sort_values("結帳操作時間", kind="stable").reset_index(drop=True)
+    new_first = merged_sorted.groupby("phone_key", as_index=False, observed=True).first()
+    return merged_sorted, new_first
+
+def distinct_visit_dates(times):
+    dates = set()
+    for t in times:
+        if pd.isna(t):
+            continue
+        ts = pd.to_datetime(t, errors="coerce")
+        if pd.isna(ts):
+            continue
+        dates.add(ts.date())
+    return sorted(dates)
+
+def store_return_loop(new_first, merged_sorted, churn_days):
+    # 改版前的逐列迴圈（同分店回店），作為 add_store_return_flags 的對照組與比對基準
+    checkouts_by_phone_store = merged_sorted.groupby(["phone_key", "分店"], observed=True)["結帳操作時間"].apply(list)
+    churn_flags = []
+    return_days_store = []
+    for _, row in new_first.iterrows():
+        pk = row["phone_key"]
+        store = row.get("分店")
+        first_time = row["結帳操作時間"]
+        if pd.isna(first_time):
+            return_days_store.append(np.nan)
+            churn_flags.append(True)
+            continue
+        first_date = pd.to_datetime(first_time).date()
+        times = checkouts_by_phone_store.get((pk, store), [])
+        visit_dates = distinct_visit_dates(times)
+        next_dates = [d for d in visit_dates if d > first_date]
+        next_date = next_dates[0] if next_dates else None
+        if next_date is not None:
+            return_days = (next_date - first_date).days
+            return_days_store.append(return_days)
+            churn_flags.append(return_days > churn_days)
+        else:
+            return_days_store.append(np.nan)
+            churn_flags.append(True)
+    new_first = new_first.copy()
+    new_first["return_days_store"] = return_days_store
+    new_first["churn"] = churn_flags
+    return new_first
+
+def repeat_loop(new_first, merged_sorted, t2, t3):
+    # 改版前的逐列迴圈（同分店同師傅第 2、3 次來店），作為 add_repeat_flags 的對照組與比對基準
+    checkouts_by_key = merged_sorted.groupby(KEY_COLS, observed=True)["結帳操作時間"].apply(list)
+    days2 = []
+    days3 = []
+    repeat2 = []
+    repeat3 = []
+    for _, row in new_first.iterrows():
+        key = tuple(row[c] for c in KEY_COLS)
+        first_time = row["結帳操作時間"]
+        if pd.isna(first_time):
+            days2.append(np.nan)
+            days3.append(np.nan)
+            repeat2.append(False)
+            repeat3.append(False)
+            continue
+        first_date = pd.to_datetime(first_time).date()
+        visit_dates = distinct_visit_dates(checkouts_by_key.get(key, []))
+        after = [d for d in visit_dates if d > first_date]
+        d2 = (after[0] - first_date).days if len(after) >= 1 else np.nan
+        d3 = (after[1] - first_date).days if len(after) >= 2 else np.nan
+        days2.append(d2)
+        days3.append(d3)
+        repeat2.append(pd.notna(d2) and d2 <= t2)
+        repeat3.append(pd.notna(d3) and d3 <= t3)
+    new_first = new_first.copy()
+    new_first["days_to_2nd"] = days2
+    new_first["days_to_3rd"] = days3
+    new_first["repeat2"] = repeat2
+    new_first["repeat3"] = repeat3
+    return new_first
+
+def regular_loop(relationship_first, merged_sorted):
+    # 改版前的逐列迴圈（熟客達標與達標後回訪），作為 add_regular_metrics 的對照組與比對基準
+    checkouts_by_key = merged_sorted.groupby(KEY_COLS, observed=True)["結帳操作時間"].apply(list)
+    regular_counts = []
+    regular_achieved = []
+    regular_dates = []
+    post_regular_visits = []
+    retention_achieved = []
+    for _, row in relationship_first.iterrows():
+        key = tuple(row[c] for c in KEY_COLS)
+        baseline_time = row["baseline_time"]
+        times = sorted(t for t in checkouts_by_key.get(key, []) if pd.notna(t))
+        after = [t for t in times if t >= baseline_time]
+        window_end = baseline_time + timedelta(days=REGULAR_DAYS)
+        within = [t for t in after if t <= window_end]
+        achieved = len(within) >= REGULAR_VISITS
+        regular_counts.append(len(within))
+        regular_achieved.append(achieved)
+        if achieved:
+            reg_date = within[REGULAR_VISITS - 1]
+            retention_end = reg_date + timedelta(days=RETENTION_DAYS)
+            post = [t for t in after if t > reg_date and t <= retention_end]
+            regular_dates.append(reg_date)
+            post_regular_visits.append(len(post))
+            retention_achieved.append(len(post) >= RETENTION_VISITS)
+        else:
+            regular_dates.append(pd.NaT)
+            post_regular_visits.append(np.nan)
+            retention_achieved.append(np.nan)
+    relationship_first = relationship_first.copy()
+    relationship_first["regular_count_180"] = regular_counts
+    relationship_first["regular_achieved"] = regular_achieved
+    relationship_first["regular_date"] = regular_dates
+    relationship_first["post_regular_visits_180"] = post_regular_visits
+    relationship_first["retention_achieved"] = retention_achieved
+    return relationship_first
+
+def visit_indexes(merged_sorted):
+    return visit_index(merged_sorted, ["phone_key", "分店"]), visit_index(merged_sorted, KEY_COLS)
+
+def regular_metrics(merged_sorted, index):
+    relationship_first = (
+        merged_sorted
+        .groupby(KEY_COLS, as_index=False, observed=True)
+        .first()
+        .rename(columns={"結帳操作時間": "baseline_time"})
+    )
+    return add_regular_metrics(relationship_first, index, "baseline_time")
+
+def vacancy(merged_sorted):
+    # 每月活動 cube（出勤、穩定度也由它彙總）與由它導出的空窗率
+    activity = activity_cube(merged_sorted, ["分店", "設計師", "month"])
+    return activity, vacancy_from_activity(activity, ["分店", "設計師", "month"])
+
+def stability(activity, start_ts_6m, end_ts):
+    return stability_metrics(rollup_activity(activity, ["設計師", "month"]), activity, start_ts_6m, end_ts)
+
+def scoring(designer_metrics):
+    return add_goal_scores(add_block_scores(designer_metrics.copy()))
+
+def run_size(n_rows, load_max_rows, seed, loop_max_rows=100_000):
+    stages = {}
+    reference = {}
+    bills = synthetic_bills(n_rows, seed=seed)
+    members = synthetic_members(bills, seed=seed)
+
+    # xlsx 來回寫讀在大筆數時要數十分鐘，超過 load_max_rows 就略過讀檔階段
+    if n_rows <= load_max_rows:
+        with tempfile.TemporaryDirectory(prefix="bench-bills-") as tmp:
+            paths = write_store_workbooks(bills, Path(tmp))
+            loaded, _, _ = timed(stages, "load", load_bills, paths, ["服務"])
+            del loaded
+    else:
+        stages["load"] = None
+
+    merged = timed(stages, "normalize", lambda: prepare_checkouts(bills.copy()))
+    merged_sorted, new_first = timed(stages, "first_checkout", first_checkouts, merged)
+    store_index, relationship_index = timed(stages, "visit_index", visit_indexes, merged_sorted)
+    new_first = timed(stages, "churn", add_store_return_flags, new_first, store_index, "結帳操作時間", CHURN_DAYS)
+    # 舊逐列迴圈只在小筆數時跑，記在 reference，不計入總計
+    if n_rows <= loop_max_rows:
+        timed(reference, "churn_loop", store_return_loop, new_first, merged_sorted, CHURN_DAYS)
+        reference["churn_speedup"] = round(reference["churn_loop"] / stages["churn"], 1)
+    timed(stages, "repeat", add_repeat_flags, new_first, relationship_index, "結帳操作時間", T2_DAYS, T3_DAYS)
+    if n_rows <= loop_max_rows:
+        timed(reference, "repeat_loop", repeat_loop, new_first, merged_sorted, T2_DAYS, T3_DAYS)
+        reference["repeat_speedup"] = round(reference["repeat_loop"] / stages["repeat"], 1)
+    relationship_first = timed(stages, "regular", regular_metrics, merged_sorted, relationship_index)
+    if n_rows <= loop_max_rows:
+        timed(reference, "regular_loop", regular_loop, relationship_first, merged_sorted)
+        reference["regular_speedup"] = round(reference["regular_loop"] / stages["regular"], 1)
+    activity, _ = timed(stages, "vacancy", vacancy, merged_sorted)
+    timed(stages, "store_partials", store_partials, merged_sorted, new_first, relationship_first, None, (store_index, relationship_index))
+
+    end_ts = merged_sorted["結帳操作時間"].max()
+    start_ts_6m = end_ts - pd.DateOffset(months=6)
+    timed(stages, "stability", stability, activity, start_ts_6m, end_ts)
+
+    # 評分需要完整的師傅指標表；compute_view 另記一段，方便看檢視階段整體成本
+    base = derive_base_model(merged, prepare_members(members.copy()), ["服務"], [])
+    view = timed(stages, "view", compute_view, base)
+    timed(stages, "scoring", scoring, view["designer_metrics"])
+    timed(stages, "sweep", window_sweep, view["new_first_store"], view["end_date"])
+    timed(stages, "history", designer_history, base)
+
+    return {
+        "rows": n_rows,
+        "checkouts": len(merged_sorted),
+        "customers": int(merged_sorted["phone_key"].nunique()),
+        "designers": int(merged_sorted["設計師"].nunique()),
+        "stages": stages,
+        "reference": reference,
+        "total": round(sum(v for v in stages.values() if v is not None), 4),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+def git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=Path(__file__).parent)
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+def compare(results, baseline):
+    # 與前次結果逐段比較：ratio > 1 表示變慢
+    old = {r["rows"]: r for r in baseline["results"]}
+    lines = []
+    for r in results:
+        prev = old.get(r["rows"])
+        if prev is None:
+            continue
+        for stage, seconds in r["stages"].items():
+            before = prev["stages"].get(stage)
+            if seconds is None or not before:
+                continue
+            lines.append(f"{r['rows']:>10,} {stage:<15} {before:>9.3f}s → {seconds:>9.3f}s  x{seconds / before:.2f}")
+    return lines
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="顧客關係經營分析：管線效能量測")
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES, help="帳單筆數（預設 10k 100k 1M 5M）")
+    parser.add_argument("--load-max-rows", type=int, default=200_000, help="超過此筆數略過 xlsx 讀檔階段")
+    parser.add_argument("--loop-max-rows", type=int, default=100_000, help="超過此筆數略過舊逐列迴圈的對照量測")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="bench_results.json", help="結果 JSON 路徑")
+    parser.add_argument("--baseline", help="前次結果 JSON，印出各階段倍率")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = []
+    for n_rows in args.sizes:
+        result = run_size(n_rows, args.load_max_rows, args.seed, args.loop_max_rows)
+        results.append(result)
+        timings = "  ".join(f"{k}={'-' if v is None else f'{v:.3f}'}" for k, v in result["stages"].items())
+        print(f"{n_rows:>10,} 筆  總計 {result['total']:.2f}s  peak RSS {result['peak_rss_mb']:.0f}MB  {timings}")
+        if result["reference"]:
+            ref = result["reference"]
+            loops = [k[: -len("_loop")] for k in ref if k.endswith("_loop")]
+            print(f"{'':>10}    舊逐列迴圈 " + "  ".join(f"{k}_loop={ref[k + '_loop']:.3f}s（向量化快 {ref[k + '_speedup']:.1f} 倍）" for k in loops))
+        gc.collect()
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "git": git_revision(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "cpus": os.cpu_count(),
+        "seed": args.seed,
+        "results": results,
+    }
+    Path(args.out).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"已輸出 {args.out}")
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        for line in compare(results, baseline):
+            print(line)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,284 @@
+import os
+import re
+import json
+import time
+import hashlib
+import inspect
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+from operator import itemgetter
+from pathlib import Path
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+from pandas.io.parsers import TextParser
+
+# 帳單解析快取：以檔案內容雜湊為 key，每個工作表轉存一份 Parquet，跨 session/重啟共用
+BILL_CACHE_DIR = Path(os.environ.get("BILL_CACHE_DIR", Path.home() / ".cache" / "therapist-churn-insights" / "bills"))
+BILL_CACHE_MAX_BYTES = int(os.environ.get("BILL_CACHE_MAX_MB", "2048")) * 1024 * 1024
+BILL_CACHE_MAX_AGE_DAYS = int(os.environ.get("BILL_CACHE_MAX_AGE_DAYS", "30"))
+# 串流讀檔：檔案達此大小改用 openpyxl 唯讀模式逐塊讀取（0 表示一律串流），每塊列數
+BILL_STREAM_MIN_BYTES = int(os.environ.get("BILL_STREAM_MIN_MB", "8")) * 1024 * 1024
+BILL_STREAM_CHUNK_ROWS = int(os.environ.get("BILL_STREAM_CHUNK_ROWS", "50000"))
+
+def file_name(file, default="未命名檔案"):
+    if isinstance(file, (str, Path)):
+        return Path(file).name
+    return getattr(file, "name", default)
+
+def file_bytes(file):
+    if hasattr(file, "getvalue"):
+        return file.getvalue()
+    return Path(file).read_bytes()
+
+@lru_cache(maxsize=None)
+def normalizer_variant(normalize):
+    # 正規化快取的版本：函式名稱加上其所在原始檔內容的雜湊，改了正規化（含同檔的輔助函式）舊快取自動失效；
+    # 取不到原始檔（如打包後執行）時只用名稱
+    try:
+        source = Path(inspect.getsourcefile(normalize)).read_bytes()
+    except (OSError, TypeError):
+        return normalize.__name__
+    return f"{normalize.__name__}-{hashlib.sha1(source).hexdigest()[:12]}"
+
+def file_digest(file):
+    return hashlib.sha256(file_bytes(file)).hexdigest()
+
+def bill_cache_path(digest, sheet=None, variant=None):
+    # variant：讀檔時套用的正規化版本（normalizer_variant），原始表與正規化後的表分開快取
+    if sheet is None:
+        return BILL_CACHE_DIR / f"{digest}.json"
+    key = str(sheet) if variant is None else f"{sheet}\0{variant}"
+    sheet_id = hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+    return BILL_CACHE_DIR / f"{digest}.{sheet_id}.parquet"
+
+def read_bill_cache(path):
+    if not path.exists():
+        return None
+    try:
+        df = pd.read_parquet(path) if path.suffix == ".parquet" else json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        path.unlink(missing_ok=True)
+        return None
+    os.utime(path)
+    return df
+
+def write_bill_cache(path, value):
+    tmp = path.with_name(path.name + ".tmp")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(value, pd.DataFrame):
+            value.to_parquet(tmp, index=False)
+        else:
+            tmp.write_text(json.dumps(value, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+    except Exception:
+        # 混型欄位等無法轉成 Parquet 的工作表直接略過快取
+        tmp.unlink(missing_ok=True)
+        return False
+    return True
+
+def prune_bill_cache(max_bytes=None, max_age_days=None):
+    max_bytes = BILL_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    max_age_days = BILL_CACHE_MAX_AGE_DAYS if max_age_days is None else max_age_days
+    if not BILL_CACHE_DIR.exists():
+        return
+    entries = []
+    cutoff = time.time() - max_age_days * 86400
+    for path in BILL_CACHE_DIR.iterdir():
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        if stat.st_mtime < cutoff:
+            path.unlink(missing_ok=True)
+        else:
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries, key=lambda e: e[0]):
+        if total <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+
+# 後續計算只用到這些帳單欄位，讀檔時只解析這幾欄
+BILL_COLUMNS = ["國碼", "電話號碼", "結帳操作時間", "設計師", "分店", "項目", "指定"]
+
+def compact_columns(df):
+    # 文字欄轉 category：重複的分店、師傅、項目、電話只存一份
+    for c in df.columns:
+        if not isinstance(df[c].dtype, pd.CategoricalDtype) and pd.api.types.is_string_dtype(df[c]):
+            df[c] = df[c].astype("category")
+    return df
+
+def concat_frames(frames):
+    # 逐欄合併：各塊都是 category 的欄位以 union_categoricals 合併（類別排序與 astype("category") 相同），
+    # 不會先展開成整欄字串；類別型別不一致（如一塊全是數字）或有塊缺欄時照常 concat
+    names = list(dict.fromkeys(c for f in frames for c in f.columns))
+    columns = {}
+    for c in names:
+        parts = [f[c] if c in f.columns else pd.Series(None, index=range(len(f)), dtype=object) for f in frames]
+        if all(isinstance(p.dtype, pd.CategoricalDtype) for p in parts):
+            try:
+                columns[c] = union_categoricals(parts, sort_categories=True)
+                continue
+            except TypeError:
+                pass
+        columns[c] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(columns)
+
+def sheet_chunk_frame(rows, names):
+    # 與 read_excel 相同的 TextParser 轉型：數字字串轉數字、"NA" 等視為缺值；型別依各塊自行推斷
+    return TextParser(rows, header=None, names=names).read()
+
+def iter_sheet_chunks(ws, columns=BILL_COLUMNS, chunk_rows=None):
+    # openpyxl 唯讀工作表逐列讀取，只取需要的欄位，每 chunk_rows 列產出一塊；整列空白略過
+    chunk_rows = chunk_rows or BILL_STREAM_CHUNK_ROWS
+    ws.reset_dimensions()
+    rows = ws.iter_rows(values_only=True)
+    header = next(rows, None) or ()
+    positions = {}
+    for i, c in enumerate(header):
+        if c in columns and c not in positions:
+            positions[c] = i
+    if not positions:
+        return
+    names = list(positions)
+    width = max(positions.values()) + 1
+    pick = itemgetter(*positions.values())
+    if len(names) == 1:
+        pick = lambda row, get=pick: (get(row),)
+    chunk = []
+    for row in rows:
+        if len(row) < width:
+            row = row + (None,) * (width - len(row))
+        values = pick(row)
+        if all(v is None for v in values):
+            continue
+        chunk.append(values)
+        if len(chunk) >= chunk_rows:
+            yield sheet_chunk_frame(chunk, names)
+            chunk = []
+    if chunk:
+        yield sheet_chunk_frame(chunk, names)
+
+def stream_bill_sheet(ws, normalize=None, chunk_rows=None):
+    # 每塊讀進來先正規化、轉 category 再暫存，峰值記憶體取決於塊大小而非整張工作表
+    frames = []
+    for chunk in iter_sheet_chunks(ws, chunk_rows=chunk_rows):
+        if normalize is not None:
+            chunk = normalize(chunk)
+        frames.append(compact_columns(chunk))
+    return concat_frames(frames) if frames else pd.DataFrame()
+
+def iter_bill_sheets(xls, sheets, normalize=None, streaming=False):
+    # 同一個已開啟的活頁簿依序產出 (工作表, DataFrame, 解析秒數)，不重複解壓
+    for s in sheets:
+        if s not in xls.sheet_names:
+            continue
+        started = time.perf_counter()
+        if streaming:
+            df = stream_bill_sheet(xls.book[s], normalize)
+        else:
+            df = pd.read_excel(xls, sheet_name=s, usecols=lambda c: c in BILL_COLUMNS)
+            if normalize is not None:
+                df = normalize(df)
+            df = compact_columns(df)
+        yield s, df, time.perf_counter() - started
+
+def read_bill(data, name, sheets, normalize=None, streaming=None):
+    # normalize：讀檔時逐表（串流時逐塊）套用的正規化函式；streaming 為 None 時依檔案大小決定
+    digest = hashlib.sha256(data).hexdigest()
+    variant = None if normalize is None else normalizer_variant(normalize)
+    if streaming is None:
+        streaming = len(data) >= BILL_STREAM_MIN_BYTES
+    xls = None
+    manifest = read_bill_cache(bill_cache_path(digest))
+    if manifest is None:
+        xls = pd.ExcelFile(BytesIO(data))
+        manifest = {"sheet_names": list(xls.sheet_names)}
+        write_bill_cache(bill_cache_path(digest), manifest)
+    available = [s for s in sheets if s in manifest["sheet_names"]]
+    parsed = {}
+    timings = []
+    missing = []
+    for s in available:
+        started = time.perf_counter()
+        df = read_bill_cache(bill_cache_path(digest, s, variant))
+        if df is None:
+            missing.append(s)
+        else:
+            parsed[s] = df if normalize is not None else df[[c for c in df.columns if c in BILL_COLUMNS]]
+            timings.append({"檔案": name, "工作表": s, "來源": "快取", "列數": len(df), "秒數": time.perf_counter() - started})
+    wrote = False
+    if missing:
+        if xls is None:
+            xls = pd.ExcelFile(BytesIO(data))
+        # 串流需要 openpyxl 的唯讀工作表；其他讀取引擎照舊整表讀入
+        streaming = streaming and xls.engine == "openpyxl"
+        for s, df, seconds in iter_bill_sheets(xls, missing, normalize, streaming):
+            parsed[s] = df
+            timings.append({"檔案": name, "工作表": s, "來源": "串流" if streaming else "解析", "列數": len(df), "秒數": seconds})
+            wrote = write_bill_cache(bill_cache_path(digest, s, variant), df) or wrote
+    if wrote:
+        prune_bill_cache()
+    frames = [parsed[s] for s in available if s in parsed]
+    if not frames:
+        return pd.DataFrame(), available, timings
+    return concat_frames(frames), available, timings
+
+def infer_store_name(filename):
+    stem = Path(filename).stem
+    name = stem
+    name = re.sub(r"帳單紀錄", "", name)
+    name = re.sub(r"帳單|紀錄", "", name)
+    name = re.sub(r"\d{4}-\d{2}-\d{2}", "", name)
+    name = re.sub(r"\d{8,}", "", name)
+    name = re.sub(r"[_\-]+", " ", name)
+    name = re.sub(r"\s+", " ", name).strip()
+    return name if name else stem
+
+def read_store_bill(data, name, sheets, normalize=None, streaming=None):
+    # 單一分店帳單：讀檔並補上來源檔案與分店；可在子行程執行
+    df, used_sheets, timings = read_bill(data, name, sheets, normalize, streaming)
+    if not df.empty:
+        store_name = infer_store_name(name)
+        df["來源檔案"] = name
+        if "分店" not in df.columns:
+            df["分店"] = store_name
+        else:
+            stores = df["分店"]
+            if isinstance(stores.dtype, pd.CategoricalDtype) and store_name not in stores.cat.categories:
+                stores = stores.cat.add_categories([store_name])
+            df["分店"] = stores.fillna(store_name)
+    return df, used_sheets, timings
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def default_load_workers():
+    return max(1, min(available_cpus(), int(os.environ.get("BILL_LOAD_MAX_WORKERS", "8"))))
+
+def load_bills(files, sheets, max_workers=1, normalize=None, streaming=None):
+    # max_workers > 1 時以行程池平行解析各檔；結果依上傳順序合併，與逐檔讀取一致
+    payloads = [(file_bytes(f), file_name(f), list(sheets), normalize, streaming) for f in files]
+    workers = min(max_workers or 1, len(payloads))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(read_store_bill, *zip(*payloads)))
+    else:
+        results = [read_store_bill(*payload) for payload in payloads]
+    frames = []
+    used = set()
+    timings = []
+    for df, used_sheets, file_timings in results:
+        timings.extend(file_timings)
+        if not df.empty:
+            frames.append(df)
+        used.update(used_sheets)
+    if not frames:
+        return pd.DataFrame(), list(used), timings
+    return concat_frames(frames), list(used), timings
@@ -0,0 +1,95 @@
+import argparse
+import sys
+from pathlib import Path
+
+from bill_io import default_load_workers
+from analytics import (
+    HISTORY_MONTHS,
+    DataInputError,
+    build_base_model,
+    build_report,
+    compute_view,
+    default_compute_workers,
+    designer_options,
+    write_excel_report,
+)
+from snapshot import write_snapshot
+from profiling import PROFILE_LOG, append_profile_log, profile_table, start_profiling, stop_profiling
+
+# 命令列版本：不開瀏覽器，直接由帳單/會員名單產出師傅指標與 Excel 報表（可排程於夜間執行）
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="顧客關係經營分析（命令列）")
+    parser.add_argument("bills", nargs="+", help="帳單紀錄 .xlsx（可多檔）")
+    parser.add_argument("--members", help="會員名單 .xlsx（選填）")
+    parser.add_argument("--out-dir", default=".", help="輸出資料夾（預設目前資料夾）")
+    parser.add_argument("--types", nargs="+", default=["服務", "票券"], help="計算包含結帳類型（預設 服務 票券）")
+    parser.add_argument("--stores", nargs="+", help="只計算這些分店（預設全部）")
+    parser.add_argument("--exclude-designers", nargs="+", default=[], help="排除師傅")
+    parser.add_argument("--min-repeat-base", type=int, default=5, help="回指率最低樣本數（預設 5）")
+    parser.add_argument("--all-customers", action="store_true", help="流失名單包含未流失的新客")
+    # 歷史要逐月重算各期計數，較慢，預設不算；快照也不需要它
+    parser.add_argument("--history-months", type=int, default=0, help=f"另算近 N 個月的師傅指標歷史（預設 0=不計算；網頁為 {HISTORY_MONTHS}）")
+    parser.add_argument("--snapshot", action="store_true", help="另存全品牌快照（Parquet），供網頁「開啟快照」使用")
+    parser.add_argument("--profile", action="store_true", help=f"印出各階段耗時與峰值記憶體，並附加到 {PROFILE_LOG}")
+    parser.add_argument("--workers", type=int, default=default_load_workers(), help="平行讀檔行程數")
+    parser.add_argument("--compute-workers", type=int, default=default_compute_workers(), help="依分店平行計算同店指標的行程數（1=不分段）")
+    args = parser.parse_args(argv)
+    missing = [f for f in args.bills + ([args.members] if args.members else []) if not Path(f).is_file()]
+    if missing:
+        parser.error(f"找不到檔案：{', '.join(missing)}")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if args.profile:
+        start_profiling()
+    try:
+        base = build_base_model(args.bills, args.members, args.types, args.workers, args.compute_workers)
+        store_filter = args.stores if base["has_store"] else None
+        excluded = set(args.exclude_designers)
+        designer_filter = [d for d in designer_options(base, store_filter) if d not in excluded]
+        view = compute_view(base, store_filter, designer_filter, args.min_repeat_base)
+        brand_view = None
+        if args.snapshot:
+            # 快照一律是全品牌、全師傅口徑；有篩選時另算一份
+            filtered = store_filter is not None or excluded
+            brand_view = compute_view(base, None, None, args.min_repeat_base) if filtered else view
+    except DataInputError as e:
+        print(f"錯誤：{e}", file=sys.stderr)
+        return 2
+
+    report = build_report(base, view, churned_only=not args.all_customers, history_months=args.history_months)
+    metrics_path = out_dir / "designer_metrics.csv"
+    report_path = out_dir / "customer_relationship_analysis.xlsx"
+    report["designer_metrics"].to_csv(metrics_path, index=False, encoding="utf-8-sig")
+    outputs = [metrics_path, report_path]
+    if report["designer_history"] is not None:
+        history_path = out_dir / "designer_history.csv"
+        report["designer_history"].to_csv(history_path, index=False, encoding="utf-8-sig")
+        outputs.insert(1, history_path)
+    write_excel_report(
+        report_path,
+        report["overall"],
+        report["designer_table"],
+        report["store_table"],
+        report["store_designer_table"],
+        report["churn_list"],
+        report["display_vacancy"],
+        report["history_table"],
+    )
+    print(f"資料截止：{view['end_date']}，師傅 {len(report['designer_metrics'])} 位")
+    print(f"已輸出 {'、'.join(str(p) for p in outputs)}")
+    if brand_view is not None:
+        print(f"已建立快照 {write_snapshot(base, brand_view, args.bills)}")
+    if args.profile:
+        records = stop_profiling()
+        append_profile_log(records, {"source": "cli", "bill_files": len(args.bills), "rows": len(base["merged"])})
+        for r in profile_table(records):
+            print(f"{r['階段']:<24} {r['秒數']:>8.3f}s {r['峰值記憶體(MB)']:>8.0f}MB {r['列數'] if r['列數'] is not None else '-':>10}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
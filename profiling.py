@@ -0,0 +1,118 @@
+import itertools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+# 選用的逐段效能紀錄：開啟後各階段記錄耗時、峰值記憶體與筆數，並可附加到本機 JSONL
+PROFILE_LOG = Path(os.environ.get("PROFILE_LOG", Path.home() / ".cache" / "therapist-churn-insights" / "profile.jsonl"))
+
+# Streamlit 每個工作階段在各自的執行緒跑腳本，紀錄放在 thread-local 避免互相混到
+_local = threading.local()
+
+# VmHWM 是整個行程共用的：進行中的階段（所有執行緒）登記在這裡，任何歸零前先把峰值併進去
+_open_stages = {}
+_stage_ids = itertools.count()
+_peak_lock = threading.Lock()
+
+def start_profiling():
+    _local.records = []
+    _local.depth = 0
+
+def stop_profiling():
+    records = getattr(_local, "records", None) or []
+    _local.records = None
+    return [r for r in records if r is not None]
+
+def profiling_enabled():
+    return getattr(_local, "records", None) is not None
+
+def reset_peak_rss():
+    # Linux 可把行程的峰值 RSS（VmHWM）歸零，各階段量到的就是自己的峰值；其他平台只能看整個行程的峰值。
+    # 歸零前先把目前峰值併入所有進行中的階段，外層與其他工作階段的峰值才不會被歸零吃掉
+    with _peak_lock:
+        _fold_peak_locked()
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            pass
+
+def _fold_peak_locked():
+    if _open_stages:
+        peak = peak_rss_mb()
+        for key, value in _open_stages.items():
+            _open_stages[key] = max(value, peak)
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss 在 Linux 為 KB、macOS 為 bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+@contextmanager
+def stage(name, rows=None):
+    # 用法：with stage("load_bills") as s: ...; s["rows"] = len(df)
+    records = getattr(_local, "records", None)
+    info = {"rows": rows}
+    if records is None:
+        yield info
+        return
+    # 先佔位，讓外層階段排在內層之前
+    slot = len(records)
+    records.append(None)
+    depth = _local.depth
+    _local.depth += 1
+    key = next(_stage_ids)
+    reset_peak_rss()
+    with _peak_lock:
+        _open_stages[key] = 0.0
+    started = time.perf_counter()
+    try:
+        yield info
+    finally:
+        _local.depth = depth
+        # 期間任何歸零（內層階段或其他工作階段）前的峰值都已併入，再加上最後一段的峰值
+        with _peak_lock:
+            peak = max(_open_stages.pop(key), peak_rss_mb())
+        records[slot] = {
+            "stage": name,
+            "depth": depth,
+            "seconds": round(time.perf_counter() - started, 4),
+            "peak_rss_mb": round(peak, 1),
+            "rows": info["rows"],
+        }
+
+def append_profile_log(records, context=None, path=None):
+    # 每次重跑一行：時間、情境（模式、檔案數等）與各階段紀錄
+    if not records:
+        return
+    path = PROFILE_LOG if path is None else Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    line = {"time": datetime.now().isoformat(timespec="seconds"), "context": context or {}, "stages": records}
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(line, ensure_ascii=False, default=str) + "\n")
+
+def profile_table(records):
+    # 依開始順序排列，內層階段縮排顯示
+    return [
+        {
+            "階段": "　" * r["depth"] + r["stage"],
+            "秒數": r["seconds"],
+            "峰值記憶體(MB)": r["peak_rss_mb"],
+            "列數": r["rows"],
+        }
+        for r in records
+        if r is not None
+    ]
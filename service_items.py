@@ -0,0 +1,106 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# 服務項目 → 分鐘對照表：項目文字只在第一次出現時解析「N分鐘」並存檔沿用；
+# 手動覆寫（介面編輯或上傳 CSV）另存一檔，查表時優先於解析結果
+ITEM_DIR = Path(os.environ.get("ITEM_MINUTES_DIR", Path.home() / ".cache" / "therapist-churn-insights" / "items"))
+PARSED_PATH = ITEM_DIR / "item_minutes.csv"
+OVERRIDE_PATH = ITEM_DIR / "item_minutes_override.csv"
+ITEM_COLUMNS = ["項目", "分鐘"]
+MINUTES_PATTERN = r"(\d+)\s*分鐘"
+
+def extract_minutes(items):
+    # 項目中所有「N分鐘」加總；每個不同字串只解析一次再依 codes 展開回各列
+    codes, uniques = pd.factorize(items, use_na_sentinel=True)
+    if len(uniques) == 0:
+        return np.zeros(len(codes), dtype=np.int64)
+    texts = pd.Series(uniques, dtype=object).astype(str)
+    found = texts.str.extractall(MINUTES_PATTERN)[0]
+    per_item = (
+        found.map(int).groupby(level=0).sum()
+        .reindex(range(len(texts)), fill_value=0)
+        .to_numpy(dtype=np.int64)
+    )
+    return np.where(codes >= 0, per_item[codes], 0)
+
+def clean_item_table(df):
+    # 項目一律當文字比對；分鐘轉數字，同一項目重複時以後面的為準
+    df = pd.DataFrame({
+        "項目": df["項目"].astype(object).where(df["項目"].isna(), df["項目"].astype(str)),
+        "分鐘": pd.to_numeric(df["分鐘"], errors="coerce"),
+    })
+    df = df[df["項目"].notna()]
+    return df.drop_duplicates("項目", keep="last").reset_index(drop=True)
+
+def read_item_table(path):
+    if not path.exists():
+        return pd.DataFrame({"項目": pd.Series(dtype=object), "分鐘": pd.Series(dtype=float)})
+    df = pd.read_csv(path, dtype={"項目": object}, keep_default_na=False, na_values={"分鐘": [""]}, encoding="utf-8-sig")
+    return clean_item_table(df).dropna(subset=["分鐘"])
+
+def write_item_table(path, df):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    df[ITEM_COLUMNS].to_csv(tmp, index=False, encoding="utf-8-sig")
+    os.replace(tmp, path)
+
+def parsed_item_minutes(texts):
+    # 只解析對照表還沒有的項目，有新增才寫回
+    table = read_item_table(PARSED_PATH)
+    missing = pd.Index(texts).unique().difference(pd.Index(table["項目"]))
+    if len(missing):
+        new = pd.DataFrame({"項目": missing.astype(object), "分鐘": extract_minutes(pd.Series(missing, dtype=object))})
+        table = pd.concat([table, new], ignore_index=True)
+        write_item_table(PARSED_PATH, table)
+    return table
+
+def load_item_overrides():
+    return read_item_table(OVERRIDE_PATH)
+
+def item_overrides_version():
+    # 給 st.cache_data 當 key：覆寫存檔後基礎模型的空窗率會重算
+    return OVERRIDE_PATH.stat().st_mtime_ns if OVERRIDE_PATH.exists() else None
+
+def save_item_overrides(rows):
+    # rows：項目、分鐘；分鐘為空代表刪除該項目的覆寫。未出現在 rows 的既有覆寫保留
+    rows = clean_item_table(rows)
+    current = load_item_overrides()
+    current = current[~current["項目"].isin(rows["項目"])]
+    table = pd.concat([current, rows.dropna(subset=["分鐘"])], ignore_index=True).sort_values("項目")
+    write_item_table(OVERRIDE_PATH, table)
+    return table
+
+def item_lookup(texts, overrides=None):
+    parsed = parsed_item_minutes(texts)
+    lookup = pd.Series(parsed["分鐘"].to_numpy(dtype=float), index=pd.Index(parsed["項目"], dtype=object))
+    if overrides is not None and not overrides.empty:
+        lookup = pd.concat([lookup[~lookup.index.isin(overrides["項目"])], overrides.set_index("項目")["分鐘"].astype(float)])
+    return lookup
+
+def item_minutes(items, overrides=None):
+    # 以不同項目對照表做 hash join：各項目查一次（覆寫優先），再依 codes 展開回各列
+    overrides = load_item_overrides() if overrides is None else overrides
+    codes, uniques = pd.factorize(items, use_na_sentinel=True)
+    if len(uniques) == 0:
+        return np.zeros(len(codes), dtype=float)
+    texts = pd.Index(pd.Series(uniques, dtype=object).astype(str), dtype=object)
+    per_item = item_lookup(texts, overrides).reindex(texts).fillna(0).to_numpy(dtype=float)
+    return np.where(codes >= 0, per_item[codes], 0.0)
+
+def item_minutes_table(items, overrides=None):
+    # 介面用：各項目筆數、解析分鐘、覆寫分鐘；無法判斷時長（0 分鐘且未覆寫）的排前面
+    overrides = load_item_overrides() if overrides is None else overrides
+    counts = pd.Series(items, dtype=object).dropna().astype(str).value_counts()
+    texts = pd.Index(counts.index, dtype=object)
+    parsed = parsed_item_minutes(texts).set_index("項目")["分鐘"]
+    table = pd.DataFrame({
+        "項目": texts,
+        "筆數": counts.to_numpy(),
+        "解析分鐘": parsed.reindex(texts).to_numpy(),
+        "覆寫分鐘": overrides.set_index("項目")["分鐘"].reindex(texts).to_numpy(),
+    })
+    table["未知時長"] = (table["解析分鐘"] <= 0) & table["覆寫分鐘"].isna()
+    return table.sort_values(["未知時長", "筆數"], ascending=[False, False]).reset_index(drop=True)
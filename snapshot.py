@@ -0,0 +1,148 @@
+import os
+import json
+import shutil
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+from pandas.api.types import infer_dtype
+
+# 夜間批次快照：全品牌的基礎模型與檢視結果存成一組 Parquet，網頁可直接開啟、不必重新解析 xlsx
+SNAPSHOT_DIR = Path(os.environ.get("SNAPSHOT_DIR", Path.home() / ".cache" / "therapist-churn-insights" / "snapshots"))
+SNAPSHOT_KEEP = int(os.environ.get("SNAPSHOT_KEEP", "30"))
+SNAPSHOT_FORMAT = 4
+
+# 檢視結果中可直接存檔的 frame；基礎模型的 new_first/relationship_first 由帶滿期旗標的版本去掉旗標還原
+VIEW_FRAMES = [
+    "new_first_store",
+    "relationship_first",
+    "new_recent_churn",
+    "designer_metrics",
+    "store_monthly_avg",
+    "summary_by_store",
+    "activity_monthly",
+    "vacancy_monthly",
+    "vacancy_recent",
+]
+NEW_FIRST_FLAGS = ["matured", "matured_2", "matured_3"]
+RELATIONSHIP_FLAGS = ["regular_matured_180", "retention_matured_180"]
+
+def parquet_ready(df):
+    # 混型 object 欄（例如同欄有數字與文字）Parquet 無法寫入，轉成字串並保留空值；只換掉這些欄，不整份複製
+    df = df.copy(deep=False)
+    for c in df.columns:
+        if df[c].dtype == object and infer_dtype(df[c], skipna=True).startswith("mixed"):
+            df[c] = df[c].where(df[c].isna(), df[c].astype(str))
+    return df
+
+def write_frame(path, df):
+    parquet_ready(df).to_parquet(path, index=False)
+
+def write_snapshot(base, view, sources=()):
+    # 先寫到暫存資料夾再改名，排程中斷不會留下半套快照
+    name = datetime.now().strftime("%Y%m%d-%H%M%S")
+    target = SNAPSHOT_DIR / name
+    tmp = SNAPSHOT_DIR / f".{name}.tmp"
+    tmp.mkdir(parents=True, exist_ok=True)
+    write_frame(tmp / "merged.parquet", base["merged"])
+    # 會員索引另存一檔，開啟快照後名單一樣能補上會員姓名
+    if base["members"] is not None:
+        write_frame(tmp / "members.parquet", base["members"].reset_index())
+    # 各截止日的部分彙總：開啟快照後切換分店也只需相加
+    if base.get("store_partials") is not None:
+        write_frame(tmp / "store_partials.parquet", base["store_partials"])
+    frames = []
+    for key in VIEW_FRAMES:
+        if view.get(key) is not None:
+            write_frame(tmp / f"{key}.parquet", view[key])
+            frames.append(key)
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "name": name,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "sources": [Path(s).name for s in sources],
+        "include_types": list(base["include_types"]),
+        "name_col": base["name_col"],
+        "has_store": base["has_store"],
+        "rows": len(base["merged"]),
+        "frames": frames,
+        "store_filter": view["store_filter"],
+        "designer_filter": list(view["designer_filter"]),
+        "min_repeat_base": view["min_repeat_base"],
+        "has_request": view["has_request"],
+        "end_date": str(view["end_date"]),
+        "start_ts_3m": str(view["start_ts_3m"]),
+        "start_ts_6m": str(view["start_ts_6m"]),
+        "start_ts_12m": str(view["start_ts_12m"]),
+    }
+    (tmp / "manifest.json").write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, target)
+    prune_snapshots()
+    return target
+
+def list_snapshots():
+    # 新到舊；只列出格式相符且寫入完成的快照
+    if not SNAPSHOT_DIR.exists():
+        return []
+    manifests = []
+    for path in sorted(SNAPSHOT_DIR.iterdir(), reverse=True):
+        manifest_path = path / "manifest.json"
+        if path.name.startswith(".") or not manifest_path.exists():
+            continue
+        try:
+            manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+        except ValueError:
+            continue
+        if manifest.get("format") == SNAPSHOT_FORMAT:
+            manifests.append(manifest)
+    return manifests
+
+def prune_snapshots(keep=None):
+    keep = SNAPSHOT_KEEP if keep is None else keep
+    for manifest in list_snapshots()[keep:]:
+        shutil.rmtree(SNAPSHOT_DIR / manifest["name"], ignore_errors=True)
+
+def load_snapshot(name):
+    # 回傳 (base, view)；view 為全品牌、全師傅的檢視結果，篩選不同時由 analytics.compute_view 從 base 重算
+    path = SNAPSHOT_DIR / name
+    manifest = json.loads((path / "manifest.json").read_text(encoding="utf-8"))
+    view = {key: None for key in VIEW_FRAMES}
+    for key in manifest["frames"]:
+        view[key] = pd.read_parquet(path / f"{key}.parquet")
+    merged = pd.read_parquet(path / "merged.parquet")
+    members = None
+    if (path / "members.parquet").exists():
+        members = pd.read_parquet(path / "members.parquet").set_index("phone_key")
+    end_date = pd.Timestamp(manifest["end_date"])
+    partials = None
+    view_partials = None
+    if (path / "store_partials.parquet").exists():
+        partials = pd.read_parquet(path / "store_partials.parquet")
+        view_partials = partials[partials["end_date"] == end_date]
+        if manifest["store_filter"] is not None:
+            view_partials = view_partials[view_partials["分店"].isin(manifest["store_filter"])]
+    view.update(
+        store_partials=view_partials,
+        store_filter=manifest["store_filter"],
+        designer_filter=manifest["designer_filter"],
+        min_repeat_base=manifest["min_repeat_base"],
+        has_request=manifest["has_request"],
+        end_date=end_date,
+        start_ts_3m=pd.Timestamp(manifest["start_ts_3m"]),
+        start_ts_6m=pd.Timestamp(manifest["start_ts_6m"]),
+        start_ts_12m=pd.Timestamp(manifest["start_ts_12m"]),
+    )
+    base = {
+        "merged": merged,
+        "new_first": view["new_first_store"].drop(columns=NEW_FIRST_FLAGS),
+        "relationship_first": view["relationship_first"].drop(columns=RELATIONSHIP_FLAGS, errors="ignore"),
+        "activity_monthly": view["activity_monthly"],
+        "vacancy_monthly": view["vacancy_monthly"],
+        "store_partials": partials,
+        "members": members,
+        "include_types": manifest["include_types"],
+        "name_col": manifest["name_col"],
+        "has_store": manifest["has_store"],
+        "load_timings": [],
+    }
+    return base, view
@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+
+# 合成帳單資料：供效能量測使用，欄位與格式比照實際匯出的「帳單紀錄」
+
+ITEMS = [
+    ("精油按摩", [60, 90, 120]),
+    ("足底按摩", [30, 40, 60]),
+    ("肩頸舒壓", [20, 30]),
+    ("熱石療程", [90, 120]),
+    ("頭皮護理", [45, 60]),
+]
+ADD_ONS = ["加強肩頸 15分鐘", "熱敷 10分鐘"]
+
+def synthetic_bills(n_rows, n_stores=5, designers_per_store=12, n_customers=None, months=24, seed=0, end="2025-12-31"):
+    # 顧客來店頻率取 gamma 分布（少數常客、多數低頻），同一顧客的來店間隔為指數分布，近似 Poisson 回訪
+    rng = np.random.default_rng(seed)
+    n_customers = n_customers or max(1, n_rows // 6)
+    end_ts = pd.Timestamp(end)
+    start_ts = end_ts - pd.DateOffset(months=months)
+    span_days = (end_ts - start_ts).days
+
+    weights = rng.gamma(0.6, 1.0, n_customers)
+    counts = rng.multinomial(n_rows, weights / weights.sum())
+    customer = np.repeat(np.arange(n_customers), counts)
+
+    # 每位顧客：平均回訪間隔、第一次來店日、常去分店與指定師傅
+    mean_gap = np.maximum(span_days / np.maximum(counts, 1) * rng.uniform(0.3, 1.0, n_customers), 1.0)
+    first_day = rng.uniform(0, 1, n_customers) * np.maximum(span_days - mean_gap * counts, 0)
+    gaps = rng.exponential(mean_gap[customer])
+    starts = np.r_[0, np.cumsum(counts)[:-1]]
+    cum = np.cumsum(gaps)
+    day = first_day[customer] + cum - np.repeat(cum[starts[counts > 0]] - gaps[starts[counts > 0]], counts[counts > 0])
+    day = np.minimum(day, span_days - 1e-6)
+    times = start_ts + pd.to_timedelta(np.floor(day), unit="D") + pd.to_timedelta(rng.integers(10 * 3600, 22 * 3600, n_rows), unit="s")
+
+    home_store = rng.integers(0, n_stores, n_customers)
+    store = np.where(rng.random(n_rows) < 0.92, home_store[customer], rng.integers(0, n_stores, n_rows))
+    fav_designer = rng.integers(0, designers_per_store, n_customers)
+    stays = rng.random(n_rows) < 0.7
+    designer = np.where(stays, fav_designer[customer], rng.integers(0, designers_per_store, n_rows))
+
+    item_idx = rng.integers(0, len(ITEMS), n_rows)
+    labels = []
+    for name, durations in ITEMS:
+        labels.extend(f"{name} {d}分鐘" for d in durations)
+    offsets = np.cumsum([0] + [len(d) for _, d in ITEMS])[:-1]
+    sizes = np.array([len(d) for _, d in ITEMS])
+    label_idx = offsets[item_idx] + (rng.random(n_rows) * sizes[item_idx]).astype(int)
+    items = np.array(labels, dtype=object)[label_idx]
+    add_on = rng.random(n_rows) < 0.1
+    items[add_on] = items[add_on] + "+" + np.array(ADD_ONS, dtype=object)[rng.integers(0, len(ADD_ONS), add_on.sum())]
+    items[rng.random(n_rows) < 0.02] = "商品加購"
+
+    # 電話格式混雜（同一顧客固定一種）：純數字、帶分隔符號；國碼有數字與 "+886"
+    phone = (900000000 + np.arange(n_customers)).astype(str).astype(object)
+    dashed = rng.random(n_customers) < 0.1
+    phone[dashed] = [f"{p[:3]}-{p[3:6]}-{p[6:]}" for p in phone[dashed]]
+    phone_text = phone[customer]
+    cc = np.where(rng.random(n_customers) < 0.8, 886, 0).astype(object)
+    cc[cc == 0] = "+886"
+    cc = cc[customer]
+
+    requested = np.where(stays, "Y", "N").astype(object)
+    requested[rng.random(n_rows) < 0.05] = None
+
+    df = pd.DataFrame({
+        "國碼": cc,
+        "電話號碼": phone_text,
+        "結帳操作時間": times,
+        "設計師": np.char.add("師", designer.astype(str)).astype(object),
+        "分店": np.char.add("店", store.astype(str)).astype(object),
+        "項目": items,
+        "指定": requested,
+    })
+    # 帳單匯出是依時間排序
+    return df.sort_values("結帳操作時間", kind="stable").reset_index(drop=True)
+
+def synthetic_members(bills, seed=0):
+    rng = np.random.default_rng(seed)
+    phones = bills["電話號碼"].astype(str).str.replace("-", "", regex=False).unique()
+    phones = phones[rng.random(len(phones)) < 0.8]
+    return pd.DataFrame({
+        "國碼": 886,
+        "手機號碼": phones,
+        "來店次數": rng.integers(1, 30, len(phones)),
+        "會員姓名": [f"客{i}" for i in range(len(phones))],
+    })
+
+def write_store_workbooks(bills, directory, sheet="服務"):
+    # 依分店各寫一個「<分店>帳單紀錄.xlsx」，與實際上傳格式相同
+    paths = []
+    for store, df in bills.groupby("分店", sort=True):
+        path = directory / f"{store}帳單紀錄.xlsx"
+        df.drop(columns="分店").to_excel(path, sheet_name=sheet, index=False)
+        paths.append(path)
+    return paths
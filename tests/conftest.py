@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# 讀檔快取與服務時長對照表指向暫存資料夾，測試不會讀寫使用者的快取；需在匯入專案模組前設定
+_CACHE_TMP = tempfile.TemporaryDirectory(prefix="tests-cache-")
+os.environ["BILL_CACHE_DIR"] = os.path.join(_CACHE_TMP.name, "bills")
+os.environ["ITEM_MINUTES_DIR"] = os.path.join(_CACHE_TMP.name, "items")
+os.environ["ANALYTICS_STATE_DIR"] = os.path.join(_CACHE_TMP.name, "state")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
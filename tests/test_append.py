@@ -0,0 +1,94 @@
+import pandas as pd
+import pytest
+
+import service_items
+from analytics import append_bills, build_base_model, compute_view, save_base_state
+from service_items import save_item_overrides
+from synthetic import synthetic_bills, write_store_workbooks
+
+# 各分店的狀態截止：月初切齊與月中切開兩種；第一批（A）為截止前的帳單，第二批（B）為之後的帳單
+CUTOFFS = {
+    "month_start": {"店0": "2025-11-01", "店1": "2025-11-01"},
+    "mid_month": {"店0": "2025-11-15 12:00", "店1": "2025-10-20"},
+}
+FRAME_KEYS = {
+    "new_first": ["phone_key"],
+    "relationship_first": ["phone_key", "分店", "設計師"],
+    "activity_monthly": ["分店", "設計師", "month"],
+    "vacancy_monthly": ["分店", "設計師", "month"],
+    "store_partials": ["end_date", "分店", "設計師", "month"],
+}
+
+
+@pytest.fixture(scope="module")
+def bills():
+    return synthetic_bills(4_000, n_stores=2, months=6, seed=6)
+
+
+@pytest.fixture
+def no_overrides():
+    service_items.OVERRIDE_PATH.unlink(missing_ok=True)
+    yield
+    service_items.OVERRIDE_PATH.unlink(missing_ok=True)
+
+
+def split_files(bills, cutoffs, directory):
+    limit = bills["分店"].map({store: pd.Timestamp(t) for store, t in cutoffs.items()})
+    early = bills["結帳操作時間"] < limit
+    (directory / "A").mkdir()
+    (directory / "B").mkdir()
+    return write_store_workbooks(bills[early], directory / "A"), write_store_workbooks(bills[~early], directory / "B")
+
+
+def sorted_frame(df, keys):
+    df = df.sort_values(keys, kind="stable").reset_index(drop=True)
+    # 類別的順序依附加先後可能不同，文字欄依讀檔批次可能是 str 或 object，比對時都還原成原值
+    return df.astype({
+        c: object for c in df.columns if isinstance(df[c].dtype, (pd.CategoricalDtype, pd.StringDtype))
+    })
+
+
+def assert_same_base(appended, full):
+    for key, keys in FRAME_KEYS.items():
+        pd.testing.assert_frame_equal(sorted_frame(appended[key], keys), sorted_frame(full[key], keys), obj=key)
+    pd.testing.assert_frame_equal(
+        sorted_frame(compute_view(appended)["designer_metrics"], ["設計師"]),
+        sorted_frame(compute_view(full)["designer_metrics"], ["設計師"]),
+        obj="designer_metrics",
+    )
+
+
+@pytest.mark.parametrize("cutoff", list(CUTOFFS))
+def test_append_matches_full_build(bills, cutoff, tmp_path, no_overrides):
+    files_a, files_b = split_files(bills, CUTOFFS[cutoff], tmp_path)
+    save_base_state(build_base_model(files_a, None, ["服務"]))
+    appended, rows = append_bills(files_b, ["服務"])
+    assert rows == len(bills) - sum(len(pd.read_excel(f)) for f in files_a)
+    assert_same_base(appended, build_base_model(files_a + files_b, None, ["服務"]))
+
+
+def test_append_applies_changed_overrides(bills, tmp_path, no_overrides):
+    files_a, files_b = split_files(bills, CUTOFFS["mid_month"], tmp_path)
+    save_base_state(build_base_model(files_a, None, ["服務"]))
+    # 狀態存檔後才改覆寫：已存月份的服務時數也要依新的對照表
+    save_item_overrides(pd.DataFrame({"項目": ["商品加購"], "分鐘": [45]}))
+    appended, _ = append_bills(files_b, ["服務"])
+    full = build_base_model(files_a + files_b, None, ["服務"])
+    assert_same_base(appended, full)
+
+    # 同一批帳單再附加一次（app 重跑）前又改了覆寫，不能沿用舊的狀態
+    save_item_overrides(pd.DataFrame({"項目": ["商品加購"], "分鐘": [90]}))
+    again, _ = append_bills(files_b, ["服務"])
+    assert_same_base(again, build_base_model(files_a + files_b, None, ["服務"]))
+
+
+def test_repeated_append_reports_saved_rows(bills, tmp_path, no_overrides):
+    files_a, files_b = split_files(bills, CUTOFFS["month_start"], tmp_path)
+    save_base_state(build_base_model(files_a, None, ["服務"]))
+
+    base, appended = append_bills(files_b, ["服務"])
+    assert appended > 0
+    # 附加後狀態檔已改寫，同一批帳單再呼叫一次（app 重跑）仍回報當時附加的筆數，不重複附加
+    again, appended_again = append_bills(files_b, ["服務"])
+    assert appended_again == appended
+    assert len(again["merged"]) == len(base["merged"])
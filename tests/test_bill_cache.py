@@ -0,0 +1,56 @@
+import importlib.util
+
+import pandas as pd
+
+import bill_io
+from analytics import normalize_bills
+from bill_io import load_bills
+from synthetic import synthetic_bills, write_store_workbooks
+
+NORMALIZER = '''
+def normalize(df):
+    df["分鐘"] = {minutes}
+    return df
+'''
+
+
+def load_normalizer(path, minutes):
+    path.write_text(NORMALIZER.format(minutes=minutes), encoding="utf-8")
+    spec = importlib.util.spec_from_file_location(f"normalizer_{minutes}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.normalize
+
+
+def test_normalized_cache_follows_normalizer_source(tmp_path):
+    (path,) = write_store_workbooks(synthetic_bills(200, n_stores=1, seed=4), tmp_path)
+    first = load_normalizer(tmp_path / "normalizer.py", 30)
+    df, _, timings = load_bills([path], ["服務"], normalize=first)
+    assert [t["來源"] for t in timings] == ["解析"]
+    df, _, timings = load_bills([path], ["服務"], normalize=first)
+    assert [t["來源"] for t in timings] == ["快取"]
+    assert (df["分鐘"] == 30).all()
+
+    # 同名的正規化函式改了內容，不能讀到舊版結果
+    second = load_normalizer(tmp_path / "normalizer.py", 45)
+    df, _, timings = load_bills([path], ["服務"], normalize=second)
+    assert [t["來源"] for t in timings] == ["解析"]
+    assert (df["分鐘"] == 45).all()
+
+
+
+def test_streamed_chunks_match_read_excel(tmp_path, monkeypatch):
+    # 每塊 64 列、每家分店約 400 列：跨塊以 union_categoricals 合併的類別與逐塊正規化，都要與整表讀入相同。
+    # 以 app 實際用的 normalize_bills 比對；不正規化時混用數字與文字的欄位各塊推斷可能不同（見 README）
+    paths = write_store_workbooks(synthetic_bills(1_200, n_stores=3, seed=5), tmp_path)
+    monkeypatch.setattr(bill_io, "BILL_STREAM_CHUNK_ROWS", 64)
+    frames = {}
+    for streaming in [True, False]:
+        # 讀檔快取不分是否串流，各用一個快取資料夾
+        monkeypatch.setattr(bill_io, "BILL_CACHE_DIR", tmp_path / f"cache-{streaming}")
+        df, _, timings = load_bills(paths, ["服務"], normalize=normalize_bills, streaming=streaming)
+        assert {t["來源"] for t in timings} == {"串流" if streaming else "解析"}
+        frames[streaming] = df
+    assert len(frames[True]) == 1_200
+    assert isinstance(frames[True]["項目"].dtype, pd.CategoricalDtype)
+    pd.testing.assert_frame_equal(frames[True], frames[False])
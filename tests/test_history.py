@@ -0,0 +1,28 @@
+import pandas as pd
+import pytest
+
+from analytics import compute_view, derive_base_model, designer_history, prepare_checkouts
+from synthetic import synthetic_bills
+
+# 師傅指標歷史的每一期，須與只用該月底以前的帳單完整重算的 compute_view 相同
+
+@pytest.fixture(scope="module")
+def checkouts():
+    return prepare_checkouts(synthetic_bills(20_000, n_stores=3, designers_per_store=4, months=10, seed=1))
+
+def by_designer(df):
+    df = df.assign(設計師=df["設計師"].astype(str))
+    return df.sort_values("設計師").reset_index(drop=True)
+
+@pytest.mark.parametrize("store_filter", [None, ["店0", "店1"]])
+def test_history_matches_rerun_on_truncated_bills(checkouts, store_filter):
+    base = derive_base_model(checkouts.copy(), None, ["服務"], [])
+    history = designer_history(base, store_filter, months=6)
+    assert history["end_date"].nunique() == 6
+    for end_date, period in history.groupby("end_date"):
+        next_month = (end_date.to_period("M") + 1).start_time
+        truncated = checkouts[checkouts["結帳操作時間"] < next_month]
+        view = compute_view(derive_base_model(truncated.copy(), None, ["服務"], []), store_filter)
+        assert view["end_date"] == end_date
+        expected = by_designer(view["designer_metrics"])
+        pd.testing.assert_frame_equal(by_designer(period.drop(columns="end_date"))[expected.columns], expected, check_dtype=False)
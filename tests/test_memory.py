@@ -0,0 +1,64 @@
+import gc
+import subprocess
+import tracemalloc
+import types
+from pathlib import Path
+
+import pytest
+
+import analytics
+from synthetic import synthetic_bills
+
+# 尖峰記憶體（tracemalloc）與改版前（整表複製）的 analytics.py 比較；舊版由 git 歷史取得
+BEFORE_REVISION = "fd68fa4"
+ROOT = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope="module")
+def before():
+    try:
+        source = subprocess.run(
+            ["git", "show", f"{BEFORE_REVISION}:analytics.py"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip(f"沒有 git 歷史，取不到 {BEFORE_REVISION} 的 analytics.py")
+    module = types.ModuleType("analytics_before")
+    exec(compile(source, f"{BEFORE_REVISION}:analytics.py", "exec"), module.__dict__)
+    return module
+
+
+@pytest.fixture(scope="module")
+def bills():
+    # 實際上傳的帳單是各分店檔案接在一起，時間沒有排序
+    return synthetic_bills(100_000, seed=2).sample(frac=1, random_state=2).reset_index(drop=True)
+
+
+def pipeline_peaks(module, bills):
+    # 基礎模型建立、全品牌檢視、3 家分店檢視各自的尖峰，與建立到全品牌檢視整段的尖峰（MiB，以呼叫前為 0）
+    merged = module.prepare_checkouts(bills.copy())
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        base = module.derive_base_model(merged, None, [], {})
+        peaks = {"base": tracemalloc.get_traced_memory()[1] - start}
+        for name, store_filter in [("view", None), ("stores", module.store_options(base)[:3])]:
+            held = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            module.compute_view(base, store_filter)
+            peaks[name] = tracemalloc.get_traced_memory()[1] - held
+            peaks.setdefault("pipeline", max(peaks["base"], tracemalloc.get_traced_memory()[1] - start))
+    finally:
+        tracemalloc.stop()
+    return {k: v / 2**20 for k, v in peaks.items()}
+
+
+def test_peak_memory_below_copy_heavy_pipeline(before, bills):
+    old = pipeline_peaks(before, bills)
+    new = pipeline_peaks(analytics, bills)
+    # 檢視階段不再複製整份結帳列：全品牌與分店子集都降到 1/3 以下
+    assert old["view"] >= 3 * new["view"], (old, new)
+    assert old["stores"] >= 3 * new["stores"], (old, new)
+    # 建立基礎模型（多了拜訪索引與分店部分彙總）不高於改版前；整段尖峰約降 40%
+    assert new["base"] <= old["base"], (old, new)
+    assert old["pipeline"] >= 1.5 * new["pipeline"], (old, new)
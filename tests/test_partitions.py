@@ -0,0 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pytest
+
+from analytics import derive_base_model, prepare_checkouts
+from synthetic import synthetic_bills
+
+
+@pytest.fixture(scope="module")
+def merged():
+    return prepare_checkouts(synthetic_bills(3_000, n_stores=3, seed=5))
+
+
+@pytest.mark.parametrize("case", ["all", "empty", "no_store"])
+def test_partitioned_frames_match_sequential(merged, case):
+    if case == "empty":
+        merged = merged.iloc[:0]
+    elif case == "no_store":
+        merged = merged.assign(分店=pd.Series(pd.NA, index=merged.index, dtype=merged["分店"].dtype))
+    sequential = derive_base_model(merged.copy(), None, [], {})
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        partitioned = derive_base_model(merged.copy(), None, [], {}, executor=executor)
+    for key in ["new_first", "relationship_first", "activity_monthly"]:
+        pd.testing.assert_frame_equal(partitioned[key], sequential[key])
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from analytics import KEY_COLUMNS, prepare_checkouts, visit_index
+from bench import first_checkouts, regular_loop, regular_metrics
+from synthetic import synthetic_bills
+
+
+@pytest.mark.parametrize("seed", [7, 8, 9])
+def test_regular_metrics_match_loop(seed):
+    bills = synthetic_bills(8_000, n_stores=3, seed=seed)
+    rng = np.random.default_rng(seed)
+    # 隨機留空結帳時間、分店與師傅：缺時間的結帳不算來店，缺 key 的列不屬於任何關係
+    bills.loc[rng.random(len(bills)) < 0.02, "結帳操作時間"] = pd.NaT
+    bills.loc[rng.random(len(bills)) < 0.02, "分店"] = None
+    bills.loc[rng.random(len(bills)) < 0.02, "設計師"] = None
+    merged_sorted, _ = first_checkouts(prepare_checkouts(bills))
+    result = regular_metrics(merged_sorted, visit_index(merged_sorted, KEY_COLUMNS))
+    expected = regular_loop(result[KEY_COLUMNS + ["baseline_time"]], merged_sorted)
+    assert expected["retention_achieved"].eq(True).any()
+    np.testing.assert_array_equal(result["regular_count_180"].to_numpy(), expected["regular_count_180"].to_numpy(dtype=np.int64))
+    np.testing.assert_array_equal(result["regular_achieved"].to_numpy(), expected["regular_achieved"].to_numpy(dtype=bool))
+    pd.testing.assert_series_equal(
+        pd.to_datetime(result["regular_date"]), pd.to_datetime(expected["regular_date"]), check_dtype=False
+    )
+    np.testing.assert_array_equal(
+        result["post_regular_visits_180"].to_numpy(), expected["post_regular_visits_180"].to_numpy(dtype=float)
+    )
+    pd.testing.assert_series_equal(result["retention_achieved"], expected["retention_achieved"], check_dtype=False)
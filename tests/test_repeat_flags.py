@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from analytics import KEY_COLUMNS, T2_DAYS, T3_DAYS, add_repeat_flags, prepare_checkouts, visit_index
+from bench import first_checkouts, repeat_loop
+from synthetic import synthetic_bills
+
+
+@pytest.mark.parametrize("seed", [4, 5, 6])
+def test_repeat_flags_match_loop(seed):
+    bills = synthetic_bills(8_000, n_stores=3, seed=seed)
+    rng = np.random.default_rng(seed)
+    # 隨機留空結帳時間、分店與師傅：缺時間的首單沒有第 2、3 次，缺 key 的列不算任何關係的來店
+    bills.loc[rng.random(len(bills)) < 0.02, "結帳操作時間"] = pd.NaT
+    bills.loc[rng.random(len(bills)) < 0.02, "分店"] = None
+    bills.loc[rng.random(len(bills)) < 0.02, "設計師"] = None
+    merged_sorted, new_first = first_checkouts(prepare_checkouts(bills))
+    assert new_first["結帳操作時間"].isna().any()
+    expected = repeat_loop(new_first, merged_sorted, T2_DAYS, T3_DAYS)
+    index = visit_index(merged_sorted, KEY_COLUMNS)
+    result = add_repeat_flags(new_first.copy(), index, "結帳操作時間", T2_DAYS, T3_DAYS)
+    assert expected["repeat3"].any()
+    for col in ["days_to_2nd", "days_to_3rd"]:
+        np.testing.assert_array_equal(result[col].to_numpy(), expected[col].to_numpy(dtype=float))
+    for col in ["repeat2", "repeat3"]:
+        np.testing.assert_array_equal(result[col].to_numpy(), expected[col].to_numpy(dtype=bool))
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from analytics import CHURN_DAYS, add_store_return_flags, prepare_checkouts, visit_index
+from bench import first_checkouts, store_return_loop
+from synthetic import synthetic_bills
+
+
+@pytest.fixture(scope="module")
+def checkouts():
+    bills = synthetic_bills(20_000, n_stores=3, seed=3)
+    rng = np.random.default_rng(3)
+    # 部分結帳時間與分店留空：缺時間的顧客首單可能是 NaT，缺分店的列不算任何分店的來店
+    bills.loc[rng.random(len(bills)) < 0.02, "結帳操作時間"] = pd.NaT
+    bills.loc[rng.random(len(bills)) < 0.02, "分店"] = None
+    return first_checkouts(prepare_checkouts(bills))
+
+
+def test_store_return_matches_loop(checkouts):
+    merged_sorted, new_first = checkouts
+    assert new_first["結帳操作時間"].isna().any()
+    assert new_first["分店"].isna().any()
+    expected = store_return_loop(new_first, merged_sorted, CHURN_DAYS)
+    index = visit_index(merged_sorted, ["phone_key", "分店"])
+    result = add_store_return_flags(new_first.copy(), index, "結帳操作時間", CHURN_DAYS)
+    np.testing.assert_array_equal(
+        result["return_days_store"].to_numpy(), expected["return_days_store"].to_numpy(dtype=float)
+    )
+    np.testing.assert_array_equal(result["churn"].to_numpy(), expected["churn"].to_numpy(dtype=bool))